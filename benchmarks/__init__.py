@@ -0,0 +1,28 @@
+import json
+import time
+
+
+def report(benchmark, **results) -> None:
+    """ Print the results of a benchmark as a line of JSON. """
+    results['benchmark'] = benchmark
+    print(json.dumps(results, sort_keys=True), flush=True)
+
+
+def get_rate(count, seconds) -> float:
+    """ Get the amount of operations per second, rounded to whole operations. """
+    return round(count / seconds) if seconds > 0 else 0
+
+
+class Stopwatch:
+    """ Adds up the time spent inside its with blocks. """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self.started
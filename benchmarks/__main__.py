@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+
+from benchmarks import codecs, lookup, routing
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the DHT, every result is printed as a line of JSON.')
+    parser.add_argument(
+        '--only', action='append', choices=['routing', 'codecs', 'lookup'],
+        help='Only run this benchmark, can be given more than once.')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+        help='The amounts of contacts to add to a BucketTree.')
+    parser.add_argument(
+        '--iterations', type=int, default=10000, help='The amount of times to encode a message.')
+    parser.add_argument(
+        '--network-size', type=int, default=100, help='The amount of nodes in the simulated network.')
+    parser.add_argument(
+        '--lookups', type=int, default=100, help='The amount of lookups in the simulated network.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random keys.')
+
+    args = parser.parse_args()
+    benchmarks = args.only or ['routing', 'codecs', 'lookup']
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    if 'routing' in benchmarks:
+        routing.run(args.sizes, seed=args.seed)
+
+    if 'codecs' in benchmarks:
+        codecs.run(args.iterations, seed=args.seed)
+
+    if 'lookup' in benchmarks:
+        lookup.run(args.network_size, args.lookups, seed=args.seed)
@@ -0,0 +1,51 @@
+import random
+
+from dht.codecs import CODECS
+from dht.protocol import Message
+from dht.utils import hash_string
+
+from benchmarks import Stopwatch, get_rate, report
+
+
+def create_messages(rand) -> dict:
+    """ Create the messages that are sent most, by name. """
+
+    key = hash_string('benchmark')
+    contacts = [
+        [hash_string(str(i)), '10.0.{:d}.{:d}'.format(i, rand.randrange(256)), 9999]
+        for i in range(20)
+    ]
+    value = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(1024))
+
+    return {
+        'find_node': Message(1, key, 'find_node'),
+        'find_node_response': Message(1, contacts),
+        'store': Message(2, value, 'store'),
+    }
+
+
+def benchmark_message(name, message, codec, iterations) -> None:
+    """ Encode and decode a message with a codec. """
+
+    with Stopwatch() as encode:
+        for _ in range(iterations):
+            data = message.get_bytes(codec)
+
+    with Stopwatch() as decode:
+        for _ in range(iterations):
+            Message.from_bytes(data)
+
+    report(
+        'codecs.encode', codec=codec.name, message=name, size=len(data), iterations=iterations,
+        seconds=encode.seconds, ops_per_second=get_rate(iterations, encode.seconds))
+    report(
+        'codecs.decode', codec=codec.name, message=name, size=len(data), iterations=iterations,
+        seconds=decode.seconds, ops_per_second=get_rate(iterations, decode.seconds))
+
+
+def run(iterations=10000, seed=0) -> None:
+    messages = create_messages(random.Random(seed))
+
+    for codec in CODECS.values():
+        for name, message in messages.items():
+            benchmark_message(name, message, codec, iterations)
@@ -0,0 +1,48 @@
+import asyncio
+import random
+
+from dht.lookup import NodeLookup
+from dht.simulator import create_network
+from dht.utils import hash_string
+
+from benchmarks import Stopwatch, get_rate, report
+
+
+def get_percentile(values, percentile):
+    """ Get the percentile of sorted values. """
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def run(size=100, lookups=100, seed=0) -> None:
+    """ Look up random keys from random nodes of a simulated network. """
+
+    rand = random.Random(seed)
+    loop = asyncio.get_event_loop()
+
+    with Stopwatch() as build:
+        dhts = create_network(size, loop)
+
+    report('lookup.create_network', nodes=size, seconds=build.seconds)
+
+    latencies = []
+    hops = []
+
+    for i in range(lookups):
+        dht = rand.choice(dhts)
+        lookup = NodeLookup(hash_string(str(rand.random())), dht.bucket_tree, dht.get_protocol)
+
+        with Stopwatch() as stopwatch:
+            loop.run_until_complete(lookup.run())
+
+        latencies.append(stopwatch.seconds)
+        hops.append(lookup.get_hops())
+
+    latencies.sort()
+
+    report(
+        'lookup.node_lookup', nodes=size, lookups=lookups,
+        ops_per_second=get_rate(lookups, sum(latencies)),
+        latency_mean=sum(latencies) / lookups,
+        latency_p50=get_percentile(latencies, 50),
+        latency_p99=get_percentile(latencies, 99),
+        hops_mean=sum(hops) / lookups)
@@ -0,0 +1,97 @@
+import random
+
+from dht import settings
+from dht.contacts import ContactTable
+from dht.node import Node, SelfNode
+from dht.routing import BucketTree
+
+from benchmarks import Stopwatch, get_rate, report
+
+
+# Nodes are created in batches outside of the timed blocks, so creating them isn't
+# measured and a million of them don't have to be in memory at once.
+BATCH_SIZE = 10000
+
+
+def create_nodes(rand, amount) -> list:
+    key_format = '{:0' + str(settings.KEY_SIZE // 4) + 'x}'
+
+    return [
+        Node(key_format.format(rand.getrandbits(settings.KEY_SIZE)), '127.0.0.1', 9999)
+        for _ in range(amount)
+    ]
+
+
+def benchmark_add_node(rand, size) -> BucketTree:
+    """ Add size random contacts to a new BucketTree, most of them don't fit. """
+
+    tree = BucketTree(SelfNode(create_nodes(rand, 1)[0].key, '127.0.0.1', 9999))
+    stopwatch = Stopwatch()
+
+    for start in range(0, size, BATCH_SIZE):
+        nodes = create_nodes(rand, min(BATCH_SIZE, size - start))
+
+        with stopwatch:
+            for node in nodes:
+                tree.add_node(node)
+
+    contacts = sum(
+        len(bucket_node.bucket.nodes) for bucket_node in tree.get_leaf_bucket_nodes(include_self=True))
+
+    report(
+        'routing.add_node', contacts=size, nodes_in_tree=contacts,
+        seconds=stopwatch.seconds, ops_per_second=get_rate(size, stopwatch.seconds))
+
+    return tree
+
+
+def benchmark_find_nodes(rand, tree, size, lookups) -> None:
+    """ Find the closest nodes to random keys in a BucketTree. """
+
+    keys = [node.key for node in create_nodes(rand, lookups)]
+
+    with Stopwatch() as stopwatch:
+        for key in keys:
+            tree.find_nodes(key)
+
+    report(
+        'routing.find_nodes', contacts=size, lookups=lookups,
+        seconds=stopwatch.seconds, ops_per_second=get_rate(lookups, stopwatch.seconds))
+
+
+def benchmark_contact_table(rand, size, lookups) -> None:
+    """ Add size random contacts to a ContactTable, they all fit, and find the
+    closest contacts to random keys in it. """
+
+    table = ContactTable()
+    stopwatch = Stopwatch()
+
+    for start in range(0, size, BATCH_SIZE):
+        nodes = create_nodes(rand, min(BATCH_SIZE, size - start))
+
+        with stopwatch:
+            for node in nodes:
+                table.add_node(node)
+
+    report(
+        'contacts.add', contacts=size,
+        seconds=stopwatch.seconds, ops_per_second=get_rate(size, stopwatch.seconds))
+
+    keys = [node.key for node in create_nodes(rand, lookups)]
+
+    with Stopwatch() as stopwatch:
+        for key in keys:
+            table.find_nodes(key)
+
+    report(
+        'contacts.find_nodes', contacts=size, lookups=lookups,
+        seconds=stopwatch.seconds, ops_per_second=get_rate(lookups, stopwatch.seconds))
+
+
+def run(sizes, lookups=10000, seed=0) -> None:
+    rand = random.Random(seed)
+
+    for size in sizes:
+        tree = benchmark_add_node(rand, size)
+        benchmark_find_nodes(rand, tree, size, lookups)
+        benchmark_contact_table(rand, size, lookups)
@@ -1,7 +1,10 @@
 import logging
+import time
+
+from collections import OrderedDict
 
 from dht.node import SelfNode
-from dht.settings import BUCKET_SIZE, BUCKET_REPLACEMENT_CACHE_SIZE
+from dht.settings import BUCKET_SIZE, BUCKET_REPLACEMENT_CACHE_SIZE, BUCKET_STALE_FAILURES
 
 
 class BucketHasSelfException(Exception):
@@ -21,26 +24,29 @@ class BucketIsFullException(Exception):
 
 
 class Bucket:
-    """ A Bucket is a list of sorted Nodes by last_seen. """
+    """ A Bucket holds Nodes by key, ordered by last_seen with the least recently
+    seen Node first. The replacement cache holds the Nodes that didn't fit, in the
+    same order. """
 
     def __init__(self,
                  nodes_size=BUCKET_SIZE,
-                 replacement_cache_size=BUCKET_REPLACEMENT_CACHE_SIZE):
+                 replacement_cache_size=BUCKET_REPLACEMENT_CACHE_SIZE,
+                 stale_failures=BUCKET_STALE_FAILURES):
         """ Init the Bucket. """
-        self.nodes = []
+        self.nodes = OrderedDict()
         self.nodes_size = nodes_size
-        self.replacement_cache = []
+        self.replacement_cache = OrderedDict()
         self.replacement_cache_size = replacement_cache_size
+        self.stale_failures = stale_failures
         self.has_self = False
 
-    def add_node(self, node):
-        """ Add a node to this bucket. """
+    def add_node(self, node) -> bool:
+        """ Add a node to this bucket. A full Bucket makes room by replacing a stale
+        node. Return False if there is no room and the node is added to the
+        replacement cache instead. """
 
-        try:
-            self.find_node(node.key)
+        if node.key in self.nodes:
             raise NodeAlreadyAddedException('This node is already in this Bucket.')
-        except NodeNotFoundException:
-            pass
 
         if self.has_self:
             raise BucketHasSelfException('This Bucket has SelfNode, split this Bucket.')
@@ -48,47 +54,102 @@ class Bucket:
         if isinstance(node, SelfNode):
             self.has_self = True
 
-        if len(self.nodes) < self.nodes_size:
-            self.nodes.append(node)
-            self.sort()
-        elif len(self.replacement_cache) < self.replacement_cache_size:
-            self.add_replacement(node)
-        else:
-            raise BucketIsFullException()
+        if len(self.nodes) >= self.nodes_size:
+            stale = self.get_stale_node()
+
+            if stale is None:
+                self.add_replacement(node)
+                return False
+
+            logging.debug("Replacing stale node %s", stale.key)
+            del self.nodes[stale.key]
+
+        # A Node we already have as a replacement keeps its protocol and history.
+        node = self.replacement_cache.pop(node.key, node)
+        self.nodes[node.key] = node
+        return True
 
     def find_node(self, key):
         """ Find and return a Node by key in this Bucket. """
         try:
-            return next(node for node in self.nodes if node.key == key)
-        except StopIteration:
+            return self.nodes[key]
+        except KeyError:
             raise NodeNotFoundException()
 
     def remove_node(self, key):
         """ Remove and return a Node from this Bucket. """
-        (node, index) = next(
-            (self.nodes[i], i) for i in range(len(self.nodes)) if self.nodes[i].key == key)
-        del self.nodes[index]
-        return node
+        try:
+            return self.nodes.pop(key)
+        except KeyError:
+            raise NodeNotFoundException()
+
+    def touch(self, key) -> None:
+        """ Mark a Node, or a Node in the replacement cache, as seen now. It becomes
+        the most recently seen Node. """
+
+        if key in self.nodes:
+            nodes = self.nodes
+        elif key in self.replacement_cache:
+            nodes = self.replacement_cache
+        else:
+            raise NodeNotFoundException()
+
+        nodes[key].last_seen = time.monotonic()
+        nodes.move_to_end(key)
 
-    def sort(self):
-        """ Sort the nodes of this Bucket by last_seen. """
-        self.nodes.sort(key=lambda node: node.last_seen)
+    def get_least_recently_seen(self):
+        """ Get the Node that wasn't seen for the longest time. """
+        return next(iter(self.nodes.values()))
+
+    def get_stale_node(self):
+        """ Get the least recently seen stale Node, None if no Node is stale. """
+        return next(
+            (node for node in self.nodes.values() if node.failures >= self.stale_failures), None)
+
+    def replace_node(self, key):
+        """ Replace a Node by the most recently seen Node of the replacement cache.
+        Return the replacement, None if there is none and the Node is kept. """
+
+        if key not in self.nodes:
+            raise NodeNotFoundException()
+
+        if not self.replacement_cache:
+            return None
+
+        del self.nodes[key]
+
+        _, node = self.replacement_cache.popitem()
+        self.nodes[node.key] = node
+        return node
 
     def add_replacement(self, node):
-        self.replacement_cache.append(node)
+        """ Add a node to the replacement cache, the least recently seen replacement
+        makes room when the cache is full. A node that is in the cache already is only
+        marked as seen, the Node in the cache keeps its protocol and history. """
+
+        if node.key in self.replacement_cache:
+            self.touch(node.key)
+            return
+
+        if len(self.replacement_cache) >= self.replacement_cache_size:
+            if not self.replacement_cache:
+                raise BucketIsFullException()
+
+            self.replacement_cache.popitem(last=False)
+
+        self.replacement_cache[node.key] = node
 
     def get_unconnected_nodes(self) -> list:
         """ Get the unconnected nodes in this Bucket. """
 
         unconnected = []
 
-        for node in self.nodes:
+        for node in self.nodes.values():
             if not node.is_connected():
                 unconnected.append(node)
 
-        for node in self.replacement_cache:
+        for node in self.replacement_cache.values():
             if not node.is_connected():
                 unconnected.append(node)
 
         return unconnected
-
@@ -0,0 +1,42 @@
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ Keeps values for ttl seconds. When there are more than max_size values the
+    least recently used values are dropped. """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # The value and the time it expires by key, the least recently used first.
+        self.items = OrderedDict()
+
+    def get(self, key):
+        """ Get the value of a key, raise a KeyError if it isn't there or expired. """
+
+        value, expires = self.items[key]
+
+        if expires <= self.clock():
+            del self.items[key]
+            raise KeyError(key)
+
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        self.items[key] = (value, self.clock() + self.ttl)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def remove(self, key) -> None:
+        self.items.pop(key, None)
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,353 @@
+import json
+import socket
+import struct
+
+from dht import settings
+
+
+class UnknownCodecException(Exception):
+    pass
+
+
+class JSONCodec:
+    """ Encodes messages as JSON objects, every peer understands this codec. """
+
+    name = 'json'
+
+    @staticmethod
+    def matches(payload) -> bool:
+        """ Check if the payload is encoded with this codec. """
+        return payload[0] == ord('{')
+
+    def encode(self, msg_id: int, command: str, data) -> bytes:
+        message = {
+            "id": msg_id,
+            "data": data,
+        }
+
+        if command:
+            message["command"] = command
+
+        return json.dumps(message).encode()
+
+    def decode(self, payload) -> tuple:
+        message = json.loads(str(payload, 'utf-8'))
+        return message['id'], message.get('command'), message['data']
+
+
+class BinaryCodec:
+    """ Encodes messages with struct packed headers and type tagged values. Keys
+    (lowercase hexadecimal strings) are sent as raw bytes and contacts, (key,
+    address, port), as a raw key with a packed IP address and port. Decoding
+    gives the same values as the JSON codec would. """
+
+    name = 'binary'
+
+    MAGIC = 0xd7
+
+    # Magic, message id and the length of the command that follows the header.
+    HEADER = struct.Struct('>BQB')
+
+    NONE = 0
+    FALSE = 1
+    TRUE = 2
+    INT = 3
+    FLOAT = 4
+    STR = 5
+    HEX = 6
+    LIST = 7
+    DICT = 8
+    CONTACT_IPV4 = 9
+    CONTACT_IPV6 = 10
+    BIG_INT = 11
+
+    CONTACT_TAGS = frozenset((CONTACT_IPV4, CONTACT_IPV6))
+
+    TAG = struct.Struct('>B')
+    LENGTH = struct.Struct('>I')
+    HEX_LENGTH = struct.Struct('>B')
+    INT_VALUE = struct.Struct('>q')
+    FLOAT_VALUE = struct.Struct('>d')
+    PORT = struct.Struct('>H')
+
+    # The tag and key length of a packed contact.
+    CONTACT_HEADER = struct.Struct('>BB')
+
+    # Only strings long enough to gain from packing, and short enough to fit the
+    # length byte, are sent as raw bytes.
+    HEX_MIN_LENGTH = 16
+    HEX_MAX_LENGTH = 510
+
+    INT_MIN = -2 ** 63
+    INT_MAX = 2 ** 63 - 1
+
+    @classmethod
+    def matches(cls, payload) -> bool:
+        """ Check if the payload is encoded with this codec. """
+        return payload[0] == cls.MAGIC
+
+    def encode(self, msg_id: int, command: str, data) -> bytes:
+        command = (command or '').encode()
+
+        parts = [self.HEADER.pack(self.MAGIC, msg_id, len(command)), command]
+        self._encode_value(data, parts)
+
+        return b''.join(parts)
+
+    def decode(self, payload) -> tuple:
+        payload = memoryview(payload)
+
+        _, msg_id, command_length = self.HEADER.unpack_from(payload)
+        offset = self.HEADER.size + command_length
+
+        command = str(payload[self.HEADER.size:offset], 'ascii') or None
+        data, _ = self._decode_value(payload, offset)
+
+        return msg_id, command, data
+
+    def _encode_value(self, value, parts: list) -> None:
+        """ Encode value and append the encoded parts to parts. """
+
+        if value is None:
+            parts.append(self.TAG.pack(self.NONE))
+
+        elif value is True:
+            parts.append(self.TAG.pack(self.TRUE))
+
+        elif value is False:
+            parts.append(self.TAG.pack(self.FALSE))
+
+        elif isinstance(value, int):
+            if self.INT_MIN <= value <= self.INT_MAX:
+                parts.append(self.TAG.pack(self.INT))
+                parts.append(self.INT_VALUE.pack(value))
+            else:
+                encoded = str(value).encode()
+                parts.append(self.TAG.pack(self.BIG_INT))
+                parts.append(self.LENGTH.pack(len(encoded)))
+                parts.append(encoded)
+
+        elif isinstance(value, float):
+            parts.append(self.TAG.pack(self.FLOAT))
+            parts.append(self.FLOAT_VALUE.pack(value))
+
+        elif isinstance(value, str):
+            raw = self._get_hex_bytes(value)
+
+            if raw is not None:
+                parts.append(self.TAG.pack(self.HEX))
+                parts.append(self.HEX_LENGTH.pack(len(raw)))
+                parts.append(raw)
+            else:
+                encoded = value.encode()
+                parts.append(self.TAG.pack(self.STR))
+                parts.append(self.LENGTH.pack(len(encoded)))
+                parts.append(encoded)
+
+        elif isinstance(value, (list, tuple)):
+            if not self._encode_contact(value, parts):
+                parts.append(self.TAG.pack(self.LIST))
+                parts.append(self.LENGTH.pack(len(value)))
+
+                for item in value:
+                    # Most lists are lists of contacts, try them first.
+                    if type(item) not in (list, tuple) or not self._encode_contact(item, parts):
+                        self._encode_value(item, parts)
+
+        elif isinstance(value, dict):
+            parts.append(self.TAG.pack(self.DICT))
+            parts.append(self.LENGTH.pack(len(value)))
+
+            for key, item in value.items():
+                self._encode_value(str(key), parts)
+                self._encode_value(item, parts)
+
+        else:
+            raise TypeError('Can not encode value of type {}'.format(type(value).__name__))
+
+    def _get_hex_bytes(self, value: str):
+        """ Get the raw bytes of a lowercase hexadecimal string, or None if the string
+        is not sent as raw bytes. """
+
+        length = len(value)
+
+        if length < self.HEX_MIN_LENGTH or length > self.HEX_MAX_LENGTH or length & 1:
+            return None
+
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            return None
+
+        # Whitespace or uppercase digits would not decode to the same string again.
+        if len(raw) * 2 != length or not value.islower():
+            return None
+
+        return raw
+
+    def _encode_contact(self, value, parts: list) -> bool:
+        """ Encode a (key, address, port) contact in its packed form if it can be
+        decoded to exactly the same value again. """
+
+        if len(value) != 3:
+            return False
+
+        key, address, port = value
+
+        if type(key) is not str or type(address) is not str or type(port) is not int:
+            return False
+
+        raw = self._get_hex_bytes(key)
+
+        if raw is None or not 0 <= port <= 0xffff:
+            return False
+
+        # inet_pton only accepts IPv4 addresses in their dotted decimal form, IPv6
+        # addresses can be written in more than one way.
+        try:
+            if ':' in address:
+                tag = self.CONTACT_IPV6
+                packed = socket.inet_pton(socket.AF_INET6, address)
+
+                if socket.inet_ntop(socket.AF_INET6, packed) != address:
+                    return False
+            else:
+                tag = self.CONTACT_IPV4
+                packed = socket.inet_pton(socket.AF_INET, address)
+        except (OSError, ValueError):
+            return False
+
+        parts.append(self.CONTACT_HEADER.pack(tag, len(raw)) + raw + packed + self.PORT.pack(port))
+
+        return True
+
+    def _decode_value(self, payload: memoryview, offset: int) -> tuple:
+        """ Decode the value at offset, return the value and the offset after it. """
+
+        (tag,) = self.TAG.unpack_from(payload, offset)
+        offset += self.TAG.size
+
+        if tag == self.NONE:
+            return None, offset
+
+        if tag == self.TRUE:
+            return True, offset
+
+        if tag == self.FALSE:
+            return False, offset
+
+        if tag == self.INT:
+            return self.INT_VALUE.unpack_from(payload, offset)[0], offset + self.INT_VALUE.size
+
+        if tag == self.FLOAT:
+            return self.FLOAT_VALUE.unpack_from(payload, offset)[0], offset + self.FLOAT_VALUE.size
+
+        if tag in (self.STR, self.BIG_INT):
+            (length,) = self.LENGTH.unpack_from(payload, offset)
+            start = offset + self.LENGTH.size
+            value = str(payload[start:start + length], 'utf-8')
+            return (int(value) if tag == self.BIG_INT else value), start + length
+
+        if tag == self.HEX:
+            return self._decode_hex(payload, offset)
+
+        if tag == self.LIST:
+            (length,) = self.LENGTH.unpack_from(payload, offset)
+            offset += self.LENGTH.size
+            value = []
+
+            for _ in range(length):
+                # Most lists are lists of contacts, decode them without the other tags.
+                if payload[offset] in self.CONTACT_TAGS:
+                    item, offset = self._decode_contact(payload, offset)
+                else:
+                    item, offset = self._decode_value(payload, offset)
+
+                value.append(item)
+
+            return value, offset
+
+        if tag == self.DICT:
+            (length,) = self.LENGTH.unpack_from(payload, offset)
+            offset += self.LENGTH.size
+            value = {}
+
+            for _ in range(length):
+                key, offset = self._decode_value(payload, offset)
+                value[key], offset = self._decode_value(payload, offset)
+
+            return value, offset
+
+        if tag in self.CONTACT_TAGS:
+            return self._decode_contact(payload, offset - self.TAG.size)
+
+        raise ValueError('Unknown value tag {:d}'.format(tag))
+
+    def _decode_contact(self, payload: memoryview, offset: int) -> tuple:
+        """ Decode the contact at offset, including its tag. """
+
+        tag, length = self.CONTACT_HEADER.unpack_from(payload, offset)
+        start = offset + self.CONTACT_HEADER.size
+        offset = start + length
+        key = payload[start:offset].hex()
+
+        if tag == self.CONTACT_IPV4:
+            address = socket.inet_ntop(socket.AF_INET, payload[offset:offset + 4])
+            offset += 4
+        else:
+            address = socket.inet_ntop(socket.AF_INET6, payload[offset:offset + 16])
+            offset += 16
+
+        (port,) = self.PORT.unpack_from(payload, offset)
+        return [key, address, port], offset + self.PORT.size
+
+    def _decode_hex(self, payload: memoryview, offset: int) -> tuple:
+        (length,) = self.HEX_LENGTH.unpack_from(payload, offset)
+        start = offset + self.HEX_LENGTH.size
+        return payload[start:start + length].hex(), start + length
+
+
+JSON_CODEC = JSONCodec()
+
+CODECS = {codec.name: codec for codec in (JSON_CODEC, BinaryCodec())}
+
+
+def get_encoded_size(value) -> int:
+    """ Get the most bytes a string, or a list of strings, can take in a message with
+    any of the codecs. The JSON encoding of a string is never smaller than its binary
+    encoding, this doesn't hold for other values like numbers. """
+    return len(json.dumps(value)) + 8
+
+
+def get_codec(name: str):
+    """ Get a codec by name. """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise UnknownCodecException('Unknown codec: {}'.format(name))
+
+
+def get_payload_codec(payload):
+    """ Get the codec the payload is encoded with. """
+    if not payload:
+        raise UnknownCodecException('Payload is empty.')
+
+    for codec in CODECS.values():
+        if codec.matches(payload):
+            return codec
+
+    raise UnknownCodecException('Payload is not encoded with a known codec.')
+
+
+def select_codec(names: list):
+    """ Select the codec both we and a peer prefer most, names are the codecs of the
+    peer, the most preferred first. When the most preferred codecs both ends support
+    differ, JSON is selected, which every peer understands. """
+
+    ours = [name for name in settings.CODECS if name in names and name in CODECS]
+    theirs = [name for name in names if name in settings.CODECS and name in CODECS]
+
+    if ours and ours[0] == theirs[0]:
+        return CODECS[ours[0]]
+
+    return JSON_CODEC
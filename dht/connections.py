@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import random
+import time
+
+from dht import settings
+
+
+class ConnectionBackoffException(Exception):
+    pass
+
+
+class ConnectionLimitException(Exception):
+    pass
+
+
+class ConnectionManager:
+    """ Manages the connections to other nodes. Nodes are dialed concurrently, with
+    at most max_dials at the same time. A node that can't be reached isn't dialed
+    again until its backoff has passed, and connections without activity are
+    closed to stay below max_connections. """
+
+    def __init__(self, connect, max_connections=None, max_dials=None, idle_timeout=None,
+                 node_failed=None):
+        """ connect is a coroutine function that connects to a Node and returns the
+        protocol of the connection. node_failed is called with a Node that couldn't
+        be reached. """
+        self.connect = connect
+        self.node_failed = node_failed
+
+        self.max_connections = max_connections or settings.MAX_CONNECTIONS
+        self.idle_timeout = idle_timeout or settings.CONNECTION_IDLE_TIMEOUT
+        self.dial_semaphore = asyncio.Semaphore(max_dials or settings.MAX_CONCURRENT_DIALS)
+
+        # The open connections, the dials in progress by node key and the backoff
+        # of the nodes that couldn't be reached by node key: (retry at, delay).
+        self.protocols = set()
+        self.dials = {}
+        self.backoff = {}
+
+    async def get_protocol(self, node):
+        """ Get the protocol of the connection to a node, dial it if there is none. """
+
+        if node.is_connected():
+            return node.protocol
+
+        if not self.can_dial(node):
+            raise ConnectionBackoffException('Not dialing {} during its backoff.'.format(node.key))
+
+        return await self.dial(node)
+
+    def can_dial(self, node) -> bool:
+        """ Check if the node isn't being dialed already or in its backoff. """
+
+        if node.key in self.dials:
+            return True
+
+        backoff = self.backoff.get(node.key)
+        return backoff is None or backoff[0] <= time.monotonic()
+
+    def dial(self, node) -> asyncio.Future:
+        """ Dial a node, a node that is being dialed already isn't dialed again. """
+
+        try:
+            return self.dials[node.key]
+        except KeyError:
+            pass
+
+        task = asyncio.ensure_future(self._dial(node))
+        task.add_done_callback(lambda _: self._dial_done(node, task))
+
+        self.dials[node.key] = task
+        return task
+
+    def dial_nodes(self, nodes) -> None:
+        """ Dial the nodes that aren't in their backoff, while there is room for more
+        connections. """
+
+        # Every dial is added to the dials at once, so the open connections only have
+        # to be counted once.
+        open_connections = len(self.get_open_protocols())
+
+        for node in nodes:
+            if open_connections + len(self.dials) >= self.max_connections:
+                break
+
+            if node.key not in self.dials and self.can_dial(node):
+                self.dial(node)
+
+    async def _dial(self, node):
+        async with self.dial_semaphore:
+            if not self.make_room(1):
+                raise ConnectionLimitException('All {:d} connections are busy.'.format(self.max_connections))
+
+            try:
+                protocol = await asyncio.wait_for(self.connect(node), settings.CONNECT_TIMEOUT)
+            except Exception:
+                # Any failure gets a backoff, also an invalid address of a contact.
+                self.add_backoff(node)
+                node.add_failure()
+
+                if self.node_failed is not None:
+                    self.node_failed(node)
+
+                raise
+
+        self.backoff.pop(node.key, None)
+        self.add_protocol(protocol)
+
+        return protocol
+
+    def _dial_done(self, node, task) -> None:
+        self.dials.pop(node.key, None)
+
+        # Retrieve the exception, dials in the background are never awaited.
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug("Could not connect to %s: %s", node.key, task.exception())
+
+    def add_backoff(self, node) -> None:
+        """ Double the backoff of a node that couldn't be reached. """
+
+        _, delay = self.backoff.get(node.key, (None, settings.CONNECT_BACKOFF / 2))
+        delay = min(delay * 2, settings.CONNECT_MAX_BACKOFF)
+
+        # Spread the retries of nodes that failed at the same time.
+        self.backoff[node.key] = (time.monotonic() + delay * random.uniform(0.5, 1.0), delay)
+
+    def add_protocol(self, protocol) -> None:
+        """ Add the protocol of an open connection, incoming or outgoing. """
+        self.protocols.add(protocol)
+        self.make_room(0)
+
+    def get_open_protocols(self) -> set:
+        """ Get the protocols of the open connections, forget the closed ones. """
+        self.protocols = {
+            protocol for protocol in self.protocols if not protocol.transport.is_closing()}
+        return self.protocols
+
+    def make_room(self, room) -> bool:
+        """ Close the least recently active connections without pending messages until
+        there is room for room more connections, return if there is. """
+
+        protocols = self.get_open_protocols()
+        excess = len(protocols) + room - self.max_connections
+
+        if excess <= 0:
+            return True
+
+        idle = sorted(
+            (protocol for protocol in protocols if not protocol.messages),
+            key=lambda protocol: protocol.last_activity)
+
+        for protocol in idle[:excess]:
+            logging.debug("Closing connection %s to make room", protocol.transport)
+            protocol.transport.close()
+            protocols.discard(protocol)
+
+        return len(protocols) + room <= self.max_connections
+
+    def close_idle(self) -> None:
+        """ Close the connections without activity for longer than the idle timeout. """
+
+        idle_since = time.monotonic() - self.idle_timeout
+
+        for protocol in list(self.get_open_protocols()):
+            if not protocol.messages and protocol.last_activity < idle_since:
+                logging.debug("Closing idle connection %s", protocol.transport)
+                protocol.transport.close()
+                self.protocols.discard(protocol)
@@ -0,0 +1,173 @@
+import array
+import heapq
+import ipaddress
+import time
+
+from dht import settings
+from dht.node import Node
+
+
+class ContactTable:
+    """ A table of contacts held in flat arrays instead of a Node per contact, for
+    very large amounts of contacts. Keys are held as raw bytes, addresses as
+    16 byte IPv6 (or IPv4 mapped) addresses. Nodes are only created on access.
+
+    The slots are indexed by the leading INDEX_BITS bits of their keys, so the
+    closest contacts of a key are found in the few groups of slots closest to it,
+    without going through all the contacts. """
+
+    ADDRESS_SIZE = 16
+    INDEX_BITS = 16
+
+    def __init__(self, key_size=None):
+        key_size = key_size or settings.KEY_SIZE
+
+        self.key_bytes = key_size // 8
+        self.free_bits = key_size - self.INDEX_BITS
+
+        self.keys = bytearray()
+        self.addresses = bytearray()
+        self.ports = array.array('H')
+        self.last_seen = array.array('d')
+
+        # The slot of every contact in the arrays by raw key, and the slots of the
+        # contacts by the leading bits of their keys.
+        self.slots = {}
+        self.groups = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return self.get_raw_key(key) in self.slots
+
+    def __iter__(self):
+        for slot in range(len(self.slots)):
+            yield self.get_node(slot)
+
+    def get_raw_key(self, key: str) -> bytes:
+        return int(key, 16).to_bytes(self.key_bytes, 'big')
+
+    def get_int_key(self, slot) -> int:
+        return int.from_bytes(self.keys[slot * self.key_bytes:(slot + 1) * self.key_bytes], 'big')
+
+    def get_group(self, raw_key: bytes) -> array.array:
+        """ Get the slots of the contacts sharing the leading bits of a key. """
+
+        prefix = int.from_bytes(raw_key, 'big') >> self.free_bits
+
+        try:
+            return self.groups[prefix]
+        except KeyError:
+            group = self.groups[prefix] = array.array('I')
+            return group
+
+    def add(self, key: str, address: str, port: int, last_seen=None) -> None:
+        """ Add a contact, or update it if its key is already in the table. """
+
+        raw_key = self.get_raw_key(key)
+        packed_address = ipaddress.ip_address(address)
+
+        if packed_address.version == 4:
+            packed_address = ipaddress.IPv6Address('::ffff:' + address)
+
+        if last_seen is None:
+            last_seen = time.monotonic()
+
+        slot = self.slots.get(raw_key)
+
+        if slot is None:
+            self.slots[raw_key] = len(self.ports)
+            self.get_group(raw_key).append(len(self.ports))
+            self.keys.extend(raw_key)
+            self.addresses.extend(packed_address.packed)
+            self.ports.append(int(port))
+            self.last_seen.append(last_seen)
+            return
+
+        self.addresses[slot * self.ADDRESS_SIZE:(slot + 1) * self.ADDRESS_SIZE] = packed_address.packed
+        self.ports[slot] = int(port)
+        self.last_seen[slot] = last_seen
+
+    def add_node(self, node) -> None:
+        self.add(node.key, node.address, node.port, node.last_seen)
+
+    def touch(self, key: str) -> None:
+        """ Mark a contact as seen now. """
+        self.last_seen[self.slots[self.get_raw_key(key)]] = time.monotonic()
+
+    def get(self, key: str) -> Node:
+        """ Get a contact as Node, raise a KeyError if it isn't in the table. """
+        return self.get_node(self.slots[self.get_raw_key(key)])
+
+    def remove(self, key: str) -> None:
+        """ Remove a contact, the last contact moves into its slot. """
+
+        raw_key = self.get_raw_key(key)
+        slot = self.slots.pop(raw_key)
+        last = len(self.ports) - 1
+
+        group = self.get_group(raw_key)
+        group.remove(slot)
+
+        if not group:
+            del self.groups[int.from_bytes(raw_key, 'big') >> self.free_bits]
+
+        if slot != last:
+            last_key = bytes(self.keys[last * self.key_bytes:])
+            last_group = self.get_group(last_key)
+            last_group[last_group.index(last)] = slot
+            self.keys[slot * self.key_bytes:(slot + 1) * self.key_bytes] = last_key
+            self.addresses[slot * self.ADDRESS_SIZE:(slot + 1) * self.ADDRESS_SIZE] = \
+                self.addresses[last * self.ADDRESS_SIZE:]
+            self.ports[slot] = self.ports[last]
+            self.last_seen[slot] = self.last_seen[last]
+            self.slots[last_key] = slot
+
+        del self.keys[last * self.key_bytes:]
+        del self.addresses[last * self.ADDRESS_SIZE:]
+        self.ports.pop()
+        self.last_seen.pop()
+
+    def find_nodes(self, key: str, count=None) -> list:
+        """ Get the count contacts closest to the key, ordered by XOR distance. The
+        groups are visited by the XOR distance of their leading bits to those of the
+        key, every group only holds contacts further away than the groups before it. """
+
+        int_key = int(key, 16)
+        prefix = int_key >> self.free_bits
+        count = min(count or settings.BUCKET_SIZE, len(self.slots))
+
+        # With few groups, sorting them is cheaper than trying every prefix.
+        if len(self.groups) * self.INDEX_BITS < 1 << self.INDEX_BITS:
+            prefixes = sorted(self.groups, key=lambda other: other ^ prefix)
+        else:
+            prefixes = (prefix ^ distance for distance in range(1 << self.INDEX_BITS))
+
+        closest = []
+
+        for other in prefixes:
+            if len(closest) >= count:
+                break
+
+            group = self.groups.get(other)
+
+            if group:
+                closest.extend(heapq.nsmallest(
+                    count - len(closest), group, key=lambda slot: self.get_int_key(slot) ^ int_key))
+
+        return [self.get_node(slot) for slot in closest]
+
+    def get_node(self, slot) -> Node:
+        """ Create a Node of the contact in slot. """
+
+        raw_key = self.keys[slot * self.key_bytes:(slot + 1) * self.key_bytes]
+        address = ipaddress.IPv6Address(
+            bytes(self.addresses[slot * self.ADDRESS_SIZE:(slot + 1) * self.ADDRESS_SIZE]))
+
+        mapped = address.ipv4_mapped
+
+        if mapped is not None:
+            address = mapped
+
+        return Node(raw_key.hex(), str(address), self.ports[slot], last_seen=self.last_seen[slot])
@@ -0,0 +1,177 @@
+import asyncio
+import collections
+import logging
+import time
+
+from dht import metrics, settings
+from dht.protocol import FRAME_HEADER, DHTProtocol, FrameReader
+from dht.ratelimit import create_peer_rate_limiter
+from dht.timers import TimerHeap
+
+
+class DatagramPeerTransport:
+    """ The transport of a single peer on a shared datagram endpoint. """
+
+    def __init__(self, endpoint, address):
+        self.endpoint = endpoint
+        self.address = address
+        self.closing = False
+
+    def write(self, data: bytes) -> None:
+        self.endpoint.transport.sendto(data, self.address)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.address
+
+        return self.endpoint.transport.get_extra_info(name, default)
+
+    def close(self) -> None:
+        self.endpoint.remove_peer(self.address)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+
+class DHTDatagramPeerProtocol(DHTProtocol):
+    """ The DHTProtocol with a single peer over a datagram endpoint. Every datagram
+    holds whole messages. Commands are sent again when no response is received in
+    time, because datagrams can get lost. """
+
+    def data_received(self, data):
+        super().data_received(data)
+
+        # A partial frame in a datagram will never be completed by the next one.
+        self.frame_reader.buffer.clear()
+
+    def get_max_message_size(self) -> int:
+        """ Every message has to fit in a single datagram. """
+        return settings.MAX_DATAGRAM_SIZE - FRAME_HEADER.size
+
+    def send_message(self, message):
+        super().send_message(message)
+
+        if message.id not in self.messages:
+            return
+
+        self.timers.call_later(settings.RETRANSMIT_INTERVAL, self.retransmit, message, 1)
+
+    def retransmit(self, message, attempt) -> None:
+        """ Send the message again if there is still no response. The message fails
+        when its deadline passes. """
+
+        if self.messages.get(message.id) is not message or attempt >= settings.RETRANSMIT_ATTEMPTS:
+            return
+
+        logging.debug("Retransmitting %s to %s", message.command, self.transport.address)
+
+        data = FrameReader.frame(message.get_bytes(self.codec))
+
+        if self.write(data):
+            metrics.BYTES_SENT.inc(len(data))
+
+        self.timers.call_later(settings.RETRANSMIT_INTERVAL, self.retransmit, message, attempt + 1)
+
+
+class DHTDatagramProtocol(asyncio.DatagramProtocol):
+    """ A datagram endpoint for all peers, the messages of every peer are handled
+    by its own DHTDatagramPeerProtocol. """
+
+    def __init__(self, self_key, bucket_tree, value_store, listen_port, inbound_limits=None):
+        self.self_key = self_key
+        self.routing = bucket_tree
+        self.value_store = value_store
+        self.listen_port = listen_port
+
+        self.transport = None
+        self.timers = TimerHeap()
+
+        # The protocol of every peer by address, the least recently active first.
+        self.peers = collections.OrderedDict()
+
+        # The rate of commands every address may send, shared by all its peers.
+        self.inbound_limits = (
+            inbound_limits if inbound_limits is not None else create_peer_rate_limiter())
+
+    def connection_made(self, transport):
+        logging.info("Datagram endpoint ready on %s", transport.get_extra_info('sockname'))
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.get_peer(address).data_received(data)
+
+    def error_received(self, exc):
+        logging.warning("Datagram error: %s", exc)
+
+    def pause_writing(self):
+        """ The endpoint is shared, so writing to every peer is paused. """
+
+        for peer in self.peers.values():
+            peer.pause_writing()
+
+    def resume_writing(self):
+        for peer in list(self.peers.values()):
+            peer.resume_writing()
+
+    def get_peer(self, address) -> DHTDatagramPeerProtocol:
+        """ Get the protocol of the peer at address, create it if it doesn't exist. """
+
+        # IPv6 addresses also hold the flow info and scope id.
+        address = tuple(address[:2])
+
+        try:
+            peer = self.peers[address]
+        except KeyError:
+            pass
+        else:
+            self.peers.move_to_end(address)
+            return peer
+
+        self.make_room()
+
+        peer = DHTDatagramPeerProtocol(
+            self.self_key, self.routing, self.value_store, self.listen_port, timers=self.timers,
+            inbound_limits=self.inbound_limits)
+        peer.transport = DatagramPeerTransport(self, address)
+
+        self.peers[address] = peer
+        return peer
+
+    def make_room(self) -> None:
+        """ Forget the least recently active peers without pending commands, until there
+        is room for another peer. """
+
+        excess = len(self.peers) + 1 - settings.MAX_DATAGRAM_PEERS
+
+        if excess <= 0:
+            return
+
+        idle = []
+
+        for address, peer in self.peers.items():
+            if len(idle) >= excess:
+                break
+
+            if not peer.messages:
+                idle.append(address)
+
+        for address in idle:
+            self.remove_peer(address)
+
+    def close_idle(self) -> None:
+        """ Forget the peers without activity for longer than the idle timeout. """
+
+        idle_since = time.monotonic() - settings.CONNECTION_IDLE_TIMEOUT
+
+        for address, peer in list(self.peers.items()):
+            if not peer.messages and peer.last_activity < idle_since:
+                self.remove_peer(address)
+
+    def remove_peer(self, address) -> None:
+        """ Forget the peer at address. """
+
+        peer = self.peers.pop(tuple(address[:2]), None)
+
+        if peer is not None:
+            peer.transport.closing = True
+            peer.connection_lost(None)
@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from dht import metrics, settings
+from dht.bucket import NodeNotFoundException
+from dht.node import Node
+
+
+class NodeLookup:
+    """ The iterative lookup of the nodes closest to a key. Up to alpha nodes are
+    queried in parallel, closest first, until the count closest nodes that are
+    known have all responded. """
+
+    command = 'find_node'
+
+    def __init__(self, key, bucket_tree, get_protocol,
+                 alpha=None, count=None, timeout=None):
+        """ get_protocol is a coroutine function that gives the protocol to query a
+        Node with. """
+        self.key = key
+        self.int_key = int(key, 16)
+        self.routing = bucket_tree
+        self.get_protocol = get_protocol
+
+        self.alpha = alpha or settings.LOOKUP_ALPHA
+        self.count = count or settings.BUCKET_SIZE
+        self.timeout = timeout or settings.LOOKUP_TIMEOUT
+
+        # All the nodes seen during the lookup, by key, and the amount of hops it
+        # took to learn about them.
+        self.nodes = {}
+        self.hops = {}
+
+        self.queried = set()
+        self.responded = set()
+        self.failed = set()
+
+        self.value = None
+        self.found = False
+
+    def distance(self, node) -> int:
+        return node.int_key ^ self.int_key
+
+    async def run(self) -> list:
+        """ Run the lookup, return the closest nodes that responded ordered by
+        distance. """
+
+        start = time.monotonic()
+        self.routing.mark_lookup(self.int_key)
+
+        for node in self.routing.find_nodes(self.key, self.count):
+            self.add_node(node, 1)
+
+        pending = {}
+
+        try:
+            while not self.found:
+                for node in self.get_nodes_to_query(self.alpha - len(pending)):
+                    self.queried.add(node.key)
+                    pending[asyncio.ensure_future(self.query(node))] = node
+
+                if not pending:
+                    break
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    self.handle_result(pending.pop(task), task)
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+        metrics.LOOKUP_DURATION.observe(time.monotonic() - start, labels=(self.command,))
+        metrics.LOOKUP_HOPS.observe(self.get_hops(), labels=(self.command,))
+
+        return self.get_closest_nodes(self.responded)
+
+    def get_nodes_to_query(self, amount) -> list:
+        """ Get the closest nodes not queried yet, as long as they are amongst the
+        count closest nodes that didn't fail. """
+
+        if amount <= 0:
+            return []
+
+        candidates = [node for node in self.nodes.values() if node.key not in self.failed]
+
+        closest = heapq.nsmallest(self.count, candidates, key=self.distance)
+        return [node for node in closest if node.key not in self.queried][:amount]
+
+    def get_closest_nodes(self, keys) -> list:
+        return heapq.nsmallest(self.count, (self.nodes[key] for key in keys), key=self.distance)
+
+    async def query(self, node):
+        protocol = await self.get_protocol(node)
+        return await asyncio.wait_for(getattr(protocol, self.command)(self.key), self.timeout)
+
+    def handle_result(self, node, task) -> None:
+        """ Handle the result of querying node. """
+
+        try:
+            data = task.result()
+        except Exception as e:
+            logging.debug("Lookup of %s failed at %s: %s", self.key, node.key, e)
+            self.failed.add(node.key)
+            return
+
+        self.responded.add(node.key)
+
+        if type(data) != list:
+            self.handle_value(node, data)
+            return
+
+        for node_data in data:
+            self.add_node(self.get_node(node_data), self.hops[node.key] + 1)
+
+    def handle_value(self, node, value) -> None:
+        """ Handle a response that is not a list of nodes. """
+        pass
+
+    def add_node(self, node, hops) -> None:
+        if node.key == self.routing.self_node.key or node.key in self.nodes:
+            return
+
+        self.nodes[node.key] = node
+        self.hops[node.key] = hops
+
+    def get_node(self, node_data) -> Node:
+        """ Get the Node of the data in a response, from the routing tree if it is in
+        there so its protocol can be reused. """
+        try:
+            return self.routing.find_node(node_data[0])
+        except NodeNotFoundException:
+            return Node(node_data[0], node_data[1], node_data[2])
+
+    def get_hops(self) -> int:
+        """ Get the amount of hops it took to reach the closest responding node. """
+        closest = self.get_closest_nodes(self.responded)
+        return self.hops[closest[0].key] if closest else 0
+
+
+class ValueLookup(NodeLookup):
+    """ The iterative lookup of a value, it stops as soon as a node returns the
+    value. """
+
+    command = 'find_value'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value_hops = 0
+
+    def handle_value(self, node, value) -> None:
+        self.value = value
+        self.value_hops = self.hops[node.key]
+        self.found = True
+
+    def get_hops(self) -> int:
+        return self.value_hops if self.found else super().get_hops()
@@ -1,50 +1,145 @@
 import argparse
 import asyncio
-import importlib
 import logging
 import random
-import settings
+import socket
 import string
 
-from collections import deque
-
+from dht import metrics, settings
+from dht.cache import TTLCache
+from dht.connections import ConnectionManager
+from dht.datagram import DHTDatagramProtocol
+from dht.lookup import NodeLookup, ValueLookup
 from dht.node import SelfNode
-from dht.protocol import DHTServerProtocol, DHTClientProtocol
+from dht.protocol import BusyException, DHTServerProtocol, DHTClientProtocol, split_batches
+from dht.ratelimit import create_peer_rate_limiter
+from dht.refresh import RefreshScheduler
 from dht.routing import BucketTree
-from dht.utils import hash_string
+from dht.snapshot import SnapshotException, read_snapshot, write_snapshot
+from dht.utils import HASH_FUNCTIONS, hash_string
+from dht.trace import TRACE_LOGGER
+from dht.value_stores import create_value_store
 
 
 class DHT:
 
-    def __init__(self, listen_port, initial_node=None):
-        self.initial_node = initial_node
+    def __init__(self, listen_port, initial_nodes=None, transport=settings.TRANSPORT):
+        """ initial_nodes are the (address, port) of the seeds to join the network
+        through. """
+        self.initial_nodes = list(initial_nodes or [])
         self.listen_port = listen_port
+        self.transport = transport
+        self.datagram_protocol = None
+
+        # The ping tasks by the key of the node they ping, the nodes are pinged
+        # because their Bucket is full.
+        self.pinging = {}
+
+        # The values put through us by key. We are their publisher, only we keep
+        # them from expiring.
+        self.published = {}
+
+        # The lookups in progress by command and key, concurrent lookups of the same
+        # key share them. Their recent results are cached.
+        self.lookups = {}
+        self.value_cache = TTLCache(settings.VALUE_CACHE_TTL, settings.CACHE_SIZE)
+        self.node_cache = TTLCache(settings.NODE_CACHE_TTL, settings.CACHE_SIZE)
 
         logging.info("Listening on {}".format(self.listen_port))
 
         self.value_store = self.create_value_store()
+
+        # The key and contacts of the snapshot of an earlier run, if there is one.
+        self.snapshot = self.load_snapshot()
+
         self.self_key = self.create_self_key()
         self.self_node = self.create_self_node()
-        self.bucket_tree = self.create_bucket_tree()
 
         self.loop = asyncio.get_event_loop()
+        self.bucket_tree = self.create_bucket_tree()
+        self.connections = self.create_connection_manager()
+
+        # The rate of commands every peer may send, over all its connections.
+        self.inbound_limits = create_peer_rate_limiter()
 
         self.create_server()
+        self.create_metrics()
+
+        self.tasks = []
+        self.start_tasks()
+
+    def create_metrics(self):
+        """ Let the metrics read their values from this DHT, and serve them if there
+        is a port to serve them on. """
+
+        metrics.ROUTING_NODES.collect = lambda: {
+            (str(index),): size for index, size in enumerate(self.bucket_tree.get_bucket_sizes())}
+        metrics.PENDING_MESSAGES.collect = lambda: {(): self.get_pending_messages()}
+        metrics.VALUE_STORE_VALUES.collect = lambda: {(): len(self.value_store)}
+        metrics.VALUE_STORE_BYTES.collect = lambda: {(): self.value_store.size}
 
-        if self.initial_node is not None:
-            self.connect_to_initial_node()
-            self.loop.create_task(self.refresh_nodes(key=self.self_key))
+        if settings.METRICS_PORT is not None:
+            self.loop.run_until_complete(
+                metrics.serve_metrics(settings.METRICS_HOST, settings.METRICS_PORT))
 
-        self.loop.create_task(self.connect_to_unconnected_nodes())
+    def get_pending_messages(self) -> int:
+        """ Get the amount of commands waiting for a response. """
+
+        if self.transport == 'udp':
+            protocols = self.datagram_protocol.peers.values()
+        else:
+            protocols = self.connections.get_open_protocols()
+
+        return sum(len(protocol.messages) for protocol in protocols)
+
+    def start_tasks(self):
+        """ Start the tasks that keep the BucketTree and the stored values up to date. """
+
+        if self.initial_nodes or self.snapshot is not None:
+            self.tasks.append(self.loop.create_task(self.join()))
+
+        if settings.SNAPSHOT_PATH is not None:
+            self.tasks.append(self.loop.create_task(self.write_snapshots()))
+
+        self.refresh_scheduler = RefreshScheduler(self.bucket_tree, self.lookup_node)
+        self.refresh_scheduler.start()
+
+        self.tasks.append(self.loop.create_task(self.connect_to_unconnected_nodes()))
+        self.tasks.append(self.loop.create_task(self.expire_values()))
+        self.tasks.append(self.loop.create_task(self.republish_values()))
 
     def create_value_store(self):
         """ Create a Store to store values in. """
-        module = importlib.import_module('value_stores.' + settings.VALUE_STORE)
-        value_store_class = getattr(module, 'MemoryStore')
-        return value_store_class()
+        return create_value_store(settings.VALUE_STORE)
+
+    def load_snapshot(self):
+        """ Load the snapshot at SNAPSHOT_PATH, return its key and contacts or None if
+        there is no usable snapshot. """
+
+        if settings.SNAPSHOT_PATH is None:
+            return None
+
+        try:
+            snapshot = read_snapshot(settings.SNAPSHOT_PATH)
+        except FileNotFoundError:
+            return None
+        except SnapshotException as e:
+            logging.warning("Ignoring the snapshot: {}".format(e))
+            return None
+
+        logging.info("Loaded a snapshot of {:d} contacts".format(len(snapshot[1])))
+
+        return snapshot
 
     def create_self_key(self):
-        """ Create a key with which we will identify ourselves. """
+        """ Create a key with which we will identify ourselves, or take the key of the
+        snapshot. """
+
+        if self.snapshot is not None:
+            key = self.snapshot[0]
+            logging.info("Our key is {}".format(key))
+            return key
+
         key = hash_string(
             ''.join([random.choice(string.ascii_letters) for _ in range(160)]))
 
@@ -58,90 +153,504 @@ class DHT:
         return self_node
 
     def create_bucket_tree(self):
-        """ Create the BucketTree to store Nodes. """
-        tree = BucketTree(self.self_node)
+        """ Create the BucketTree to store Nodes, with the contacts of the snapshot. The
+        contacts of the replacement caches come last, so they end up there again. """
+        tree = BucketTree(self.self_node, on_bucket_full=None, clock=self.loop.time)
+
+        if self.snapshot is not None:
+            for node in self.snapshot[1]:
+                tree.add_node(node)
+
+        tree.on_bucket_full = self.check_node
         return tree
 
+    def create_connection_manager(self):
+        """ Create the ConnectionManager to dial other nodes with. """
+        return ConnectionManager(self.connect_to_node, node_failed=self.bucket_tree.node_failed)
+
+    def create_protocol(self, protocol_class):
+        """ Create the protocol of a new connection. """
+        return protocol_class(
+            self.self_key, self.bucket_tree, self.value_store, self.listen_port,
+            connections=self.connections, inbound_limits=self.inbound_limits)
+
     def create_server(self):
         """ Create the server to listen for incoming connections. """
 
+        if self.transport == 'udp':
+            listen = self.loop.create_datagram_endpoint(
+                lambda: DHTDatagramProtocol(
+                    self.self_key, self.bucket_tree, self.value_store, self.listen_port,
+                    self.inbound_limits),
+                local_addr=('0.0.0.0', self.listen_port)
+            )
+
+            _, self.datagram_protocol = self.loop.run_until_complete(listen)
+            return
+
         listen = self.loop.create_server(
-            lambda: DHTServerProtocol(
-                self.self_key, self.bucket_tree, self.value_store, self.listen_port),
+            lambda: self.create_protocol(DHTServerProtocol),
             '0.0.0.0',
             self.listen_port
         )
 
         self.loop.run_until_complete(listen)
 
-    def connect_to_initial_node(self):
-        """ Connect to the initial node if one is known. """
+    async def identify_at(self, address, port):
+        """ Connect to a seed and identify ourselves, so it knows us. """
 
-        logging.info("Connecting to initial node: {}".format(self.initial_node))
+        if self.transport == 'udp':
+            # Responses are matched on the address they come from, so use the IP address.
+            addresses = await self.loop.getaddrinfo(
+                address, int(port), family=socket.AF_INET, type=socket.SOCK_DGRAM)
+
+            await self.datagram_protocol.get_peer(addresses[0][4]).identify()
+            return
 
         connect = self.loop.create_connection(
-            lambda: DHTClientProtocol(
-                self.self_key, self.bucket_tree, self.value_store, self.listen_port),
-            self.initial_node[0],
-            int(self.initial_node[1])
-        )
+            lambda: self.create_protocol(DHTClientProtocol), address, int(port))
 
-        self.loop.run_until_complete(connect)
+        _, protocol = await asyncio.wait_for(connect, settings.CONNECT_TIMEOUT)
+        await protocol.identified
 
-    async def refresh_nodes(self, key=None, wait=None):
+    async def identify_at_seeds(self) -> int:
+        """ Identify at all the seeds at the same time, until BOOTSTRAP_QUORUM of them
+        know us or BOOTSTRAP_TIMEOUT seconds have passed. Return the amount of seeds
+        that know us, the slower seeds are left to answer in the background. """
 
-        to_check = deque([key])
+        logging.info("Connecting to {:d} initial nodes".format(len(self.initial_nodes)))
 
-        while True:
+        pending = {
+            asyncio.ensure_future(self.identify_at(address, port)): (address, port)
+            for address, port in self.initial_nodes
+        }
 
-            if wait is None:
-                wait = 3
+        quorum = min(settings.BOOTSTRAP_QUORUM, len(pending))
+        deadline = self.loop.time() + settings.BOOTSTRAP_TIMEOUT
+        identified = 0
 
-            # TODO maximum wait in the settings
-            wait = min(wait * 2, 30)
+        while pending and identified < quorum:
+            done, _ = await asyncio.wait(
+                pending, timeout=max(deadline - self.loop.time(), 0),
+                return_when=asyncio.FIRST_COMPLETED)
 
-            logging.debug("refresh_node sleeping {:d} seconds".format(wait))
-            await asyncio.sleep(wait)
+            if not done:
+                break
 
-            try:
+            for future in done:
+                seed = pending.pop(future)
+
+                if future.exception() is None:
+                    identified += 1
+                else:
+                    logging.warning("Could not identify at initial node {}: {}".format(
+                        seed, future.exception()))
+
+        for future in pending:
+            future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        return identified
+
+    async def join(self):
+        """ Wait until a quorum of the seeds knows us, then look up our own key and a
+        key in the range of the furthest Buckets at the same time, to fill the
+        BucketTree. Without seeds the contacts of the snapshot are asked. When no seed
+        answers, they are tried again up to BOOTSTRAP_ATTEMPTS times, seeds that are
+        started at the same time may not listen yet. """
+
+        attempts = 0
 
-                while True:
-                    search_key = to_check.pop()
+        while self.initial_nodes and not await self.identify_at_seeds() and self.snapshot is None:
+            attempts += 1
 
-                    nodes = self.bucket_tree.find_nodes(search_key)
+            if attempts >= settings.BOOTSTRAP_ATTEMPTS:
+                logging.warning("Could not identify at any initial node")
+                return
 
-                    for node in nodes:
-                        if node == self.self_node or node.protocol is None:
-                            continue
+            await asyncio.sleep(settings.BOOTSTRAP_RETRY_INTERVAL)
 
-                        node.protocol.find_node(search_key)
+        keys = [self.self_key] + [
+            self.get_random_key(prefix_length) for prefix_length in range(settings.BOOTSTRAP_LOOKUPS)]
 
-            except IndexError:
+        await asyncio.gather(*[self.lookup_node(key) for key in keys], return_exceptions=True)
 
-                for bucket_node in self.bucket_tree.get_leaf_bucket_nodes(include_self=False):
-                    bucket_node_range = bucket_node.get_range()
-                    key = hex(random.randrange(bucket_node_range[0], bucket_node_range[1]))[2:]
-                    to_check.appendleft(key)
+    def get_random_key(self, prefix_length) -> str:
+        """ Get a random key that shares exactly prefix_length bits with our key. """
+
+        bit = self.bucket_tree.key_size - 1 - prefix_length
+        int_key = ((self.self_node.int_key ^ (1 << bit)) >> bit << bit) | random.randrange(1 << bit)
+
+        return '{:0{}x}'.format(int_key, self.bucket_tree.key_size // 4)
 
     async def connect_to_unconnected_nodes(self):
+        """ Connect to the nodes in the BucketTree without a connection, and close the
+        connections that are idle. """
 
         while True:
 
             await asyncio.sleep(1)
 
-            for node in self.bucket_tree.get_unconnected_nodes():
-                logging.debug(node)
-                connect = self.loop.create_connection(
-                    lambda: DHTClientProtocol(
-                        self.self_key, self.bucket_tree, self.value_store, self.listen_port),
-                    node.address,
-                    int(node.port)
-                )
+            nodes = self.bucket_tree.get_unconnected_nodes()
+
+            if self.transport == 'udp':
+                self.datagram_protocol.close_idle()
+
+                for node in nodes:
+                    await self.connect_to_node(node)
+
+                continue
 
-                _, protocol = await connect
+            self.connections.close_idle()
+            self.connections.dial_nodes(nodes)
+
+    async def connect_to_node(self, node):
+        """ Connect to a node and identify ourselves, return the protocol. """
+
+        if self.transport == 'udp':
+            # There is no connection to make, just let the node know about us.
+            protocol = self.datagram_protocol.get_peer((node.address, int(node.port)))
+
+            # Nothing waits on the identify, retrieve its exception.
+            identified = protocol.identify()
+            identified.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        else:
+            connect = self.loop.create_connection(
+                lambda: self.create_protocol(DHTClientProtocol),
+                node.address,
+                int(node.port)
+            )
+
+            _, protocol = await connect
+
+        node.protocol = protocol
+        protocol.node = node
+
+        return protocol
+
+    async def get_protocol(self, node):
+        """ Get the protocol to send messages to a node with, connect to the node if
+        there is no protocol yet. The connection of the Node in the BucketTree is
+        used when there is one. """
+
+        if node.key != self.self_key:
+            node = self.bucket_tree.get_known_node(node.key) or node
+
+        if self.transport == 'udp':
+            if node.is_connected():
+                return node.protocol
+
+            return await self.connect_to_node(node)
+
+        return await self.connections.get_protocol(node)
+
+    def check_node(self, node):
+        """ Ping the least recently seen node of a full Bucket in the background. """
+
+        if node.key in self.pinging:
+            return
+
+        task = self.loop.create_task(self.ping_node(node))
+        task.add_done_callback(lambda task: self.pinging.pop(node.key, None))
+
+        self.pinging[node.key] = task
+
+    async def ping_node(self, node):
+        """ Ping a node, replace it in the BucketTree from the replacement cache if it
+        doesn't respond. A node that answers it is busy is kept. """
+
+        try:
+            protocol = await self.get_protocol(node)
+            await protocol.ping()
+        except BusyException as e:
+            # A busy node is alive, it only sheds our commands for a while.
+            logging.info("Ping to {} is shed: {}".format(node.key, e))
+            self.bucket_tree.touch_node(node)
+        except Exception as e:
+            logging.info("Ping to {} failed: {}".format(node.key, e))
+            self.bucket_tree.replace_node(node)
+        else:
+            self.bucket_tree.touch_node(node)
+
+    async def share_lookup(self, command, key, lookup):
+        """ Run a lookup, or wait for the lookup of the same command and key that is
+        in progress already. lookup is a coroutine function taking the key. """
+
+        try:
+            future = self.lookups[(command, key)]
+        except KeyError:
+            future = asyncio.ensure_future(lookup(key))
+            future.add_done_callback(lambda _: self.lookups.pop((command, key), None))
+            self.lookups[(command, key)] = future
+
+        # A waiting caller that is cancelled doesn't cancel the lookup of the others.
+        return await asyncio.shield(future)
+
+    async def lookup_node(self, key, cached=True) -> list:
+        """ Find the nodes closest to the key in the network. A recent result is used if
+        cached, stores look the nodes up again since some of them may have left. """
+
+        if cached:
+            try:
+                return list(self.node_cache.get(key))
+            except KeyError:
+                pass
+
+        return list(await self.share_lookup('find_node', key, self.run_node_lookup))
+
+    async def run_node_lookup(self, key) -> list:
+        lookup = NodeLookup(key, self.bucket_tree, self.get_protocol)
+        nodes = await lookup.run()
+
+        if nodes:
+            self.node_cache.set(key, nodes)
+
+        return nodes
+
+    async def get(self, key):
+        """ Get the value of the key from the network, raise a KeyError if no node
+        has it. """
+
+        try:
+            return self.value_store.retrieve(key)
+        except KeyError:
+            pass
+
+        try:
+            return self.value_cache.get(key)
+        except KeyError:
+            pass
+
+        return await self.share_lookup('find_value', key, self.run_value_lookup)
+
+    async def run_value_lookup(self, key):
+        lookup = ValueLookup(key, self.bucket_tree, self.get_protocol)
+        await lookup.run()
+
+        if not lookup.found:
+            raise KeyError(key)
+
+        self.value_cache.set(key, lookup.value)
+        return lookup.value
+
+    async def put(self, value) -> str:
+        """ Store the value at the nodes closest to its key, and here if we are one of
+        them. Return the key. """
+
+        key = hash_string(value)
+        self.published[key] = value
+
+        nodes = await self.lookup_node(key, cached=False)
+
+        if self.is_closest(key, nodes):
+            self.value_store.store(value)
+
+        await self.wait_for_stores([self.store(node, value) for node in nodes])
+
+        return key
 
-                node.protocol = protocol
-                protocol.node = node
+    def is_closest(self, key, nodes) -> bool:
+        """ Check if we are one of the BUCKET_SIZE nodes closest to the key, nodes are
+        the closest other nodes ordered by distance. """
+
+        if len(nodes) < settings.BUCKET_SIZE:
+            return True
+
+        int_key = int(key, 16)
+        return self.self_node.int_key ^ int_key < nodes[-1].int_key ^ int_key
+
+    async def wait_for_stores(self, stores) -> None:
+        """ Run the stores at the same time for up to LOOKUP_TIMEOUT seconds. A store
+        that fails, because its node is gone or busy, doesn't fail the others. """
+
+        stores = [asyncio.ensure_future(store) for store in stores]
+
+        if not stores:
+            return
+
+        await asyncio.wait(stores, timeout=settings.LOOKUP_TIMEOUT)
+
+        for store in stores:
+            if not store.done():
+                store.cancel()
+            elif not store.cancelled() and store.exception() is not None:
+                logging.debug("Storing values failed: {}".format(store.exception()))
+
+    async def get_many(self, keys) -> dict:
+        """ Get the values of many keys from the network, by key. Keys no node has are
+        left out. The keys are asked for in batches at the closest node we know of
+        them, the keys that node doesn't have are looked up one by one. """
+
+        values = {}
+        groups = {}
+
+        for key in keys:
+            try:
+                values[key] = self.value_store.retrieve(key)
+                continue
+            except KeyError:
+                pass
+
+            for node in self.bucket_tree.find_nodes(key, 2):
+                if node.key != self.self_key:
+                    groups.setdefault(node.key, (node, []))[1].append(key)
+                    break
+
+        requests = [self.find_values(node, node_keys) for node, node_keys in groups.values()]
+
+        for result in await asyncio.gather(*requests, return_exceptions=True):
+            if isinstance(result, dict):
+                values.update(result)
+
+        missing = [key for key in keys if key not in values]
+        results = await asyncio.gather(*[self.get(key) for key in missing], return_exceptions=True)
+
+        for key, result in zip(missing, results):
+            if not isinstance(result, Exception):
+                values[key] = result
+
+        return values
+
+    async def put_many(self, values) -> list:
+        """ Store many values at the nodes closest to their keys, and here if we are one
+        of them. Return the keys. The values are sent in batches to every node. """
+
+        keys = [hash_string(value) for value in values]
+        self.published.update(zip(keys, values))
+
+        closest = await asyncio.gather(
+            *[self.lookup_node(key, cached=False) for key in keys], return_exceptions=True)
+
+        groups = {}
+
+        for key, value, nodes in zip(keys, values, closest):
+            if isinstance(nodes, Exception):
+                continue
+
+            if self.is_closest(key, nodes):
+                self.value_store.store(value)
+
+            for node in nodes:
+                groups.setdefault(node.key, (node, []))[1].append(value)
+
+        await self.wait_for_stores([
+            self.store_many(node, node_values) for node, node_values in groups.values()])
+
+        return keys
+
+    async def find_values(self, node, keys) -> dict:
+        """ Ask a node for the values of keys, in batches that fit in a message to the
+        node. The values of batches that fail are left out. """
+
+        protocol = await self.get_protocol(node)
+        batches = split_batches(keys, settings.BATCH_SIZE, protocol.get_max_message_size() // 2)
+        results = await asyncio.gather(
+            *[protocol.find_values(batch) for batch in batches], return_exceptions=True)
+
+        values = {}
+
+        for result in results:
+            if isinstance(result, dict):
+                values.update(result)
+
+        return values
+
+    async def store(self, node, value, ttl=None) -> None:
+        """ Store a value at a node, for ttl seconds if it is republished. """
+        protocol = await self.get_protocol(node)
+        return await protocol.store(value, ttl)
+
+    async def store_many(self, node, values) -> list:
+        """ Store values at a node, in batches that fit in a message to the node. """
+
+        protocol = await self.get_protocol(node)
+        batches = split_batches(values, settings.BATCH_SIZE, protocol.get_max_message_size() // 2)
+        results = await asyncio.gather(*[protocol.store_many(batch) for batch in batches])
+
+        return [key for result in results for key in result]
+
+    async def expire_values(self):
+        """ Remove the expired values from the value store. """
+
+        while True:
+            await asyncio.sleep(settings.EXPIRE_INTERVAL)
+
+            removed = self.value_store.expire()
+
+            if removed:
+                logging.info("Removed {:d} expired values".format(removed))
+
+    async def republish_values(self):
+        """ Store the stored values again at the nodes closest to them, so nodes that
+        joined since have them too. The values we published are stored for another
+        VALUE_TTL, the others only for the time they have left. """
+
+        while True:
+            await asyncio.sleep(settings.REPUBLISH_INTERVAL)
+
+            await self.republish_published()
+            await self.republish_stored()
+
+    async def republish_published(self):
+        """ Put the values we published again, for another VALUE_TTL. """
+
+        published = list(self.published.values())
+
+        logging.info("Publishing {:d} values again".format(len(published)))
+
+        for start in range(0, len(published), settings.REPUBLISH_BATCH_SIZE):
+            await self.put_many(published[start:start + settings.REPUBLISH_BATCH_SIZE])
+
+    async def republish_stored(self):
+        """ Store the values stored here, that others published, again for the time
+        they have left. """
+
+        # A value stored at us less than an interval ago is republished by the
+        # node that stored it, there is no need to do it as well.
+        fresh = self.value_store.clock() + settings.VALUE_TTL - settings.REPUBLISH_INTERVAL
+        keys = [
+            key for key in self.value_store.keys()
+            if key not in self.published and (self.value_store.get_expires(key) or 0) < fresh
+        ]
+
+        logging.info("Republishing {:d} values".format(len(keys)))
+
+        for start in range(0, len(keys), settings.REPUBLISH_BATCH_SIZE):
+            batch = keys[start:start + settings.REPUBLISH_BATCH_SIZE]
+            await asyncio.gather(
+                *[self.republish_value(key) for key in batch], return_exceptions=True)
+
+    async def republish_value(self, key):
+        """ Store a value again at the nodes closest to it, for the time it has left.
+        It keeps its expiry time here. """
+
+        try:
+            value = self.value_store.retrieve(key)
+            expires = self.value_store.get_expires(key)
+        except KeyError:
+            return
+
+        ttl = None if expires is None else expires - self.value_store.clock()
+
+        if ttl is not None and ttl <= 0:
+            return
+
+        nodes = await self.lookup_node(key, cached=False)
+        await self.wait_for_stores([self.store(node, value, ttl) for node in nodes])
+
+    async def write_snapshots(self):
+        """ Write a snapshot of our key and the BucketTree every SNAPSHOT_INTERVAL
+        seconds. """
+
+        while True:
+            await asyncio.sleep(settings.SNAPSHOT_INTERVAL)
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        try:
+            write_snapshot(settings.SNAPSHOT_PATH, self.bucket_tree)
+        except OSError as e:
+            logging.warning("Could not write the snapshot: {}".format(e))
 
     def run(self):
         """ Run the loop to start everything. """
@@ -151,16 +660,76 @@ class DHT:
         except KeyboardInterrupt:
             pass
 
+        if settings.SNAPSHOT_PATH is not None:
+            self.write_snapshot()
+
+        self.value_store.close()
         self.loop.close()
 
 
+def parse_address(text) -> tuple:
+    """ Parse an address like 1.2.3.4:5678 or [::1]:5678 to (address, port). """
+
+    address, _, port = text.strip().rpartition(':')
+    return address.strip('[]'), int(port)
+
+
+def read_seed_file(path) -> list:
+    """ Read the addresses of the seeds in a file, one on every line. Empty lines and
+    lines starting with # are skipped. """
+
+    with open(path) as seed_file:
+        return [
+            parse_address(line) for line in seed_file
+            if line.strip() and not line.strip().startswith('#')
+        ]
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='A python DHT')
     parser.add_argument(
-        '--initial-node', '-n', help='The initial node to connect to (1.2.3.4:5678).')
+        '--initial-node', '-n', action='append',
+        help='An initial node to connect to (1.2.3.4:5678), can be given more than once.')
+    parser.add_argument(
+        '--seed-file', help='A file with an initial node to connect to on every line.')
     parser.add_argument(
         '--listen-port', '-p', default=9999, help='The port to listen on.')
+    parser.add_argument(
+        '--transport', '-t', default=settings.TRANSPORT, choices=['tcp', 'udp'],
+        help='The transport to send messages with.')
+
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='The amount of DHT processes to run, on the listen port and the ports after it.')
+
+    parser.add_argument(
+        '--key-size', type=int, default=settings.KEY_SIZE, choices=sorted(HASH_FUNCTIONS),
+        help='The size of the keys in bits, the same for every node of the network.')
+
+    parser.add_argument(
+        '--codecs', nargs='+', default=settings.CODECS, choices=['json', 'binary'],
+        help='The wire codecs to use, the most preferred first.')
+
+    parser.add_argument(
+        '--value-store', default=settings.VALUE_STORE, choices=['memory', 'disk'],
+        help='Where to store values.')
+    parser.add_argument(
+        '--value-store-path', default=settings.VALUE_STORE_PATH,
+        help='The directory of the disk value store.')
+
+    parser.add_argument(
+        '--snapshot', default=settings.SNAPSHOT_PATH,
+        help='The file to keep our key and contacts in between runs.')
+
+    parser.add_argument(
+        '--metrics-port', type=int, default=settings.METRICS_PORT,
+        help='The port to serve the metrics on for Prometheus, at /metrics.')
+
+    parser.add_argument(
+        '--trace-sample-rate', type=float, default=settings.TRACE_SAMPLE_RATE,
+        help='The part of the requests to trace, from 0 to 1.')
+    parser.add_argument('--trace-file', help='The file to write the traced requests to.')
 
     parser.add_argument('-v', action='store_true', dest='verbose_info', help='Verbose')
     parser.add_argument('-vv', action='store_true', dest='verbose_debug', help='More verbose')
@@ -175,10 +744,28 @@ if __name__ == "__main__":
         logging.basicConfig(level=logging.INFO)
         logging.info('Setting logging level to info')
 
-    if args.initial_node is not None:
-        initial_node = tuple(args.initial_node.split(":"))
-    else:
-        initial_node = None
+    settings.KEY_SIZE = args.key_size
+    settings.CODECS = args.codecs
+    settings.VALUE_STORE = args.value_store
+    settings.VALUE_STORE_PATH = args.value_store_path
+    settings.SNAPSHOT_PATH = args.snapshot
+    settings.METRICS_PORT = args.metrics_port
+    settings.TRACE_SAMPLE_RATE = args.trace_sample_rate
 
-    dht = DHT(args.listen_port, initial_node)
-    dht.run()
+    if args.trace_file is not None:
+        TRACE_LOGGER.addHandler(logging.FileHandler(args.trace_file))
+        TRACE_LOGGER.propagate = False
+
+    initial_nodes = [parse_address(address) for address in args.initial_node or []]
+
+    if args.seed_file is not None:
+        initial_nodes.extend(read_seed_file(args.seed_file))
+
+    if args.workers > 1:
+        from dht.workers import Supervisor
+
+        supervisor = Supervisor(args.workers, args.listen_port, initial_nodes, args.transport)
+        supervisor.run()
+    else:
+        dht = DHT(args.listen_port, initial_nodes, args.transport)
+        dht.run()
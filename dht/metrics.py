@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import logging
+import math
+
+
+class Metric:
+    """ A metric with a value for every combination of label values. """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+        # The values by a tuple of label values.
+        self.values = {}
+
+        # A function that gives the values at the time they are read, for values
+        # that are kept elsewhere.
+        self.collect = None
+
+    def get_values(self) -> dict:
+        return self.collect() if self.collect is not None else self.values
+
+    def get_lines(self) -> list:
+        """ Get the lines of this metric in the Prometheus text format. """
+
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+
+        for labels, value in sorted(self.get_values().items()):
+            lines.append('{}{} {}'.format(self.name, self.format_labels(labels), format_value(value)))
+
+        return lines
+
+    def format_labels(self, labels, extra=()) -> str:
+        pairs = list(zip(self.label_names, labels)) + list(extra)
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+class Counter(Metric):
+    """ A value that only goes up. """
+
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down. """
+
+    type = 'gauge'
+
+    def set(self, value, labels=()) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """ Counts the observed values per bucket, and keeps their sum and count. """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, label_names=()):
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, labels=()) -> None:
+        try:
+            counts = self.values[labels]
+        except KeyError:
+            # A count for every bucket and +Inf, then the sum.
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def get_lines(self) -> list:
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + [math.inf], counts):
+                cumulative += count
+                lines.append('{}_bucket{} {:d}'.format(
+                    self.name, self.format_labels(labels, [('le', format_value(bound))]), cumulative))
+
+            lines.append('{}_sum{} {}'.format(self.name, self.format_labels(labels), format_value(counts[-1])))
+            lines.append('{}_count{} {:d}'.format(self.name, self.format_labels(labels), cumulative))
+
+        return lines
+
+
+class Registry:
+    """ Holds metrics by name. """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=()) -> Counter:
+        return self.register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()) -> Gauge:
+        return self.register(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, buckets, label_names=()) -> Histogram:
+        return self.register(Histogram(name, help, buckets, label_names))
+
+    def get_text(self) -> str:
+        """ Get all the metrics in the Prometheus text format. """
+
+        lines = []
+
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].get_lines())
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+async def serve_metrics(host, port, registry=None):
+    """ Serve the metrics of the registry as text over HTTP at /metrics. """
+
+    registry = registry or REGISTRY
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+
+            # Skip the headers of the request.
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request_line.split()
+
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', registry.get_text().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+
+            writer.write(
+                'HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: {:d}\r\n\r\n'.format(status, len(body)).encode() + body)
+
+            await writer.drain()
+        except ConnectionError as e:
+            logging.debug("Metrics request failed: {}".format(e))
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info("Serving metrics on {}:{}".format(host, port))
+
+    return server
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+HOP_BUCKETS = [0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20]
+
+
+# The metrics of all the DHTs in this process.
+REGISTRY = Registry()
+
+RPCS_SENT = REGISTRY.counter(
+    'dht_rpcs_sent_total', 'The commands sent to other nodes.', ['command'])
+RPCS_RECEIVED = REGISTRY.counter(
+    'dht_rpcs_received_total', 'The commands received from other nodes.', ['command'])
+RPC_TIMEOUTS = REGISTRY.counter(
+    'dht_rpc_timeouts_total', 'The commands without a response in time.', ['command'])
+LATE_RESPONSES = REGISTRY.counter(
+    'dht_late_responses_total', 'The responses received after the deadline of their command.')
+RPCS_SHED = REGISTRY.counter(
+    'dht_rpcs_shed_total', 'The commands answered with a busy error.', ['command'])
+MESSAGES_DROPPED = REGISTRY.counter(
+    'dht_messages_dropped_total', 'The messages dropped because the outbound queue was full.')
+RPC_DURATION = REGISTRY.histogram(
+    'dht_rpc_duration_seconds', 'The time until the response on a command.', LATENCY_BUCKETS, ['command'])
+
+BYTES_SENT = REGISTRY.counter('dht_bytes_sent_total', 'The bytes sent to other nodes.')
+BYTES_RECEIVED = REGISTRY.counter('dht_bytes_received_total', 'The bytes received from other nodes.')
+
+LOOKUP_HOPS = REGISTRY.histogram(
+    'dht_lookup_hops', 'The hops to the closest node of a lookup.', HOP_BUCKETS, ['command'])
+LOOKUP_DURATION = REGISTRY.histogram(
+    'dht_lookup_duration_seconds', 'The time a lookup takes.', LATENCY_BUCKETS, ['command'])
+
+ROUTING_NODES = REGISTRY.gauge(
+    'dht_routing_nodes', 'The nodes in every Bucket, by the prefix length it shares with us.', ['bucket'])
+PENDING_MESSAGES = REGISTRY.gauge('dht_pending_messages', 'The commands waiting for a response.')
+VALUE_STORE_VALUES = REGISTRY.gauge('dht_value_store_values', 'The values in the value store.')
+VALUE_STORE_BYTES = REGISTRY.gauge('dht_value_store_bytes', 'The bytes of the values in the value store.')
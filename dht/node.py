@@ -1,36 +1,69 @@
-import datetime
-
-from dht.utils import hex_to_bin
+import time
 
 
 class Node:
     """ A node (peer) in the DHT. """
 
+    # There can be a lot of Nodes, don't give every one of them a __dict__.
+    __slots__ = (
+        'key', 'address', 'port', 'protocol', 'last_seen', 'failures', 'response_time', '_int_key',
+        'prefix_length')
+
     def __init__(self, key, address=None, port=None, protocol=None, last_seen=None):
         self.key = key
         self.address = address
         self.port = port
         self.protocol = protocol
 
-        # Set last_seen to now()
+        # Set last_seen to now, on the monotonic clock.
         if last_seen is None:
-            current_time = datetime.datetime.now()
-            last_seen = current_time.timestamp()
+            last_seen = time.monotonic()
 
         self.last_seen = last_seen
 
-    def get_bin_key(self):
-        """ Return the binary representation of the key. The key should always be a
-        hexadecimal. """
-        return hex_to_bin(self.key)
+        # The amount of commands in a row without a response, and the smoothed time
+        # in seconds it takes to respond.
+        self.failures = 0
+        self.response_time = None
+
+        self._int_key = None
+
+        # The amount of leading bits the key shares with our own key, set by the
+        # BucketTree the first time it needs it.
+        self.prefix_length = None
+
+    @property
+    def int_key(self) -> int:
+        """ The integer value of the key, calculated once. """
+        if self._int_key is None:
+            self._int_key = int(self.key, 16)
+
+        return self._int_key
+
+    def add_response_time(self, response_time) -> None:
+        """ Register a response on a command that took response_time seconds. """
+        self.failures = 0
+        self.last_seen = time.monotonic()
+
+        if self.response_time is None:
+            self.response_time = response_time
+        else:
+            self.response_time = 0.8 * self.response_time + 0.2 * response_time
+
+    def add_failure(self) -> None:
+        """ Register a command without a response. """
+        self.failures += 1
 
     def get_data(self):
         return self.key, self.address, self.port
 
     def is_connected(self) -> bool:
-        return self.protocol is not None or isinstance(self, SelfNode)
+        if isinstance(self, SelfNode):
+            return True
+
+        return self.protocol is not None and not self.protocol.transport.is_closing()
 
 
 class SelfNode(Node):
     """ SelfNode is the representation of the users' own node. """
-    pass
+    __slots__ = ()
@@ -1,10 +1,78 @@
 import asyncio
-import json
+import collections
 import logging
+import struct
+import time
 
 from typing import Union
 
+from dht import metrics, settings
+from dht.codecs import JSON_CODEC, get_codec, get_encoded_size, get_payload_codec, select_codec
 from dht.node import Node
+from dht.ratelimit import create_peer_rate_limiter
+from dht.settings import MAX_FRAME_SIZE
+from dht.timers import TimerHeap
+from dht.trace import should_trace, trace
+
+
+# Every message on the wire is prefixed with its length as an unsigned int.
+FRAME_HEADER = struct.Struct('>I')
+
+
+class FrameTooLargeException(Exception):
+    pass
+
+
+class RequestTimeoutException(Exception):
+    pass
+
+
+class KeySizeMismatchException(Exception):
+    pass
+
+
+class BusyException(Exception):
+    pass
+
+
+class CommandFailedException(Exception):
+    pass
+
+
+# Peers that don't send the size of their keys use keys of 512 bits.
+LEGACY_KEY_SIZE = 512
+
+# The response on a command that is shed because we are too busy to handle it.
+BUSY_RESPONSE = {"error": "busy"}
+
+# The responses on a command we don't know, and on a command we failed to handle.
+UNKNOWN_COMMAND_RESPONSE = {"error": "unknown_command"}
+INVALID_COMMAND_RESPONSE = {"error": "invalid_command"}
+
+
+def split_batches(items, max_count, max_size) -> list:
+    """ Split items into batches of at most max_count items and max_size encoded bytes.
+    An item larger than max_size gets a batch of its own. """
+
+    batches = []
+    batch = []
+    size = 0
+
+    for item in items:
+        item_size = get_encoded_size(item)
+
+        if batch and (len(batch) >= max_count or size + item_size > max_size):
+            batches.append(batch)
+            batch = []
+            size = 0
+
+        batch.append(item)
+        size += item_size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
 
 
 class Message:
@@ -19,20 +87,16 @@ class Message:
         if command:
             self.future = asyncio.Future()
 
-    def get_bytes(self) -> bytes:
-        """ Get the bytes of the message, include the command if it is defined. """
-        message = {
-            "id": self.id,
-            "data": self.data,
-        }
-
-        if self.command:
-            message["command"] = self.command
+        # The deadline of a sent command and the time it was sent.
+        self.timer = None
+        self.sent_at = None
 
-        message_json = json.dumps(message)
-        message_encoded = message_json.encode()
+        # If the steps of this request are traced.
+        self.traced = False
 
-        return message_encoded
+    def get_bytes(self, codec=JSON_CODEC) -> bytes:
+        """ Get the bytes of the message, include the command if it is defined. """
+        return codec.encode(self.id, self.command, self.data)
 
     @staticmethod
     def create(command: str, data: Union[str, dict]) -> 'Message':
@@ -43,14 +107,10 @@ class Message:
 
     @staticmethod
     def from_bytes(data: bytes) -> 'Message':
-        """ Create a Message from the given data. """
-        data = json.loads(data.decode())
-
-        if 'command' not in data:
-            data['command'] = None
-
-        message = Message(data['id'], data['data'], data['command'])
-        return message
+        """ Create a Message from the given data, bytes or a memoryview. The codec
+        is determined by the data itself. """
+        msg_id, command, data = get_payload_codec(data).decode(data)
+        return Message(msg_id, data, command)
 
     @staticmethod
     def create_response(message: 'Message', data: Union[str, dict]) -> 'Message':
@@ -60,35 +120,235 @@ class Message:
         return message
 
 
+class FrameReader:
+    """ Reassembles length prefixed frames from a stream of bytes. A read can
+    hold any amount of frames, including the parts of a frame. """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    @staticmethod
+    def frame(payload: bytes) -> bytes:
+        """ Prefix the payload with its length. """
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+    def feed(self, data: bytes, callback) -> None:
+        """ Add the data to the stream and call callback with a memoryview of every
+        complete frame. The memoryview is only valid during the callback. """
+
+        # Only copy into the buffer when there is a partial frame left from an
+        # earlier read, otherwise the frames are sliced from the data itself.
+        if self.buffer:
+            self.buffer.extend(data)
+            data = self.buffer
+
+        view = memoryview(data)
+        offset = 0
+
+        try:
+            while len(view) - offset >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(view, offset)
+
+                if length > self.max_frame_size:
+                    raise FrameTooLargeException(
+                        'Frame of {:d} bytes exceeds {:d} bytes.'.format(length, self.max_frame_size))
+
+                start = offset + FRAME_HEADER.size
+                end = start + length
+
+                if end > len(view):
+                    break
+
+                offset = end
+                callback(view[start:end])
+
+        finally:
+            if data is self.buffer:
+                view.release()
+
+                try:
+                    del self.buffer[:offset]
+                except BufferError:
+                    # A frame is still referenced, by the traceback of an error raised
+                    # in the callback, so the buffer can't be resized.
+                    self.buffer = self.buffer[offset:]
+            else:
+                self.buffer.extend(view[offset:])
+                view.release()
+
+
 class DHTProtocol(asyncio.Protocol):
 
-    def __init__(self, self_key, bucket_tree, value_store, listen_port):
+    # The amount of timed out commands to recognize a late response on.
+    MAX_TIMED_OUT = 64
+
+    def __init__(self, self_key, bucket_tree, value_store, listen_port,
+                 timers=None, connections=None, inbound_limits=None):
         self.self_key = self_key
         self.routing = bucket_tree
         self.value_store = value_store
         self.listen_port = listen_port
 
+        # The ConnectionManager that keeps track of this connection, if any.
+        self.connections = connections
+
         self.transport = None
         self.node = None
 
+        # The sent commands waiting for a response, by message id. The deadlines of
+        # the commands share a single TimerHeap.
+        self.messages = {}
+        self.timers = timers if timers is not None else TimerHeap()
+
+        # The send times of the last commands that timed out by message id. A late
+        # response on one of them still shows the Node is alive.
+        self.timed_out = collections.OrderedDict()
+        self.frame_reader = FrameReader()
+
+        # The codec used to send messages, negotiated during identify. Received
+        # messages are decoded with the codec they were encoded with.
+        self.codec = JSON_CODEC
+
+        # The last time a message was sent or received.
+        self.last_activity = time.monotonic()
+
+        # Writing is paused while the write buffer of the transport is above its
+        # high watermark, the messages written meanwhile are queued.
+        self.writing_paused = False
+        self.outbound = collections.deque()
+        self.outbound_size = 0
+
+        # The commands every peer may send, shared by all the connections with the
+        # same peer. Commands above its rate are shed.
+        self.inbound_limits = (
+            inbound_limits if inbound_limits is not None else create_peer_rate_limiter())
+
+    def connection_made(self, transport):
+        logging.info("Connection made with %s", transport)
+        self.transport = transport
+        self.transport.set_write_buffer_limits(settings.WRITE_BUFFER_HIGH, settings.WRITE_BUFFER_LOW)
+
+        if self.connections is not None:
+            self.connections.add_protocol(self)
+
+    def connection_lost(self, exc):
+        """ Forget the connection at the Node and fail the commands without a response. """
+
+        logging.info("Connection lost with %s", self.transport)
+
+        if self.node is not None and self.node.protocol is self:
+            self.node.protocol = None
+
+        self.outbound.clear()
+        self.outbound_size = 0
+
+        messages = list(self.messages.values())
         self.messages = {}
 
+        for message in messages:
+            message.timer.cancel()
+
+            if not message.future.done():
+                message.future.set_exception(ConnectionError('Connection lost'))
+
+    def pause_writing(self):
+        logging.debug("Pausing writes to %s", self.get_peer())
+        self.writing_paused = True
+
+    def resume_writing(self):
+        """ Write the queued messages, until the write buffer is full again. """
+
+        logging.debug("Resuming writes to %s", self.get_peer())
+        self.writing_paused = False
+
+        while self.outbound and not self.writing_paused:
+            data = self.outbound.popleft()
+            self.outbound_size -= len(data)
+            self.transport.write(data)
+
+    def write(self, data: bytes) -> bool:
+        """ Write data to the other end, or queue it while writing is paused. Return
+        False if the data is dropped because the queue is full. """
+
+        if not self.writing_paused:
+            self.transport.write(data)
+            return True
+
+        if self.outbound_size + len(data) > settings.OUTBOUND_QUEUE_SIZE:
+            metrics.MESSAGES_DROPPED.inc()
+            return False
+
+        self.outbound.append(data)
+        self.outbound_size += len(data)
+        return True
+
+    def get_max_message_size(self) -> int:
+        """ Get the most bytes a single message to the other end can take. """
+        return settings.MAX_FRAME_SIZE
+
     def send_message(self, message):
         """ Send a message to the other end, only send the id, command and
-        data keys of the message. """
+        data keys of the message. Fail the message with a FrameTooLargeException if
+        it is too large to send, or a BusyException if the outbound queue is full. """
+
+        payload = message.get_bytes(self.codec)
+
+        if len(payload) > self.get_max_message_size():
+            message.future.set_exception(FrameTooLargeException(
+                'Message of {:d} bytes exceeds {:d} bytes.'.format(
+                    len(payload), self.get_max_message_size())))
+            return
 
         self.messages[message.id] = message
-        data = message.get_bytes()
-        logging.debug("Sending: {:s}".format(data.decode()))
-        self.transport.write(data)
+        self.last_activity = message.sent_at = time.monotonic()
+        message.timer = self.timers.call_later(
+            settings.REQUEST_TIMEOUT, self.request_timed_out, message)
+
+        data = FrameReader.frame(payload)
+        logging.debug("Sending %s: %s", message.command, message.data)
+
+        if not self.write(data):
+            del self.messages[message.id]
+            message.timer.cancel()
+            message.future.set_exception(
+                BusyException('The outbound queue to {} is full'.format(self.get_peer())))
+            return
+
+        metrics.RPCS_SENT.inc(labels=(message.command,))
+        metrics.BYTES_SENT.inc(len(data))
+
+        if should_trace():
+            message.traced = True
+            trace('send', id=message.id, command=message.command, peer=self.get_peer(), bytes=len(data))
 
     def data_received(self, data):
-        """Receive data from the other end, determine if it is a command or a
-        response and act accordingly. """
+        """ Receive data from the other end and handle every complete message in it. """
+
+        self.last_activity = time.monotonic()
+        metrics.BYTES_RECEIVED.inc(len(data))
+
+        # Anything received from a Node shows it is still alive.
+        if self.node is not None:
+            self.routing.touch_node(self.node)
+
+        try:
+            self.frame_reader.feed(data, self.frame_received)
+        except FrameTooLargeException as e:
+            logging.warning("Closing connection: %s", e)
+            self.transport.close()
+
+    def frame_received(self, frame):
+        """ Receive a single message, determine if it is a command or a response and
+        act accordingly. """
 
-        message = Message.from_bytes(data)
+        try:
+            message = Message.from_bytes(frame)
+        except Exception as e:
+            logging.warning("Dropping a message from %s that can't be decoded: %s", self.get_peer(), e)
+            return
 
-        logging.debug(data)
+        logging.debug("Received %s: %s", message.command, message.data)
 
         if message.command:
             self.command_received(message)
@@ -96,41 +356,97 @@ class DHTProtocol(asyncio.Protocol):
         else:
             self.response_received(message)
 
+    def accept_command(self) -> bool:
+        """ Check if the other end may send another command, by the rate of its address. """
+
+        if self.inbound_limits is None:
+            return True
+
+        peer = self.get_peer()
+        return self.inbound_limits.consume(peer[0] if peer else None)
+
     def command_received(self, message):
         """ Receive a command, call the right handle and write the response. """
 
-        logging.info("Message received with command: {}".format(message.command))
+        logging.info("Message received with command: %s", message.command)
+        metrics.RPCS_RECEIVED.inc(labels=(message.command,))
+
+        traced = should_trace()
+        received_at = time.monotonic() if traced else None
+        command_name = message.command
 
         commands = {
             "identify": self.handle_identify,
             "find_node": self.handle_find_node,
             "find_value": self.handle_find_value,
             "store": self.handle_store,
+            "ping": self.handle_ping,
+            "find_values": self.handle_find_values,
+            "store_many": self.handle_store_many,
         }
 
-        # Get the appropriate command.
-        command = commands[message.command]
-
-        # Call the command to get the response.
-        response = command(message.data)
+        if self.writing_paused or not self.accept_command():
+            # Shed the command instead of letting the work and the responses pile up.
+            metrics.RPCS_SHED.inc(labels=(message.command,))
+            response = BUSY_RESPONSE
+        elif message.command not in commands:
+            logging.warning("Unknown command from %s: %s", self.get_peer(), message.command)
+            response = UNKNOWN_COMMAND_RESPONSE
+        else:
+            try:
+                response = commands[message.command](message.data)
+            except Exception:
+                logging.exception("Failed to handle %s from %s", message.command, self.get_peer())
+                response = INVALID_COMMAND_RESPONSE
 
-        logging.info("Sending response on command: {}".format(message.command))
+        logging.info("Sending response on command: %s", message.command)
 
         # Create a response message with the data from the command.
         message = Message.create_response(message, response)
-        data = message.get_bytes()
+        data = FrameReader.frame(message.get_bytes(self.codec))
+
+        logging.debug("Sending response: %s", message.data)
 
-        logging.debug("Sending response: {:s}".format(data.decode()))
+        if not self.write(data):
+            return
+
+        metrics.BYTES_SENT.inc(len(data))
 
-        self.transport.write(data)
+        if traced:
+            trace(
+                'command', id=message.id, command=command_name,
+                peer=self.get_peer(), duration=time.monotonic() - received_at, bytes=len(data))
 
     def response_received(self, message):
         """ Receive a response, set the result of the Future. """
 
-        orig_message = self.messages[message.id]
-        orig_message.future.set_result(message.data)
+        try:
+            orig_message = self.messages[message.id]
+        except KeyError:
+            sent_at = self.timed_out.pop(message.id, None)
+
+            if sent_at is not None:
+                self.late_response_received(sent_at)
+            else:
+                # A response on a message that was sent more than once.
+                logging.debug("Ignoring response on unknown message %s", message.id)
+
+            return
+
+        orig_message.timer.cancel()
+
+        response_time = time.monotonic() - orig_message.sent_at
+        metrics.RPC_DURATION.observe(response_time, labels=(orig_message.command,))
+
+        if self.node is not None:
+            self.node.add_response_time(response_time)
+
+        if orig_message.traced:
+            trace(
+                'response', id=message.id, command=orig_message.command, peer=self.get_peer(),
+                duration=response_time)
 
-        logging.info("Response received on command: {}".format(orig_message.command))
+        logging.info("Response received on command: %s", orig_message.command)
 
         response_handlers = {
             "identify": self.handle_identify_response,
@@ -138,19 +454,84 @@ class DHTProtocol(asyncio.Protocol):
             "find_value": self.handle_find_response,
         }
 
-        if orig_message.command in response_handlers:
-            response_handlers[orig_message.command](message.data)
+        try:
+            if message.data == BUSY_RESPONSE:
+                raise BusyException('{} is too busy for {}'.format(self.get_peer(), orig_message.command))
+
+            if message.data in (UNKNOWN_COMMAND_RESPONSE, INVALID_COMMAND_RESPONSE):
+                raise CommandFailedException('{} failed {}: {}'.format(
+                    self.get_peer(), orig_message.command, message.data["error"]))
+
+            if orig_message.command in response_handlers:
+                response_handlers[orig_message.command](message.data)
+        except (BusyException, KeySizeMismatchException, CommandFailedException) as e:
+            logging.info("%s", e)
+
+            if not orig_message.future.done():
+                orig_message.future.set_exception(e)
+        except Exception as e:
+            logging.warning("Invalid response on %s from %s: %s", orig_message.command, self.get_peer(), e)
+
+            if not orig_message.future.done():
+                orig_message.future.set_exception(e)
+        else:
+            if not orig_message.future.done():
+                orig_message.future.set_result(message.data)
 
         del self.messages[message.id]
 
+    def late_response_received(self, sent_at) -> None:
+        """ Count a response after the deadline of its command as a slow response of
+        the Node, it isn't a failure anymore. """
+
+        logging.debug("Late response from %s", self.get_peer())
+        metrics.LATE_RESPONSES.inc()
+
+        if self.node is not None:
+            self.node.add_response_time(time.monotonic() - sent_at)
+
+    def request_timed_out(self, message) -> None:
+        """ Fail a command that didn't get a response before its deadline. """
+
+        if self.messages.get(message.id) is not message:
+            return
+
+        del self.messages[message.id]
+
+        self.timed_out[message.id] = message.sent_at
+
+        if len(self.timed_out) > self.MAX_TIMED_OUT:
+            self.timed_out.popitem(last=False)
+
+        logging.info("No response on command: %s", message.command)
+        metrics.RPC_TIMEOUTS.inc(labels=(message.command,))
+
+        if message.traced:
+            trace('timeout', id=message.id, command=message.command, peer=self.get_peer())
+
+        if self.node is not None:
+            self.node.add_failure()
+            self.routing.node_failed(self.node)
+
+        if not message.future.done():
+            message.future.set_exception(
+                RequestTimeoutException('No response on {:s}'.format(message.command)))
+
+    def get_peer(self):
+        """ Get the address of the other end. """
+        return self.transport.get_extra_info('peername')
+
     def identify(self):
         message = Message.create('identify', {
             "key": self.self_key,
             "request_key": self.node is None,
             "listen_port": self.listen_port,
+            "codecs": settings.CODECS,
+            "key_size": self.routing.key_size,
         })
 
         self.send_message(message)
+        return message.future
 
     def find_node(self, key):
         message = Message.create('find_node', key)
@@ -162,21 +543,58 @@ class DHTProtocol(asyncio.Protocol):
         self.send_message(message)
         return message.future
 
-    def store(self, value):
-        message = Message.create('store', value)
+    def store(self, value, ttl=None):
+        """ Store a value, a republished value is sent with the ttl it has left. """
+        message = Message.create('store', value if ttl is None else {"value": value, "ttl": ttl})
+        self.send_message(message)
+        return message.future
+
+    def find_values(self, keys):
+        message = Message.create('find_values', keys)
         self.send_message(message)
         return message.future
 
+    def store_many(self, values):
+        message = Message.create('store_many', values)
+        self.send_message(message)
+        return message.future
+
+    def ping(self):
+        message = Message.create('ping', None)
+        self.send_message(message)
+        return message.future
+
+    def attach_node(self, key, address, port) -> None:
+        """ Make this the protocol of the Node of the key. The Node the BucketTree
+        already has is used, so the tree knows when this connection closes. """
+
+        node = Node(key, address, port)
+        self.routing.add_node(node)
+
+        if key != self.self_key:
+            node = self.routing.get_known_node(key) or node
+
+        node.protocol = self
+        self.node = node
+
     def handle_identify(self, data):
+        # A node with keys of another size is of another network, don't add it.
+        if data.get("key_size", LEGACY_KEY_SIZE) != self.routing.key_size:
+            logging.warning("Refusing a node with keys of %s bits", data.get("key_size", LEGACY_KEY_SIZE))
+            return {"error": "key_size", "key_size": self.routing.key_size}
+
         socket = self.transport.get_extra_info('peername')
+        self.attach_node(data["key"], socket[0], data['listen_port'])
 
-        self.node = Node(data["key"], socket[0], data['listen_port'], self)
-        self.routing.add_node(self.node)
+        # Peers without a codecs list only understand JSON.
+        self.codec = select_codec(data.get("codecs", [JSON_CODEC.name]))
 
         if data["request_key"]:
             return {
                 "key": self.self_key,
                 "request_key": False,
+                "codec": self.codec.name,
+                "key_size": self.routing.key_size,
             }
 
         else:
@@ -184,25 +602,86 @@ class DHTProtocol(asyncio.Protocol):
 
     def handle_find_node(self, key):
         """ Give back the closest nodes to the given key. """
-        return [node.get_data() for node in self.routing.find_nodes(key)]
+        return self.get_closest_nodes(key)
 
     def handle_find_value(self, key):
         try:
             value = self.value_store.retrieve(key)
 
         except KeyError:
-            value = [node.get_data() for node in self.routing.find_nodes(key)]
+            value = self.get_closest_nodes(key)
 
         return value
 
+    def get_closest_nodes(self, key) -> list:
+        """ Get the data of the nodes closest to the key, leaving out the node that
+        asks and ourselves. Both are known to the node that asks, and we don't know
+        the address it reaches us at. """
+
+        excluded = {self.routing.self_node.key}
+
+        if self.node is not None:
+            excluded.add(self.node.key)
+
+        nodes = self.routing.find_nodes(key, settings.BUCKET_SIZE + len(excluded))
+        nodes = [node for node in nodes if node.key not in excluded]
+
+        return [node.get_data() for node in nodes[:settings.BUCKET_SIZE]]
+
     def handle_store(self, data):
-        self.value_store.store(data)
+        """ Store a value. A republished value comes with the ttl it has left, so it
+        doesn't outlive the original. """
+
+        if isinstance(data, dict):
+            self.value_store.store_remaining(data["value"], data["ttl"])
+        else:
+            self.value_store.store(data)
+
+    def handle_find_values(self, keys):
+        """ Give back the values of the keys that are stored here, by key. Keys that
+        aren't stored here, or don't fit in the response, are left out. """
+
+        values = {}
+        size = 0
+
+        for key in keys:
+            try:
+                value = self.value_store.retrieve(key)
+            except KeyError:
+                continue
+
+            size += get_encoded_size(key) + get_encoded_size(value)
+
+            if size > self.get_max_message_size() // 2:
+                break
+
+            values[key] = value
+
+        return values
+
+    def handle_store_many(self, values):
+        """ Store all the values, give back their keys. """
+        return [self.value_store.store(value) for value in values]
+
+    def handle_ping(self, data):
+        return True
 
     def handle_identify_response(self, data: dict) -> None:
         """ Handle the response on our identify() request, add the Node. """
+
+        # The other end already knew us and didn't send its key.
+        if not data:
+            return
+
+        if data.get("key_size", LEGACY_KEY_SIZE) != self.routing.key_size:
+            raise KeySizeMismatchException('{} uses keys of {} bits, we use {:d}'.format(
+                self.get_peer(), data.get("key_size", LEGACY_KEY_SIZE), self.routing.key_size))
+
         socket = self.transport.get_extra_info('peername')
-        self.node = Node(data["key"], socket[0], socket[1], self)
-        self.routing.add_node(self.node)
+        self.attach_node(data["key"], socket[0], socket[1])
+
+        if data.get("codec") in settings.CODECS:
+            self.codec = get_codec(data["codec"])
 
     def handle_find_response(self, data):
         """
@@ -215,20 +694,24 @@ class DHTProtocol(asyncio.Protocol):
             return
 
         for node in data:
+            # A contact without an address can't be reached, don't add it.
+            if node[1] is None or node[2] is None:
+                continue
+
             node = Node(node[0], node[1], node[2])
             self.routing.add_node(node)
 
 
 class DHTServerProtocol(DHTProtocol):
-
-    def connection_made(self, transport):
-        logging.info("Connection made with {}".format(transport))
-        self.transport = transport
+    pass
 
 
 class DHTClientProtocol(DHTProtocol):
 
     def connection_made(self, transport):
-        logging.info("Connection made with {}".format(transport))
-        self.transport = transport
-        self.identify()
+        super().connection_made(transport)
+
+        # Retrieve the exception of the identify, so it isn't reported as never
+        # retrieved when nothing waits on it.
+        self.identified = self.identify()
+        self.identified.add_done_callback(lambda future: future.cancelled() or future.exception())
@@ -0,0 +1,67 @@
+import collections
+import time
+
+from dht import settings
+
+
+class TokenBucket:
+    """ Allows rate events per second on average, with bursts of up to burst events.
+    Every event takes a token, tokens come back at rate per second. """
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.updated = self.clock()
+
+    def consume(self, amount=1) -> bool:
+        """ Take amount tokens if there are enough, return if there were. """
+
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+
+class PeerRateLimiter:
+    """ A TokenBucket for every peer by address, so a peer doesn't get a higher rate
+    by opening more connections. Only the MAX_PEERS peers seen last are kept. """
+
+    MAX_PEERS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.buckets = collections.OrderedDict()
+
+    def consume(self, peer, amount=1) -> bool:
+        """ Take amount tokens of the peer if there are enough, return if there were. """
+
+        try:
+            bucket = self.buckets[peer]
+            self.buckets.move_to_end(peer)
+        except KeyError:
+            bucket = self.buckets[peer] = TokenBucket(self.rate, self.burst)
+
+            if len(self.buckets) > self.MAX_PEERS:
+                self.buckets.popitem(last=False)
+
+        return bucket.consume(amount)
+
+
+def create_peer_rate_limiter():
+    """ Create the PeerRateLimiter of INBOUND_RATE, or None if there is no limit. """
+
+    if settings.INBOUND_RATE is None:
+        return None
+
+    return PeerRateLimiter(settings.INBOUND_RATE, settings.INBOUND_BURST)
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import random
+
+from dht import settings
+from dht.timers import TimerHeap
+
+
+class RefreshScheduler:
+    """ Refreshes the Buckets without a lookup in their range for interval seconds,
+    by looking up a random key in their range. Every Bucket has a timer for when it
+    becomes stale. A lookup before then moves the refresh to interval seconds after
+    that lookup. """
+
+    def __init__(self, bucket_tree, lookup, interval=None, jitter=None, timers=None):
+        """ lookup is a coroutine function that looks up a key in the network. """
+        self.routing = bucket_tree
+        self.lookup = lookup
+
+        self.interval = interval or settings.REFRESH_INTERVAL
+        self.jitter = settings.REFRESH_JITTER if jitter is None else jitter
+        self.timers = timers if timers is not None else TimerHeap()
+
+        # The timer of every leaf BucketNode.
+        self.scheduled = {}
+
+    def start(self) -> None:
+        self.routing.on_split = self.split
+
+        for bucket_node in self.routing.get_leaf_bucket_nodes(include_self=True):
+            self.schedule(bucket_node)
+
+    def stop(self) -> None:
+        self.routing.on_split = None
+
+        for timer in self.scheduled.values():
+            timer.cancel()
+
+        self.scheduled = {}
+
+    def split(self, bucket_node) -> None:
+        """ Schedule the new leaves of a BucketNode that is split, instead of the
+        BucketNode itself. """
+
+        timer = self.scheduled.pop(bucket_node, None)
+
+        if timer is not None:
+            timer.cancel()
+
+        self.schedule(bucket_node.left)
+        self.schedule(bucket_node.right)
+
+    def schedule(self, bucket_node) -> None:
+        """ Schedule the check of a BucketNode for when it becomes stale. Spread the
+        checks, so Buckets that became stale together aren't refreshed together. """
+
+        due = bucket_node.last_lookup + self.interval - self.routing.clock()
+        delay = max(due, 0) + random.uniform(0, self.interval * self.jitter)
+
+        self.scheduled[bucket_node] = self.timers.call_later(delay, self.check, bucket_node)
+
+    def check(self, bucket_node) -> None:
+        """ Refresh a BucketNode if there was no lookup in its range in time. """
+
+        del self.scheduled[bucket_node]
+
+        if self.routing.clock() - bucket_node.last_lookup >= self.interval:
+            self.refresh(bucket_node)
+
+        self.schedule(bucket_node)
+
+    def refresh(self, bucket_node) -> None:
+        """ Look up a random key in the range of a BucketNode. """
+
+        lower, upper = bucket_node.get_range()
+        key = '{:0{}x}'.format(random.randint(lower, upper), self.routing.key_size // 4)
+
+        logging.debug("Refreshing the Bucket at depth %d with key %s", bucket_node.depth, key)
+
+        bucket_node.last_lookup = self.routing.clock()
+
+        task = asyncio.ensure_future(self.lookup(key))
+        task.add_done_callback(self.refreshed)
+
+    @staticmethod
+    def refreshed(task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug("Refresh failed: %s", task.exception())
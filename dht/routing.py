@@ -1,35 +1,64 @@
+import heapq
 import logging
+import time
 
-from dht.bucket import Bucket, BucketHasSelfException, NodeAlreadyAddedException, BucketIsFullException
-from dht.settings import KEY_SIZE, BUCKET_SIZE
-from dht.utils import hex_to_bin
+from dht.bucket import (
+    Bucket, BucketHasSelfException, NodeAlreadyAddedException, BucketIsFullException,
+    NodeNotFoundException)
+from dht import settings
+from dht.settings import BUCKET_SIZE
 
 
 class BucketNode:
     """ A BucketNode is a node in a BucketTree which can hold a bucket as
     value. """
 
-    def __init__(self):
+    def __init__(self, key_size=None, last_lookup=0.0):
+        self.key_size = key_size or settings.KEY_SIZE
         self.parent = None
         self.left = None
         self.right = None
         self.bucket = Bucket()
-        self.route = ""
+
+        # The route is held as the integer value of its bits (prefix) and the
+        # amount of bits (depth), instead of as a string of '0's and '1's.
+        self.prefix = 0
+        self.depth = 0
+
+        # The last time a key in the range of this node was looked up, on the clock
+        # of its BucketTree.
+        self.last_lookup = last_lookup
+
+    @property
+    def route(self) -> str:
+        """ The route to this node as a string of bits, left is '1'. """
+        if self.depth == 0:
+            return ""
+
+        return bin(self.prefix)[2:].zfill(self.depth)
+
+    @route.setter
+    def route(self, route: str) -> None:
+        self.prefix = int(route, 2) if route else 0
+        self.depth = len(route)
 
     def split(self) -> tuple:
         """ Make this node a inner node and create two new leaf nodes, a right
         and left BucketNode """
 
-        # Create a left BucketNode.
-        left = BucketNode()
-        left.route = self.route + "1"
+        # Create a left BucketNode, no key in its range was looked up since the last
+        # lookup in the range of this node.
+        left = BucketNode(self.key_size, self.last_lookup)
+        left.prefix = (self.prefix << 1) | 1
+        left.depth = self.depth + 1
         left.parent = self
 
         self.left = left
 
         # Create a right BucketNode.
-        right = BucketNode()
-        right.route = self.route + "0"
+        right = BucketNode(self.key_size, self.last_lookup)
+        right.prefix = self.prefix << 1
+        right.depth = self.depth + 1
         right.parent = self
 
         self.right = right
@@ -40,105 +69,188 @@ class BucketNode:
 
     def get_range(self) -> tuple:
         """ Get the range of this node. """
-        return int(self.route.ljust(KEY_SIZE, '0'), 2), int(self.route.ljust(KEY_SIZE, '1'), 2)
+        free_bits = self.key_size - self.depth
+        lower = self.prefix << free_bits
+        return lower, lower | ((1 << free_bits) - 1)
 
 
 class BucketTree:
     """ The routing tree of Kademlia. This routing tree holds the (K-)Buckets. """
 
-    def __init__(self, self_node) -> None:
-        root = BucketNode()
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, self_node, on_bucket_full=None, key_size=None, on_split=None,
+                 clock=None) -> None:
+        """ on_bucket_full is called with the least recently seen Node of a full
+        Bucket when a new node can't be added to it, to check if it is still alive.
+        on_split is called with a BucketNode that is split, its children are the new
+        leaves. key_size is the width of the keys in bits, KEY_SIZE by default. clock
+        is the time of the lookups, use the time of the event loop the Buckets are
+        refreshed on. """
+        self.key_size = key_size or settings.KEY_SIZE
+
+        if clock is not None:
+            self.clock = clock
+
+        root = BucketNode(self.key_size, self.clock())
         left, right = root.split()
 
         self.root_bucket_node = root
         self.bucket_node_list = [root, left, right]
         self.self_node = self_node
+        self.self_int_key = self_node.int_key
+        self.on_bucket_full = on_bucket_full
+        self.on_split = on_split
+
+        # The tree only splits the BucketNode holding the SelfNode, so every
+        # other leaf holds the nodes sharing exactly `index` leading bits with
+        # the SelfNode. This makes it possible to find a leaf by the length of
+        # the shared prefix instead of walking the tree bit by bit.
+        if self._get_bit(self.self_int_key, 0):
+            self.self_bucket_node = left
+            self.prefix_bucket_nodes = [right]
+        else:
+            self.self_bucket_node = right
+            self.prefix_bucket_nodes = [left]
 
         self.add_node(self_node)
 
     def find_node(self, key) -> 'Node':
         """ Find a node in the BucketTree. Raises NodeNotFound if the node isn't in
         the BucketTree. """
-        logging.debug("Finding node {}".format(key))
-        bucket_node = self._find_bucket_node(hex_to_bin(key))
+        logging.debug("Finding node %s", key)
+        bucket_node = self._find_bucket_node(int(key, 16))
         node = bucket_node.bucket.find_node(key)
         return node
 
-    def find_nodes(self, key) -> list:
-        """ Find nodes in the BucketTree closest to the key. """
-        logging.debug("Finding nodes close to {}".format(key))
+    def get_known_node(self, key):
+        """ Get the Node of a key from its Bucket or the replacement cache of its
+        Bucket, None if the BucketTree doesn't know it. """
+        bucket = self._find_bucket_node(int(key, 16)).bucket
+        return bucket.nodes.get(key) or bucket.replacement_cache.get(key)
 
-        bucket_node = self._find_bucket_node(hex_to_bin(key))
+    def find_nodes(self, key, count=BUCKET_SIZE) -> list:
+        """ Find the count nodes in the BucketTree closest to the key, ordered by
+        XOR distance. """
+        logging.debug("Finding nodes close to %s", key)
 
+        int_key = int(key, 16)
         nodes = []
-        visited = []
-        current = bucket_node
-        to_visit = []
-
-        # Don't add the parent is this is the root.
-        if bucket_node.parent is not None:
-            to_visit.append(bucket_node.parent)
-
-        while len(nodes) < BUCKET_SIZE:
-            # Start a tree traversal to search for similar nodes.
-
-            if current.bucket is not None:
-                nodes.extend(current.bucket.nodes)
-                visited.append(current)
-            elif current.left not in visited:
-                to_visit.append(current.left)
-            elif current.right not in visited:
-                to_visit.append(current.right)
-
-            try:
-                # Get the next node to check from the queue.
-                current = to_visit.pop(0)
-            except IndexError:
-                if current.parent is None:
-                    # We visited the whole tree so just stop looking any further.
-                    break
-
-                # Go up one level in the tree.
-                current = current.parent
-                visited.append(current)
+
+        for bucket_nodes in self._get_bucket_node_groups(self._get_prefix_length(int_key)):
+            candidates = [node for bucket_node in bucket_nodes for node in bucket_node.bucket.nodes.values()]
+
+            # Every next group only holds nodes further away than the nodes found so far.
+            nodes.extend(heapq.nsmallest(
+                count - len(nodes), candidates, key=lambda node: node.int_key ^ int_key))
+
+            if len(nodes) >= count:
+                break
 
         return nodes
 
     def add_node(self, node) -> bool:
         """ Add a Node (peer) to the tree. """
 
-        logging.info("Adding node to tree: {:s}".format(node.key))
-
-        key = node.get_bin_key()
+        logging.info("Adding node to tree: %s", node.key)
 
-        bucket_node = self._find_bucket_node(key)
+        bucket_node = self._find_node_bucket_node(node)
 
         try:
-            bucket_node.bucket.add_node(node)
+            added = bucket_node.bucket.add_node(node)
         except BucketHasSelfException:
+            if bucket_node.depth >= self.key_size:
+                # The key equals our own key, there is nothing left to split.
+                return False
+
             # Split the Bucket(Node) and add the node again.
             self._split_bucket_node(bucket_node)
-            self.add_node(node)
+            return self.add_node(node)
         except (BucketIsFullException, NodeAlreadyAddedException):
             return False
 
-        logging.info("Added node to tree: {:s}".format(node.key))
+        if not added:
+            logging.info("Added node to replacement cache: %s", node.key)
+
+            if self.on_bucket_full is not None:
+                self.on_bucket_full(bucket_node.bucket.get_least_recently_seen())
+
+            return False
+
+        logging.info("Added node to tree: %s", node.key)
         return True
 
-    def _find_bucket_node(self, bin_key) -> BucketNode:
-        """ Find a BucketNode in the tree by the binary value of a key. """
-        bucket_node = self.root_bucket_node
-        i = 0
+    def mark_lookup(self, int_key) -> None:
+        """ Mark the Bucket of a key as looked up now, it doesn't need a refresh. """
+        self._find_bucket_node(int_key).last_lookup = self.clock()
 
-        while bucket_node.bucket is None and i < KEY_SIZE:
-            if bin_key[i] == '1':
-                bucket_node = bucket_node.left
-            else:
-                bucket_node = bucket_node.right
+    def touch_node(self, node) -> None:
+        """ Mark a Node in the tree as seen now, if it is in the tree. """
+        try:
+            self._find_node_bucket_node(node).bucket.touch(node.key)
+        except NodeNotFoundException:
+            pass
+
+    def replace_node(self, node) -> None:
+        """ Replace a Node that didn't respond by a Node of the replacement cache. """
+
+        try:
+            replacement = self._find_node_bucket_node(node).bucket.replace_node(node.key)
+        except NodeNotFoundException:
+            return
+
+        if replacement is not None:
+            logging.info("Replaced node %s by %s", node.key, replacement.key)
+
+    def node_failed(self, node) -> None:
+        """ Replace a Node that failed to respond too many times in a row. """
+
+        if node.failures >= self._find_node_bucket_node(node).bucket.stale_failures:
+            self.replace_node(node)
+
+    def _find_bucket_node(self, int_key) -> BucketNode:
+        """ Find a leaf BucketNode in the tree by the integer value of a key. """
+        return self._get_leaf_bucket_node(self._get_prefix_length(int_key))
+
+    def _find_node_bucket_node(self, node) -> BucketNode:
+        """ Find the leaf BucketNode of a Node, its prefix length is calculated once. """
+        if node.prefix_length is None:
+            node.prefix_length = self._get_prefix_length(node.int_key)
 
-            i += 1
+        return self._get_leaf_bucket_node(node.prefix_length)
 
-        return bucket_node
+    def _get_leaf_bucket_node(self, prefix_length) -> BucketNode:
+        """ Get the leaf BucketNode of the keys sharing prefix_length bits with the
+        SelfNode. """
+        if prefix_length < len(self.prefix_bucket_nodes):
+            return self.prefix_bucket_nodes[prefix_length]
+
+        return self.self_bucket_node
+
+    def _get_bucket_node_groups(self, prefix_length):
+        """ Yield groups of leaf BucketNodes ordered by their XOR distance to a key
+        sharing prefix_length bits with the SelfNode. Nodes in a group are always
+        closer to the key than the nodes in the groups after it. """
+        depth = len(self.prefix_bucket_nodes)
+
+        if prefix_length < depth:
+            # The nodes in the Bucket of the key share one more bit with the key
+            # than the nodes in the Buckets closer to the SelfNode.
+            yield [self.prefix_bucket_nodes[prefix_length]]
+            yield self.prefix_bucket_nodes[prefix_length + 1:] + [self.self_bucket_node]
+        else:
+            yield [self.self_bucket_node]
+
+        for index in range(min(prefix_length, depth) - 1, -1, -1):
+            yield [self.prefix_bucket_nodes[index]]
+
+    def _get_prefix_length(self, int_key) -> int:
+        """ Get the amount of leading bits the key shares with the SelfNode. """
+        return self.key_size - (int_key ^ self.self_int_key).bit_length()
+
+    def _get_bit(self, int_key, index) -> int:
+        """ Get the bit at index of a key, counting from the most significant bit. """
+        return (int_key >> (self.key_size - 1 - index)) & 1
 
     def _split_bucket_node(self, bucket_node) -> None:
         """ Split a BucketNode and its Bucket. """
@@ -151,8 +263,21 @@ class BucketTree:
         self.bucket_node_list.append(left)
         self.bucket_node_list.append(right)
 
+        # Only the BucketNode holding the SelfNode is split; the child on the
+        # other side of the SelfNode gets the next shared prefix length.
+        if self._get_bit(self.self_int_key, bucket_node.depth):
+            self.self_bucket_node = left
+            self.prefix_bucket_nodes.append(right)
+        else:
+            self.self_bucket_node = right
+            self.prefix_bucket_nodes.append(left)
+
+        # Before the nodes are added again, which can split one of the children.
+        if self.on_split is not None:
+            self.on_split(bucket_node)
+
         # Re-add all the nodes in Bucket that is now unreachable.
-        for node in bucket.nodes:
+        for node in bucket.nodes.values():
             self.add_node(node)
 
     def get_unconnected_nodes(self) -> list:
@@ -165,6 +290,14 @@ class BucketTree:
 
         return unconnected
 
+    def get_bucket_sizes(self) -> list:
+        """ Get the amount of nodes in every Bucket by the length of the prefix its
+        nodes share with the SelfNode, the Bucket of the SelfNode last. """
+        return [
+            len(bucket_node.bucket.nodes)
+            for bucket_node in self.prefix_bucket_nodes + [self.self_bucket_node]
+        ]
+
     def get_leaf_bucket_nodes(self, include_self=False) -> list:
         """ Get the leaf bucket nodes; those that actually hold nodes.  """
 
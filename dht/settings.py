@@ -1,7 +1,144 @@
 
 BUCKET_SIZE = 20
 BUCKET_REPLACEMENT_CACHE_SIZE = 10
+
+# The size of the keys in bits, 160, 256 or 512. Keys are the SHA-1, SHA-256 or
+# SHA-512 hash of their value. All the nodes of a network use the same size, nodes
+# with another size are refused when they identify.
 KEY_SIZE = 512
 
+# A node that failed to respond BUCKET_STALE_FAILURES times in a row is stale, it
+# is replaced as soon as there is a node in the replacement cache to replace it.
+BUCKET_STALE_FAILURES = 5
+
+# The maximum size in bytes of a single message on the wire, and of a message in
+# a UDP datagram, which holds at most 65507 bytes.
+MAX_FRAME_SIZE = 1024 * 1024
+MAX_DATAGRAM_SIZE = 60 * 1024
+
+# The wire codecs we support, the most preferred first. The binary codec makes
+# messages smaller but takes more CPU to encode and decode than JSON. A codec is
+# only used with a peer when it is the most preferred codec of both, otherwise JSON.
+CODECS = ['json', 'binary']
+
+# The value store backend, 'memory', 'disk' or 'shared'. The disk store keeps its log
+# segments in VALUE_STORE_PATH and starts a new one at VALUE_STORE_SEGMENT_SIZE bytes.
 VALUE_STORE = 'memory'
+VALUE_STORE_PATH = 'values'
+VALUE_STORE_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# The 'shared' value store uses the store another process serves at
+# VALUE_STORE_ADDRESS, the workers share the store of their supervisor this way.
+VALUE_STORE_ADDRESS = None
+
+# The workers keep an index of the keys in the shared value store, synced every
+# SHARED_STORE_SYNC_INTERVAL seconds from a log of the last SHARED_STORE_LOG_SIZE
+# keys that were stored or removed.
+SHARED_STORE_SYNC_INTERVAL = 1.0
+SHARED_STORE_LOG_SIZE = 100000
+
+# Stored values expire after VALUE_TTL seconds unless they are stored again,
+# expired values are removed every EXPIRE_INTERVAL seconds. When a store holds
+# more values or bytes than its maximum, None for no maximum, the least recently
+# used values are evicted.
+VALUE_TTL = 24 * 60 * 60
+EXPIRE_INTERVAL = 60
+VALUE_STORE_MAX_VALUES = None
+VALUE_STORE_MAX_SIZE = None
+
+# Every REPUBLISH_INTERVAL seconds the stored values are stored again at the
+# nodes closest to them, REPUBLISH_BATCH_SIZE values at a time. They keep their
+# expiry time, only the values a node published itself get another VALUE_TTL.
+REPUBLISH_INTERVAL = 60 * 60
+REPUBLISH_BATCH_SIZE = 20
+
+# The transport to send messages with, 'tcp' or 'udp'.
+TRANSPORT = 'tcp'
+
+# The seconds to wait for the response on a command.
+REQUEST_TIMEOUT = 5.0
+
+# Over UDP a command is sent again every RETRANSMIT_INTERVAL seconds, until a
+# response is received or RETRANSMIT_ATTEMPTS attempts are made. Set the
+# interval well below the REQUEST_TIMEOUT.
+RETRANSMIT_INTERVAL = 1.0
+RETRANSMIT_ATTEMPTS = 3
+
+# Over UDP the state of at most MAX_DATAGRAM_PEERS peers is kept, peers without
+# activity for CONNECTION_IDLE_TIMEOUT seconds are forgotten.
+MAX_DATAGRAM_PEERS = 10000
+
+# At most MAX_CONNECTIONS connections are kept open, connections without
+# activity for CONNECTION_IDLE_TIMEOUT seconds are closed. At most
+# MAX_CONCURRENT_DIALS nodes are dialed at the same time, waiting CONNECT_TIMEOUT
+# seconds for each. A node that can't be reached isn't dialed again for
+# CONNECT_BACKOFF seconds, doubling every time up to CONNECT_MAX_BACKOFF seconds.
+MAX_CONNECTIONS = 1000
+CONNECTION_IDLE_TIMEOUT = 300
+MAX_CONCURRENT_DIALS = 16
+CONNECT_TIMEOUT = 5.0
+CONNECT_BACKOFF = 1.0
+CONNECT_MAX_BACKOFF = 300
+
+# Writing to a connection is paused when its write buffer holds more than
+# WRITE_BUFFER_HIGH bytes, and resumed when it holds less than WRITE_BUFFER_LOW
+# bytes. Meanwhile at most OUTBOUND_QUEUE_SIZE bytes of messages are queued, commands
+# beyond that fail at once and responses are dropped.
+WRITE_BUFFER_HIGH = 256 * 1024
+WRITE_BUFFER_LOW = 64 * 1024
+OUTBOUND_QUEUE_SIZE = 4 * 1024 * 1024
+
+# Every peer may send INBOUND_RATE commands per second, in bursts of up to
+# INBOUND_BURST commands, None for no limit. Commands above that, or while writing
+# to the peer is paused, are answered with a busy error.
+INBOUND_RATE = 500
+INBOUND_BURST = 1000
+
+# The amount of nodes queried in parallel during a lookup and the seconds to
+# wait for each of them.
+LOOKUP_ALPHA = 3
+LOOKUP_TIMEOUT = 5.0
+
+# A joining node identifies at all its seeds at the same time, and goes on as soon
+# as BOOTSTRAP_QUORUM of them know it, or after BOOTSTRAP_TIMEOUT seconds. It then
+# looks up its own key and a key in the range of each of its BOOTSTRAP_LOOKUPS
+# furthest Buckets at the same time.
+BOOTSTRAP_QUORUM = 3
+BOOTSTRAP_TIMEOUT = 10.0
+BOOTSTRAP_LOOKUPS = 4
+
+# When no seed answers, the seeds are tried again every BOOTSTRAP_RETRY_INTERVAL
+# seconds, BOOTSTRAP_ATTEMPTS times in all.
+BOOTSTRAP_ATTEMPTS = 5
+BOOTSTRAP_RETRY_INTERVAL = 2.0
+
+
+# Serve the metrics at http://METRICS_HOST:METRICS_PORT/metrics for Prometheus,
+# None to not serve them.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+
+# The part of the requests, from 0 to 1, that is traced to the 'dht.trace' logger
+# as a line of JSON for every step of the request.
+TRACE_SAMPLE_RATE = 0.0
+
+# The most keys or values sent in a single find_values or store_many command. A
+# batch also stays below half the maximum message size of the transport.
+BATCH_SIZE = 100
+
+# Values found in the network are cached for VALUE_CACHE_TTL seconds and the
+# closest nodes of a key for NODE_CACHE_TTL seconds, CACHE_SIZE of each at most.
+VALUE_CACHE_TTL = 60
+NODE_CACHE_TTL = 10
+CACHE_SIZE = 1000
+
+# A Bucket without a lookup in its range for REFRESH_INTERVAL seconds is refreshed
+# by a lookup of a random key in its range. Refreshes are spread over an extra
+# REFRESH_JITTER part of the interval.
+REFRESH_INTERVAL = 60 * 60
+REFRESH_JITTER = 0.1
 
+# Our key and the contacts of the BucketTree are written to SNAPSHOT_PATH every
+# SNAPSHOT_INTERVAL seconds and loaded at startup, None to not keep a snapshot.
+SNAPSHOT_PATH = None
+SNAPSHOT_INTERVAL = 60
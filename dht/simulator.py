@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import random
+import selectors
+
+from dht import settings
+from dht.lookup import NodeLookup
+from dht.main import DHT
+from dht.protocol import DHTClientProtocol, DHTProtocol, DHTServerProtocol
+from dht.utils import hash_string
+from dht.value_stores.memory import MemoryStore
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    """ A selector that doesn't wait for a timeout, it moves the time of its
+    VirtualTimeLoop ahead instead. """
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(timeout if timeout is None else 0)
+
+        if not events and timeout:
+            self.loop.now += timeout
+
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """ An event loop on virtual time. When no callback is ready the time moves on to
+    the next timer at once, so timeouts and latencies don't depend on how fast the
+    simulation runs. """
+
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(VirtualTimeSelector(self))
+
+    def time(self):
+        return self.now
+
+
+class MemoryTransport:
+    """ One end of a connection between two protocols in the same event loop. Writes
+    are delivered to the other end by the Network. """
+
+    def __init__(self, network, address, peername):
+        self.network = network
+        self.address = address
+        self.peername = peername
+        self.peer = None
+        self.protocol = None
+        self.closing = False
+
+        # The time the last write to this end is delivered, a connection never
+        # reorders its messages.
+        self.last_delivery = 0.0
+
+    def write(self, data: bytes) -> None:
+        if not self.closing:
+            self.network.deliver(self.peer, bytes(data))
+
+    def receive(self, data: bytes) -> None:
+        if not self.closing:
+            self.network.messages[self.address] += 1
+            self.protocol.data_received(data)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.peername
+
+        return default
+
+    def close(self) -> None:
+        """ Close both ends of the connection. """
+
+        for transport in (self, self.peer):
+            if not transport.closing:
+                transport.closing = True
+                self.network.loop.call_soon(transport.protocol.connection_lost, None)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def set_write_buffer_limits(self, high=None, low=None) -> None:
+        """ Writes are delivered at once, there is no write buffer. """
+        pass
+
+
+class Network:
+    """ An in-memory network of DHTs listening on their address and port. Every
+    message takes latency plus up to jitter seconds to arrive, and is lost with a
+    chance of loss. """
+
+    def __init__(self, loop=None, latency=0.0, jitter=0.0, loss=0.0, rand=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rand = rand or random.Random()
+
+        # The listening DHTs by (address, port), and the amount of messages
+        # received by every address.
+        self.servers = {}
+        self.messages = collections.Counter()
+
+    def add_server(self, dht) -> None:
+        self.servers[(dht.address, dht.listen_port)] = dht
+
+    def remove_server(self, dht) -> None:
+        self.servers.pop((dht.address, dht.listen_port), None)
+
+    def connect(self, dht, address, port, protocol_class=DHTClientProtocol) -> DHTProtocol:
+        """ Connect a DHT to the DHT listening on address and port, return the protocol
+        of the connecting end. """
+
+        try:
+            server = self.servers[(address, int(port))]
+        except KeyError:
+            raise ConnectionRefusedError('Nothing listens on {}:{}'.format(address, port))
+
+        client_transport = MemoryTransport(self, dht.address, (address, int(port)))
+        server_transport = MemoryTransport(self, address, (dht.address, 0))
+
+        client_transport.peer = server_transport
+        server_transport.peer = client_transport
+
+        client_transport.protocol = dht.create_protocol(protocol_class)
+        server_transport.protocol = server.create_protocol(DHTServerProtocol)
+
+        server_transport.protocol.connection_made(server_transport)
+        client_transport.protocol.connection_made(client_transport)
+
+        return client_transport.protocol
+
+    def deliver(self, transport, data: bytes) -> None:
+        """ Deliver data at a transport, after the latency of the network. """
+
+        if self.loss and self.rand.random() < self.loss:
+            return
+
+        delay = self.latency + (self.rand.uniform(0, self.jitter) if self.jitter else 0.0)
+
+        if not delay:
+            self.loop.call_soon(transport.receive, data)
+            return
+
+        when = max(self.loop.time() + delay, transport.last_delivery)
+        transport.last_delivery = when
+        self.loop.call_at(when, transport.receive, data)
+
+
+class SimulatedDHT(DHT):
+    """ A DHT on an in-memory Network. It doesn't start any background tasks, the
+    simulation drives it. """
+
+    def __init__(self, network, address, listen_port, initial_nodes=None):
+        self.network = network
+        self.address = address
+
+        super().__init__(listen_port, initial_nodes)
+
+    def create_value_store(self):
+        return MemoryStore()
+
+    def create_self_key(self):
+        """ Derive the key from the address, so simulations can be repeated. """
+        return hash_string('{}:{:d}'.format(self.address, self.listen_port))
+
+    def create_server(self):
+        self.network.add_server(self)
+
+    def create_metrics(self):
+        """ The metrics of the process are shared by all the DHTs in it. """
+        pass
+
+    def start_tasks(self):
+        pass
+
+    async def identify_at(self, address, port):
+        protocol = self.network.connect(self, address, port, protocol_class=DHTProtocol)
+        await protocol.identify()
+
+    def leave(self) -> None:
+        """ Stop listening, stop pinging and close all connections. """
+
+        self.network.remove_server(self)
+
+        for task in list(self.pinging.values()):
+            task.cancel()
+
+        for protocol in list(self.connections.get_open_protocols()):
+            protocol.transport.close()
+
+    async def connect_to_node(self, node):
+        protocol = self.network.connect(self, node.address, node.port)
+
+        node.protocol = protocol
+        protocol.node = node
+
+        return protocol
+
+
+class Simulation:
+    """ A simulated network of DHTs in a single event loop. Nodes join and leave,
+    and the lookups in the network are measured: their hops, if they found the
+    closest node and the messages they cost every node. """
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, seed=None, loop=None):
+        self.rand = random.Random(seed)
+
+        # The nodes pick the keys of their joins and their backoff delays with the
+        # random module, seed it too so a simulation can be repeated.
+        if seed is not None:
+            random.seed(seed)
+        self.network = Network(loop, latency, jitter, loss, self.rand)
+        self.loop = self.network.loop
+
+        # The DHTs in the network and the amount of DHTs ever created.
+        self.dhts = []
+        self.created = 0
+
+        self.hops = []
+        self.lookups = 0
+        self.successes = 0
+
+    def create_dht(self) -> SimulatedDHT:
+        """ Create a DHT that joins through a random DHT in the network. """
+
+        index = self.created
+        self.created += 1
+
+        address = '10.{:d}.{:d}.{:d}'.format(index >> 16 & 255, index >> 8 & 255, index & 255)
+        initial = self.rand.choice(self.dhts) if self.dhts else None
+        initial_nodes = [(initial.address, initial.listen_port)] if initial is not None else None
+
+        return SimulatedDHT(self.network, address, 9999, initial_nodes)
+
+    async def add_nodes(self, amount, batch_size=50) -> None:
+        """ Add amount DHTs to the network, batch_size of them join at the same time. """
+
+        if not self.dhts and amount > 0:
+            self.dhts.append(self.create_dht())
+            amount -= 1
+
+        while amount > 0:
+            batch = [self.create_dht() for _ in range(min(amount, batch_size))]
+            amount -= len(batch)
+
+            # A node is part of the network as soon as it listens, also when it
+            # couldn't join. Others can still find it later.
+            self.dhts.extend(batch)
+            await asyncio.gather(*[dht.join() for dht in batch], return_exceptions=True)
+
+    def remove_node(self, dht) -> None:
+        self.dhts.remove(dht)
+        dht.leave()
+
+    async def churn(self, rate, interval=1.0) -> None:
+        """ Replace a rate part of the nodes per second by new nodes, until cancelled. """
+
+        while True:
+            await asyncio.sleep(interval)
+
+            # Round the amount of nodes at random, so small rates still churn.
+            amount = rate * interval * len(self.dhts)
+            amount = int(amount) + (self.rand.random() < amount % 1)
+
+            for _ in range(min(amount, len(self.dhts) - 1)):
+                self.remove_node(self.rand.choice(self.dhts))
+
+            await self.add_nodes(amount)
+
+    async def lookup(self) -> None:
+        """ Look up a random key from a random node. """
+
+        dht = self.rand.choice(self.dhts)
+        key = hash_string(str(self.rand.random()))
+        int_key = int(key, 16)
+
+        lookup = NodeLookup(key, dht.bucket_tree, dht.get_protocol)
+        nodes = await lookup.run()
+
+        closest = min(
+            (other for other in self.dhts if other is not dht),
+            key=lambda other: other.self_node.int_key ^ int_key)
+
+        self.lookups += 1
+        self.hops.append(lookup.get_hops())
+
+        if nodes and nodes[0].key == closest.self_key:
+            self.successes += 1
+
+    async def run_lookups(self, count, concurrency=10) -> None:
+        """ Run count lookups, concurrency of them at the same time. """
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup():
+            async with semaphore:
+                await self.lookup()
+
+        await asyncio.gather(*[lookup() for _ in range(count)])
+
+    def reset(self) -> None:
+        """ Forget the measurements so far. """
+
+        self.network.messages.clear()
+        self.hops = []
+        self.lookups = 0
+        self.successes = 0
+
+    def get_results(self) -> dict:
+        """ Get the measurements since the last reset. """
+
+        hops = collections.Counter(self.hops)
+        messages = sorted(self.network.messages[dht.address] for dht in self.dhts)
+
+        return {
+            'nodes': len(self.dhts),
+            'lookups': self.lookups,
+            'success_rate': self.successes / self.lookups if self.lookups else 0.0,
+            'hops_mean': sum(self.hops) / len(self.hops) if self.hops else 0.0,
+            'hops': {str(amount): hops[amount] for amount in sorted(hops)},
+            'messages_per_node_mean': sum(messages) / len(messages) if messages else 0.0,
+            'messages_per_node_max': messages[-1] if messages else 0,
+        }
+
+    def run(self, nodes, lookups, churn=0.0, concurrency=10) -> dict:
+        """ Build a network of nodes and run lookups in it, while a churn part of the
+        nodes is replaced every second. Return the measurements of the lookups. """
+
+        self.loop.run_until_complete(self.add_nodes(nodes))
+        self.reset()
+
+        churn_task = self.loop.create_task(self.churn(churn)) if churn else None
+
+        try:
+            self.loop.run_until_complete(self.run_lookups(lookups, concurrency))
+        finally:
+            if churn_task is not None:
+                churn_task.cancel()
+
+        return self.get_results()
+
+
+def create_network(size, loop=None) -> list:
+    """ Create a Network of size DHTs and return them. """
+
+    simulation = Simulation(loop=loop)
+    simulation.loop.run_until_complete(simulation.add_nodes(size))
+
+    logging.info("Created a simulated network of {:d} nodes".format(size))
+
+    return simulation.dhts
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Simulate a network of DHTs in a single process.')
+    parser.add_argument('--nodes', type=int, default=1000, help='The amount of nodes.')
+    parser.add_argument('--lookups', type=int, default=1000, help='The amount of lookups.')
+    parser.add_argument(
+        '--concurrency', type=int, default=10, help='The amount of lookups at the same time.')
+    parser.add_argument(
+        '--latency', type=float, default=0.0, help='The seconds every message takes to arrive.')
+    parser.add_argument(
+        '--jitter', type=float, default=0.0, help='The extra seconds a message can take at most.')
+    parser.add_argument(
+        '--loss', type=float, default=0.0, help='The chance a message is lost, from 0 to 1.')
+    parser.add_argument(
+        '--churn', type=float, default=0.0,
+        help='The part of the nodes that is replaced by new nodes every second.')
+    parser.add_argument(
+        '--request-timeout', type=float, default=settings.REQUEST_TIMEOUT,
+        help='The seconds to wait for a response.')
+    parser.add_argument('--seed', type=int, default=None, help='The seed of the simulation.')
+    parser.add_argument(
+        '--virtual-time', action='store_true',
+        help='Run on virtual time, timers fire at once instead of after waiting.')
+
+    args = parser.parse_args()
+
+    settings.REQUEST_TIMEOUT = args.request_timeout
+    settings.LOOKUP_TIMEOUT = args.request_timeout
+
+    asyncio.set_event_loop(VirtualTimeLoop() if args.virtual_time else asyncio.new_event_loop())
+
+    simulation = Simulation(args.latency, args.jitter, args.loss, args.seed)
+    results = simulation.run(args.nodes, args.lookups, args.churn, args.concurrency)
+
+    print(json.dumps(results, sort_keys=True))
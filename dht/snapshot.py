@@ -0,0 +1,125 @@
+import ipaddress
+import logging
+import os
+import struct
+import zlib
+
+from dht import settings
+from dht.node import Node
+
+
+class SnapshotException(Exception):
+    pass
+
+
+# A snapshot is a header, our own key and every contact, followed by a checksum of
+# everything before it. The header holds a magic value, the version, the key size
+# in bits and the amount of contacts. A contact is its key, its IPv6 (or IPv4
+# mapped) address and its port. The nodes of the Buckets come first, least
+# recently seen first, then the nodes of the replacement caches.
+MAGIC = b'DHTS'
+VERSION = 1
+HEADER = struct.Struct('>4sBHI')
+PORT = struct.Struct('>H')
+CHECKSUM = struct.Struct('>I')
+ADDRESS_SIZE = 16
+
+
+def write_snapshot(path, bucket_tree) -> None:
+    """ Write the key of the SelfNode and the contacts of a BucketTree to path. The
+    snapshot replaces the old one at once, so a crash never leaves half of one. """
+
+    key_bytes = bucket_tree.key_size // 8
+    bucket_nodes = bucket_tree.get_leaf_bucket_nodes(include_self=True)
+
+    nodes = [node for bucket_node in bucket_nodes for node in bucket_node.bucket.nodes.values()]
+    nodes += [
+        node for bucket_node in bucket_nodes for node in bucket_node.bucket.replacement_cache.values()]
+
+    contacts = []
+
+    for node in nodes:
+        if node is bucket_tree.self_node:
+            continue
+
+        try:
+            address = ipaddress.ip_address(node.address)
+        except ValueError:
+            continue
+
+        if address.version == 4:
+            address = ipaddress.IPv6Address('::ffff:' + str(address))
+
+        contacts.append(
+            int(node.key, 16).to_bytes(key_bytes, 'big') + address.packed + PORT.pack(int(node.port)))
+
+    data = HEADER.pack(MAGIC, VERSION, bucket_tree.key_size, len(contacts))
+    data += int(bucket_tree.self_node.key, 16).to_bytes(key_bytes, 'big') + b''.join(contacts)
+    data += CHECKSUM.pack(zlib.crc32(data))
+
+    temporary_path = path + '.tmp'
+
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+    os.replace(temporary_path, path)
+
+    logging.debug("Wrote a snapshot of %d contacts to %s", len(contacts), path)
+
+
+def read_snapshot(path, key_size=None) -> tuple:
+    """ Read a snapshot, return the key of the SelfNode and the contacts as Nodes in
+    the order they should be added. Raise a SnapshotException if the snapshot is
+    damaged or of another key size than key_size, KEY_SIZE by default. """
+
+    key_size = key_size or settings.KEY_SIZE
+
+    with open(path, 'rb') as snapshot_file:
+        data = snapshot_file.read()
+
+    if len(data) < HEADER.size + CHECKSUM.size:
+        raise SnapshotException('Snapshot {} is cut short.'.format(path))
+
+    (checksum,) = CHECKSUM.unpack_from(data, len(data) - CHECKSUM.size)
+
+    if zlib.crc32(data[:-CHECKSUM.size]) != checksum:
+        raise SnapshotException('Snapshot {} is damaged.'.format(path))
+
+    magic, version, snapshot_key_size, count = HEADER.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotException('{} is not a snapshot of this version.'.format(path))
+
+    if key_size != snapshot_key_size:
+        raise SnapshotException('Snapshot {} has keys of {:d} bits.'.format(path, snapshot_key_size))
+
+    key_bytes = key_size // 8
+    contact_size = key_bytes + ADDRESS_SIZE + PORT.size
+
+    if len(data) != HEADER.size + key_bytes + count * contact_size + CHECKSUM.size:
+        raise SnapshotException('Snapshot {} has the wrong size.'.format(path))
+
+    offset = HEADER.size
+    self_key = data[offset:offset + key_bytes].hex()
+    offset += key_bytes
+
+    nodes = []
+
+    for _ in range(count):
+        key = data[offset:offset + key_bytes].hex()
+        offset += key_bytes
+
+        address = ipaddress.IPv6Address(data[offset:offset + ADDRESS_SIZE])
+        offset += ADDRESS_SIZE
+
+        if address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        (port,) = PORT.unpack_from(data, offset)
+        offset += PORT.size
+
+        nodes.append(Node(key, str(address), port))
+
+    return self_key, nodes
@@ -0,0 +1,98 @@
+import asyncio
+import heapq
+
+
+class Timer:
+    """ A callback scheduled on a TimerHeap. """
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'heap')
+
+    def __init__(self, when, callback, args, heap):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.heap = heap
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self) -> None:
+        """ Cancel the timer, it stays in the heap until it is due or compacted. """
+        if not self.cancelled:
+            self.cancelled = True
+            self.heap.cancelled += 1
+
+
+class TimerHeap:
+    """ Many timers on a heap, sharing a single callback on the event loop for the
+    timer that is due first. """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.timers = []
+        self.cancelled = 0
+
+        self.handle = None
+        self.handle_when = None
+
+    def __len__(self):
+        return len(self.timers) - self.cancelled
+
+    def call_later(self, delay, callback, *args) -> Timer:
+        """ Call callback with args after delay seconds. """
+
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+
+        timer = Timer(self.loop.time() + delay, callback, args, self)
+        heapq.heappush(self.timers, timer)
+
+        # Rebuild the heap when most of it are cancelled timers, so timers cancelled
+        # long before they are due don't pile up.
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.timers):
+            self.timers = [timer for timer in self.timers if not timer.cancelled]
+            heapq.heapify(self.timers)
+            self.cancelled = 0
+
+        if self.handle is None or timer.when < self.handle_when:
+            self._schedule(timer.when)
+
+        return timer
+
+    def _schedule(self, when) -> None:
+        """ Schedule the loop callback at when. """
+
+        if self.handle is not None:
+            self.handle.cancel()
+
+        self.handle = self.loop.call_at(when, self._run)
+        self.handle_when = when
+
+    def _run(self) -> None:
+        """ Call the timers that are due and schedule the next one. """
+
+        self.handle = None
+        now = self.loop.time()
+
+        while self.timers and (self.timers[0].cancelled or self.timers[0].when <= now):
+            timer = heapq.heappop(self.timers)
+
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+
+            # Mark it as done, so cancelling it from now on doesn't count.
+            timer.cancelled = True
+
+            # A failing callback is reported, it mustn't stop the timers after it.
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.loop.call_exception_handler({
+                    'message': 'Exception in timer callback {!r}'.format(timer.callback),
+                    'exception': e,
+                })
+
+        if self.timers:
+            self._schedule(self.timers[0].when)
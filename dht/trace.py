@@ -0,0 +1,26 @@
+import json
+import logging
+import random
+import time
+
+from dht import settings
+
+
+# The sampled requests are logged as a line of JSON each to this logger.
+TRACE_LOGGER = logging.getLogger('dht.trace')
+TRACE_LOGGER.setLevel(logging.INFO)
+
+
+def should_trace() -> bool:
+    """ Decide if a request is traced, for TRACE_SAMPLE_RATE of the requests. """
+    rate = settings.TRACE_SAMPLE_RATE
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def trace(event, **fields) -> None:
+    """ Log an event of a traced request. """
+
+    fields['event'] = event
+    fields['time'] = time.time()
+
+    TRACE_LOGGER.info('%s', json.dumps(fields, sort_keys=True, default=str))
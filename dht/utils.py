@@ -3,9 +3,17 @@ import hashlib
 from dht import settings
 
 
-def hash_string(value):
-    return hashlib.sha512(str.encode(value)).hexdigest()
+# The hash function that gives the keys of every supported key size.
+HASH_FUNCTIONS = {
+    160: hashlib.sha1,
+    256: hashlib.sha256,
+    512: hashlib.sha512,
+}
 
 
-def hex_to_bin(value):
-    return bin(int(value, 16))[2:].zfill(settings.KEY_SIZE)
+def hash_string(value, key_size=None):
+    return HASH_FUNCTIONS[key_size or settings.KEY_SIZE](str.encode(value)).hexdigest()
+
+
+def hex_to_bin(value, key_size=None):
+    return bin(int(value, 16))[2:].zfill(key_size or settings.KEY_SIZE)
@@ -0,0 +1,16 @@
+import importlib
+
+
+# The value store backends by name, the name is used in settings.VALUE_STORE.
+VALUE_STORES = {
+    'memory': 'dht.value_stores.memory.MemoryStore',
+    'disk': 'dht.value_stores.disk.DiskStore',
+    'shared': 'dht.value_stores.shared.SharedStore',
+}
+
+
+def create_value_store(name, **kwargs):
+    """ Create a value store by the name of its backend. """
+    module_name, class_name = VALUE_STORES[name].rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(**kwargs)
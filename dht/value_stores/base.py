@@ -0,0 +1,136 @@
+import heapq
+import time
+
+from dht import settings
+from dht.utils import hash_string
+
+
+class ValueStore:
+    """ The interface of a value store. Values are strings, stored by the hash of
+    the value as key. Every value expires after its time to live, and the least
+    recently used values are evicted when the store holds more than max_values
+    values or max_size bytes. """
+
+    # The clock of the expiry times, these are kept across restarts.
+    clock = staticmethod(time.time)
+
+    def __init__(self, max_values=None, max_size=None):
+        # The size in bytes of all the stored values.
+        self.size = 0
+
+        self.max_values = max_values if max_values is not None else settings.VALUE_STORE_MAX_VALUES
+        self.max_size = max_size if max_size is not None else settings.VALUE_STORE_MAX_SIZE
+
+        # A heap of (expires, key), entries of values that are stored again or
+        # removed stay in the heap and are skipped.
+        self.expiry_heap = []
+
+    def store(self, value: str, ttl=None) -> str:
+        """ Store a value for ttl seconds, or settings.VALUE_TTL, return its key.
+        Storing a value again renews its expiry time. """
+        raise NotImplementedError()
+
+    def retrieve(self, key: str) -> str:
+        """ Retrieve the value of the key, raise a KeyError if it isn't stored. """
+        raise NotImplementedError()
+
+    def store_remaining(self, value: str, ttl) -> str:
+        """ Store a value that is republished with the ttl it has left, return its key.
+        A value that is stored already keeps its expiry time when that is later. """
+
+        key = self.get_key(value)
+
+        try:
+            expires = self.get_expires(key)
+        except KeyError:
+            expires = self.clock()
+
+        if ttl <= 0 or expires is None or expires >= self.clock() + ttl:
+            return key
+
+        return self.store(value, ttl)
+
+    def remove(self, key: str) -> None:
+        """ Remove the value of the key, raise a KeyError if it isn't stored. """
+        raise NotImplementedError()
+
+    def keys(self) -> list:
+        """ Get the keys of all the stored values. """
+        raise NotImplementedError()
+
+    def get_expires(self, key: str):
+        """ Get the time the value of the key expires, None if it never expires. """
+        raise NotImplementedError()
+
+    def get_least_recently_used(self) -> str:
+        """ Get the key of the value that is used least recently. """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        """ Release the resources of the store. """
+        pass
+
+    def __contains__(self, key):
+        try:
+            self.retrieve(key)
+        except KeyError:
+            return False
+
+        return True
+
+    def __len__(self):
+        return len(self.keys())
+
+    @staticmethod
+    def get_key(value: str) -> str:
+        """ Get the key to store a value by. """
+        return hash_string(value)
+
+    def get_expiry_time(self, ttl=None):
+        """ Get the time a value stored now for ttl seconds expires. """
+
+        if ttl is None:
+            ttl = settings.VALUE_TTL
+
+        return None if ttl is None else self.clock() + ttl
+
+    def is_expired(self, expires) -> bool:
+        return expires is not None and expires <= self.clock()
+
+    def add_expiry(self, key: str, expires) -> None:
+        """ Add the expiry time of a value to the expiry heap. """
+
+        if expires is None:
+            return
+
+        heapq.heappush(self.expiry_heap, (expires, key))
+
+        # Drop the skipped entries when they make up most of the heap.
+        if len(self.expiry_heap) > 64 and len(self.expiry_heap) > 2 * len(self):
+            self.expiry_heap = [
+                (expires, key) for expires, key in self.expiry_heap
+                if key in self and self.get_expires(key) == expires]
+            heapq.heapify(self.expiry_heap)
+
+    def expire(self) -> int:
+        """ Remove the values that are expired, return the amount removed. """
+
+        now = self.clock()
+        removed = 0
+
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry_heap)
+
+            if key in self and self.get_expires(key) == expires:
+                self.remove(key)
+                removed += 1
+
+        return removed
+
+    def evict(self) -> None:
+        """ Remove the least recently used values until the store is within its limits. """
+
+        while len(self) and (
+                (self.max_values is not None and len(self) > self.max_values) or
+                (self.max_size is not None and self.size > self.max_size)):
+            self.remove(self.get_least_recently_used())
@@ -0,0 +1,247 @@
+import logging
+import os
+import struct
+import zlib
+
+from collections import OrderedDict
+
+from dht import settings
+from dht.value_stores.base import ValueStore
+
+
+class DiskStore(ValueStore):
+    """ Stores the values in append-only log segments on disk. An index in memory
+    holds where every value is, the values themselves are read from disk. """
+
+    # Every record is a checksum, a record header, the key and the value. The
+    # checksum covers everything after it. The header holds the record type, the
+    # key and value length and the time the value expires, 0 for never.
+    CHECKSUM = struct.Struct('>I')
+    RECORD_HEADER = struct.Struct('>BHId')
+
+    PUT = 1
+    DELETE = 2
+    EXPIRES = 3
+
+    def __init__(self, path=None, segment_size=None, max_values=None, max_size=None):
+        super().__init__(max_values, max_size)
+        self.path = path or settings.VALUE_STORE_PATH
+        self.segment_size = segment_size or settings.VALUE_STORE_SEGMENT_SIZE
+
+        # The location of every value by key, the least recently used first:
+        # segment id, value offset, value length, the size of the whole record and
+        # the time the value expires.
+        self.index = OrderedDict()
+
+        # The open segment files by id, values are appended to the last one.
+        self.segments = {}
+        self.active_segment = None
+        self.active_size = 0
+
+        # The bytes in the segments taken by values that are removed or replaced.
+        self.garbage = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.load()
+        self.expire()
+        self.evict()
+
+        logging.info("Disk Value Store created in {} with {:d} values".format(self.path, len(self.index)))
+
+    def store(self, value: str, ttl=None) -> str:
+        key = self.get_key(value)
+        expires = self.get_expiry_time(ttl)
+
+        if key in self.index:
+            # Only write the new expiry time, the value is already there.
+            self.index.move_to_end(key)
+            self.write_record(self.EXPIRES, key, b'', expires)
+        else:
+            self.write_record(self.PUT, key, value.encode(), expires)
+
+        self.evict()
+        self.maybe_compact()
+
+        return key
+
+    def retrieve(self, key: str) -> str:
+        segment, offset, length, _, expires = self.index[key]
+
+        if self.is_expired(expires):
+            self.remove(key)
+            raise KeyError(key)
+
+        self.index.move_to_end(key)
+
+        segment_file = self.segments[segment]
+        segment_file.seek(offset)
+
+        return segment_file.read(length).decode()
+
+    def remove(self, key: str) -> None:
+        if key not in self.index:
+            raise KeyError(key)
+
+        self.write_record(self.DELETE, key, b'')
+        self.maybe_compact()
+
+    def keys(self) -> list:
+        return list(self.index)
+
+    def get_expires(self, key: str):
+        return self.index[key][4]
+
+    def get_least_recently_used(self) -> str:
+        return next(iter(self.index))
+
+    def close(self) -> None:
+        for segment_file in self.segments.values():
+            segment_file.close()
+
+        self.segments = {}
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_segment_path(self, segment) -> str:
+        return os.path.join(self.path, '{:08d}.log'.format(segment))
+
+    def load(self) -> None:
+        """ Build the index from the segments on disk. """
+
+        segments = sorted(
+            int(name[:-4]) for name in os.listdir(self.path)
+            if name.endswith('.log') and name[:-4].isdigit())
+
+        for segment in segments:
+            self.load_segment(segment)
+
+        if segments:
+            self.active_segment = segments[-1]
+            self.active_size = os.path.getsize(self.get_segment_path(self.active_segment))
+        else:
+            self.open_segment(0)
+
+    def load_segment(self, segment) -> None:
+        """ Read all the records of a segment into the index. A record that is cut
+        short or damaged, by a crash while writing, ends the segment. """
+
+        segment_file = open(self.get_segment_path(segment), 'a+b')
+        self.segments[segment] = segment_file
+
+        segment_file.seek(0)
+        data = memoryview(segment_file.read())
+        offset = 0
+        header_size = self.CHECKSUM.size + self.RECORD_HEADER.size
+
+        while offset + header_size <= len(data):
+            (checksum,) = self.CHECKSUM.unpack_from(data, offset)
+            record_type, key_length, value_length, expires = self.RECORD_HEADER.unpack_from(
+                data, offset + self.CHECKSUM.size)
+
+            end = offset + header_size + key_length + value_length
+
+            if end > len(data) or zlib.crc32(data[offset + self.CHECKSUM.size:end]) != checksum:
+                break
+
+            key_offset = offset + header_size
+            key = str(data[key_offset:key_offset + key_length], 'ascii')
+
+            self.apply_record(
+                record_type, key, segment, key_offset + key_length, value_length, end - offset,
+                expires or None)
+
+            offset = end
+
+        if offset < len(data):
+            logging.warning("Truncating damaged segment {} at {:d}".format(segment_file.name, offset))
+            segment_file.truncate(offset)
+
+    def apply_record(self, record_type, key, segment, offset, length, record_size, expires) -> None:
+        """ Apply a record to the index. """
+
+        if record_type == self.EXPIRES:
+            # The record is only needed until the next compaction.
+            self.garbage += record_size
+
+            if key in self.index:
+                self.index[key] = self.index[key][:4] + (expires,)
+                self.add_expiry(key, expires)
+
+            return
+
+        old = self.index.pop(key, None)
+
+        if old is not None:
+            self.garbage += old[3]
+            self.size -= old[2]
+
+        if record_type == self.PUT:
+            self.index[key] = (segment, offset, length, record_size, expires)
+            self.size += length
+            self.add_expiry(key, expires)
+        else:
+            # The delete record itself is only needed until the next compaction.
+            self.garbage += record_size
+
+    def open_segment(self, segment) -> None:
+        """ Start appending to a new segment. """
+
+        self.segments[segment] = open(self.get_segment_path(segment), 'a+b')
+        self.active_segment = segment
+        self.active_size = 0
+
+    def write_record(self, record_type, key, value: bytes, expires=None) -> None:
+        """ Append a record to the active segment and apply it to the index. """
+
+        key_bytes = key.encode()
+        header = self.RECORD_HEADER.pack(record_type, len(key_bytes), len(value), expires or 0)
+        record = header + key_bytes + value
+        record = self.CHECKSUM.pack(zlib.crc32(record)) + record
+
+        segment_file = self.segments[self.active_segment]
+        segment_file.write(record)
+        segment_file.flush()
+
+        value_offset = self.active_size + len(record) - len(value)
+        self.apply_record(
+            record_type, key, self.active_segment, value_offset, len(value), len(record), expires)
+
+        self.active_size += len(record)
+
+        if self.active_size >= self.segment_size:
+            self.open_segment(self.active_segment + 1)
+
+    def maybe_compact(self) -> None:
+        """ Compact the segments when most of the bytes in them are garbage. """
+        if self.garbage >= self.segment_size and self.garbage > self.size:
+            self.compact()
+
+    def compact(self) -> None:
+        """ Write all the values to new segments and remove the old segments. The old
+        segments are only removed when all the values are written, so a crash leaves
+        no values behind. """
+
+        logging.info("Compacting {:d} bytes of garbage in {}".format(self.garbage, self.path))
+
+        old_segments = self.segments
+        old_index = self.index
+
+        self.segments = {}
+        self.index = OrderedDict()
+        self.expiry_heap = []
+        self.size = 0
+        self.garbage = 0
+        self.open_segment(max(old_segments) + 1)
+
+        for key, (segment, offset, length, _, expires) in old_index.items():
+            segment_file = old_segments[segment]
+            segment_file.seek(offset)
+            self.write_record(self.PUT, key, segment_file.read(length), expires)
+
+        for segment_file in old_segments.values():
+            segment_file.close()
+            os.remove(segment_file.name)
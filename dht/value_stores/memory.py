@@ -1,7 +1,61 @@
 import logging
 
+from collections import OrderedDict
 
-class MemoryStore:
+from dht.value_stores.base import ValueStore
+
+
+class MemoryStore(ValueStore):
+    """ Stores the values in a dict. """
+
+    def __init__(self, max_values=None, max_size=None):
+        super().__init__(max_values, max_size)
+
+        # The value and the time it expires by key, the least recently used first.
+        self.values = OrderedDict()
 
-    def __init__(self):
         logging.info("Memory Value Store created")
+
+    def store(self, value: str, ttl=None) -> str:
+        key = self.get_key(value)
+        expires = self.get_expiry_time(ttl)
+
+        if key in self.values:
+            self.values.move_to_end(key)
+        else:
+            self.size += len(value.encode())
+
+        self.values[key] = (value, expires)
+        self.add_expiry(key, expires)
+        self.evict()
+
+        return key
+
+    def retrieve(self, key: str) -> str:
+        value, expires = self.values[key]
+
+        if self.is_expired(expires):
+            self.remove(key)
+            raise KeyError(key)
+
+        self.values.move_to_end(key)
+        return value
+
+    def remove(self, key: str) -> None:
+        value, _ = self.values.pop(key)
+        self.size -= len(value.encode())
+
+    def keys(self) -> list:
+        return list(self.values)
+
+    def get_expires(self, key: str):
+        return self.values[key][1]
+
+    def get_least_recently_used(self) -> str:
+        return next(iter(self.values))
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
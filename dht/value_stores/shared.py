@@ -0,0 +1,289 @@
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+
+from multiprocessing.managers import BaseManager, dispatch
+
+from dht import settings
+from dht.cache import TTLCache
+from dht.value_stores.base import ValueStore
+
+
+class StoreManager(BaseManager):
+    """ Connects to the value store served by serve_store. """
+    pass
+
+
+StoreManager.register('get_store')
+
+
+class LockedStore:
+    """ A value store that handles the calls of one worker at a time. The server of
+    the store handles every connection in its own thread. The keys that are stored
+    and removed are logged, so the workers can keep an index of the keys. """
+
+    def __init__(self, store, log_size=None):
+        self.store = store
+        self.lock = threading.Lock()
+
+        # The last changes as (key, stored) and the amount of changes ever made.
+        self.changes = collections.deque(maxlen=log_size or settings.SHARED_STORE_LOG_SIZE)
+        self.version = 0
+
+        # The store removes values itself as well, when they expire or are evicted.
+        remove = store.remove
+
+        def logged_remove(key):
+            remove(key)
+            self.add_change(key, False)
+
+        store.remove = logged_remove
+
+    def add_change(self, key, stored) -> None:
+        self.changes.append((key, stored))
+        self.version += 1
+
+    def get_index(self):
+        """ Get the version of the log and all the keys. """
+        with self.lock:
+            return self.version, self.store.keys()
+
+    def get_changes(self, version):
+        """ Get the version of the log and the changes after version, None if they
+        aren't all in the log anymore. """
+
+        with self.lock:
+            missed = self.version - version
+
+            if missed > len(self.changes):
+                return self.version, None
+
+            return self.version, list(self.changes)[len(self.changes) - missed:]
+
+    def store_value(self, value, ttl=None):
+        with self.lock:
+            key = self.store.store(value, ttl)
+            self.add_change(key, True)
+            return key
+
+    def retrieve(self, key):
+        with self.lock:
+            return self.store.retrieve(key)
+
+    def remove(self, key):
+        with self.lock:
+            self.store.remove(key)
+
+    def keys(self):
+        with self.lock:
+            return self.store.keys()
+
+    def get_expires(self, key):
+        with self.lock:
+            return self.store.get_expires(key)
+
+    def get_least_recently_used(self):
+        with self.lock:
+            return self.store.get_least_recently_used()
+
+    def expire(self):
+        with self.lock:
+            return self.store.expire()
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.store
+
+    def get_length(self):
+        with self.lock:
+            return len(self.store)
+
+    def get_size(self):
+        with self.lock:
+            return self.store.size
+
+
+def serve_store(store, address=('127.0.0.1', 0), authkey=None):
+    """ Serve a value store to the SharedStores of other processes, from a thread
+    of this process. Return the server, its address is at server.address. """
+
+    locked_store = LockedStore(store)
+
+    class StoreServerManager(BaseManager):
+        pass
+
+    StoreServerManager.register('get_store', callable=lambda: locked_store)
+
+    manager = StoreServerManager(address, authkey=authkey or multiprocessing.current_process().authkey)
+    server = manager.get_server()
+
+    thread = threading.Thread(target=run_server, args=(server,), daemon=True)
+    thread.start()
+
+    logging.info("Serving the value store on {}:{}".format(*server.address))
+
+    return server
+
+
+def run_server(server):
+    """ Run the server until it is shut down, serve_forever always ends by raising
+    SystemExit. """
+
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+
+
+def stop_store(server):
+    """ Stop serving the value store served by serve_store. """
+
+    connection = multiprocessing.connection.Client(server.address, authkey=server.authkey)
+
+    try:
+        dispatch(connection, None, 'shutdown')
+    finally:
+        connection.close()
+
+    logging.info("Stopped serving the value store")
+
+
+class SharedStore(ValueStore):
+    """ Uses the value store of another process, served by serve_store, so the
+    workers on a host share their values. The limits and the expiry times are kept
+    by the served store.
+
+    The keys of the served store are kept in an index, which a thread updates from
+    the log of the served store every SHARED_STORE_SYNC_INTERVAL seconds. A key that
+    isn't in the index isn't asked for. A key is the hash of its value, so the
+    values that are stored or retrieved are cached and a cached value is never
+    wrong, a value removed by another worker can only be served for a while longer.
+    Values are stored from a thread in the order they are stored. """
+
+    def __init__(self, address=None, authkey=None):
+        # The state of ValueStore is kept by the served store, not here.
+        manager = StoreManager(
+            tuple(address or settings.VALUE_STORE_ADDRESS),
+            authkey=authkey or multiprocessing.current_process().authkey)
+        manager.connect()
+
+        self.proxy = manager.get_store()
+        self.cache = TTLCache(settings.VALUE_CACHE_TTL, settings.CACHE_SIZE)
+
+        # The keys of the served store, as of the version of its log.
+        self.version, keys = self.proxy.get_index()
+        self.index = set(keys)
+
+        # A single thread, so the values are stored in order and a remove comes
+        # after the stores before it.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.closed = threading.Event()
+        self.sync_thread = threading.Thread(target=self.run_sync, daemon=True)
+        self.sync_thread.start()
+
+        logging.info("Shared Value Store created")
+
+    @property
+    def size(self):
+        return self.proxy.get_size()
+
+    def run_sync(self) -> None:
+        """ Sync the index until the store is closed, this runs in its own thread. """
+
+        while not self.closed.wait(settings.SHARED_STORE_SYNC_INTERVAL):
+            try:
+                self.sync()
+            except Exception as e:
+                logging.warning("Syncing the index of the shared store failed: {}".format(e))
+
+    def sync(self) -> None:
+        """ Apply the changes of the served store since the last sync to the index. """
+
+        version, changes = self.proxy.get_changes(self.version)
+
+        if changes is None:
+            # Too much changed, start over from all the keys.
+            self.version, keys = self.proxy.get_index()
+            self.index = set(keys)
+            return
+
+        for key, stored in changes:
+            if stored:
+                self.index.add(key)
+            else:
+                self.index.discard(key)
+
+        self.version = version
+
+    def store(self, value: str, ttl=None) -> str:
+        key = self.get_key(value)
+        self.cache.set(key, value)
+        self.index.add(key)
+
+        future = self.executor.submit(self.proxy.store_value, value, ttl)
+        future.add_done_callback(self.stored)
+
+        return key
+
+    @staticmethod
+    def stored(future) -> None:
+        """ Log a value that couldn't be stored in the served store. """
+
+        if future.exception() is not None:
+            logging.error("Storing a value in the shared store failed: {}".format(future.exception()))
+
+    def retrieve(self, key: str) -> str:
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            pass
+
+        if key not in self.index:
+            raise KeyError(key)
+
+        try:
+            value = self.proxy.retrieve(key)
+        except KeyError:
+            self.index.discard(key)
+            raise
+
+        self.cache.set(key, value)
+
+        return value
+
+    def remove(self, key: str) -> None:
+        self.cache.remove(key)
+        self.index.discard(key)
+        self.executor.submit(self.proxy.remove, key).result()
+
+    def keys(self) -> list:
+        return list(self.index)
+
+    def get_expires(self, key: str):
+        return self.proxy.get_expires(key)
+
+    def get_least_recently_used(self) -> str:
+        return self.proxy.get_least_recently_used()
+
+    def expire(self) -> int:
+        return self.proxy.expire()
+
+    def close(self) -> None:
+        """ Stop syncing and wait for the values that are still being stored. """
+        self.closed.set()
+        self.executor.shutdown()
+
+    def __contains__(self, key):
+        try:
+            self.cache.get(key)
+        except KeyError:
+            return key in self.index
+
+        return True
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import time
+
+from dht import settings
+from dht.value_stores import create_value_store
+from dht.value_stores.shared import serve_store, stop_store
+
+
+def get_settings() -> dict:
+    """ Get the values of all the settings, to hand them to a worker process. """
+    return {name: getattr(settings, name) for name in dir(settings) if name.isupper()}
+
+
+def run_worker(index, listen_port, initial_nodes, transport, worker_settings, log_level):
+    """ Run a worker DHT until it is terminated, this is the target of the worker
+    processes. """
+
+    # Imported here, dht.main imports this module to start the supervisor.
+    from dht.main import DHT
+
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
+
+    logging.basicConfig(level=log_level)
+
+    class WorkerDHT(DHT):
+        """ A DHT that shares the value store of its supervisor with the other
+        workers. """
+
+        async def republish_stored(self):
+            """ The stored values are shared, only the first worker republishes them.
+            Every worker republishes the values it published itself. """
+
+            if index == 0:
+                await super().republish_stored()
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    dht = WorkerDHT(listen_port, initial_nodes, transport)
+    dht.run()
+
+
+class Supervisor:
+    """ Runs worker DHTs in their own processes, so a host uses all its cores. Every
+    worker has its own key and listens on listen_port plus its index. The workers
+    share the value store of the supervisor, and a worker that stops is started
+    again. """
+
+    # The seconds to wait before starting a stopped worker again.
+    RESTART_DELAY = 1.0
+
+    def __init__(self, workers, listen_port, initial_nodes=None, transport=settings.TRANSPORT):
+        self.workers = workers
+        self.listen_port = int(listen_port)
+        self.initial_nodes = list(initial_nodes or [])
+        self.transport = transport
+
+        self.value_store = None
+        self.server = None
+
+        # The process of every worker by index.
+        self.processes = {}
+
+    def start(self) -> None:
+        """ Serve the value store and start all the workers. """
+
+        self.value_store = create_value_store(settings.VALUE_STORE)
+        self.server = serve_store(self.value_store)
+
+        for index in range(self.workers):
+            self.start_worker(index)
+
+    def start_worker(self, index) -> None:
+        """ Start the worker at index. The first worker joins through the initial
+        nodes, the others through the initial nodes and the first worker. """
+
+        initial_nodes = list(self.initial_nodes)
+
+        if index > 0:
+            initial_nodes.append(('127.0.0.1', self.listen_port))
+
+        worker_settings = get_settings()
+        worker_settings['VALUE_STORE'] = 'shared'
+        worker_settings['VALUE_STORE_ADDRESS'] = self.server.address
+
+        # Every worker has its own snapshot and metrics port.
+        if settings.SNAPSHOT_PATH is not None:
+            worker_settings['SNAPSHOT_PATH'] = '{}.{:d}'.format(settings.SNAPSHOT_PATH, index)
+
+        if settings.METRICS_PORT is not None:
+            worker_settings['METRICS_PORT'] = settings.METRICS_PORT + index
+
+        process = multiprocessing.Process(
+            target=run_worker, name='dht-worker-{:d}'.format(index),
+            args=(
+                index, self.listen_port + index, initial_nodes, self.transport, worker_settings,
+                logging.getLogger().level))
+        process.start()
+
+        self.processes[index] = process
+
+        logging.info("Started worker {:d} on port {:d}".format(index, self.listen_port + index))
+
+    def check_workers(self, timeout=None) -> None:
+        """ Wait up to timeout seconds for workers to stop, and start them again. """
+
+        sentinels = {process.sentinel: index for index, process in self.processes.items()}
+
+        for sentinel in multiprocessing.connection.wait(list(sentinels), timeout):
+            index = sentinels[sentinel]
+
+            logging.warning("Worker {:d} stopped with exit code {}, starting it again".format(
+                index, self.processes[index].exitcode))
+
+            time.sleep(self.RESTART_DELAY)
+            self.start_worker(index)
+
+    def stop(self) -> None:
+        """ Stop all the workers and close the value store. """
+
+        for process in self.processes.values():
+            process.terminate()
+
+        for process in self.processes.values():
+            process.join()
+
+        self.processes = {}
+
+        stop_store(self.server)
+        self.value_store.close()
+
+    def run(self) -> None:
+        """ Start the workers and keep them running until interrupted. """
+
+        self.start()
+
+        try:
+            while True:
+                self.check_workers()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,42 @@
+import unittest
+
+from dht.cache import TTLCache
+
+
+class ClockTTLCache(TTLCache):
+    """ A TTLCache with a clock that is set by the test. """
+
+    now = 0.0
+
+    def clock(self):
+        return self.now
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_expire(self):
+        """ A value should be gone after its ttl. """
+
+        cache = ClockTTLCache(10, 100)
+        cache.set('key', 'value')
+
+        cache.now = 9.9
+        self.assertEqual(cache.get('key'), 'value')
+
+        cache.now = 10
+        self.assertRaises(KeyError, cache.get, 'key')
+        self.assertEqual(len(cache), 0)
+
+    def test_max_size(self):
+        """ The least recently used value should be dropped when the cache is full. """
+
+        cache = ClockTTLCache(10, 2)
+        cache.set('first', 1)
+        cache.set('second', 2)
+
+        cache.get('first')
+        cache.set('third', 3)
+
+        self.assertEqual(cache.get('first'), 1)
+        self.assertEqual(cache.get('third'), 3)
+        self.assertRaises(KeyError, cache.get, 'second')
@@ -0,0 +1,82 @@
+import json
+import unittest
+
+from unittest import mock
+
+from dht import settings
+from dht.codecs import BinaryCodec, JSONCodec, get_payload_codec, select_codec
+from dht.utils import hash_string
+
+
+class BinaryCodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        """ Decoding an encoded message should give the same data as the JSON codec. """
+
+        codec = BinaryCodec()
+
+        data = {
+            "key": hash_string('test'),
+            "request_key": True,
+            "listen_port": 9999,
+            "none": None,
+            "float": 1.5,
+            "big": 2 ** 80,
+            "text": 'some text',
+            "short_hex": 'abcd',
+            "upper_hex": hash_string('test').upper(),
+            "contacts": [
+                (hash_string('ipv4'), '127.0.0.1', 1234),
+                (hash_string('ipv6'), '::1', 5678),
+                (hash_string('port'), '127.0.0.1', '9999'),
+                ('first', 'localhost', 1234),
+                (hash_string('leading_zero'), '127.0.0.01', 1234),
+                (hash_string('long_ipv6'), '0:0:0:0:0:0:0:1', 1234),
+                (hash_string('spaced') + ' ', '127.0.0.1', 1234),
+            ],
+        }
+
+        encoded = codec.encode(42, 'identify', data)
+        self.assertTrue(isinstance(get_payload_codec(encoded), BinaryCodec))
+
+        msg_id, command, decoded = codec.decode(encoded)
+
+        self.assertEqual(msg_id, 42)
+        self.assertEqual(command, 'identify')
+        self.assertEqual(decoded, json.loads(json.dumps(data)))
+
+    def test_response_has_no_command(self):
+        """ A message without a command should decode without a command. """
+
+        codec = BinaryCodec()
+        _, command, data = codec.decode(codec.encode(1, None, 'value'))
+
+        self.assertEqual(command, None)
+        self.assertEqual(data, 'value')
+
+    def test_contacts_size(self):
+        """ A find_node response with a full bucket of contacts should be less than half
+        the size of the JSON encoded response. """
+
+        contacts = [(hash_string(str(i)), '192.168.1.{:d}'.format(i), 9000 + i) for i in range(20)]
+
+        binary = BinaryCodec().encode(1, None, contacts)
+        text = JSONCodec().encode(1, None, contacts)
+
+        self.assertLess(len(binary) * 2, len(text))
+
+
+class SelectCodecTest(unittest.TestCase):
+
+    def test_select_codec(self):
+        """ The most preferred codec known to both ends should be selected. """
+
+        with mock.patch.object(settings, 'CODECS', ['binary', 'json']):
+            self.assertEqual(select_codec(['binary', 'json']).name, 'binary')
+            self.assertEqual(select_codec(['binary']).name, 'binary')
+            self.assertEqual(select_codec(['json', 'binary']).name, 'json')
+            self.assertEqual(select_codec(['json']).name, 'json')
+            self.assertEqual(select_codec(['unknown']).name, 'json')
+
+        with mock.patch.object(settings, 'CODECS', ['json', 'binary']):
+            self.assertEqual(select_codec(['binary', 'json']).name, 'json')
@@ -0,0 +1,136 @@
+import asyncio
+import time
+import unittest
+
+from unittest import mock
+
+from dht.connections import ConnectionBackoffException, ConnectionManager
+from dht.node import Node
+
+
+class FakeProtocol:
+
+    def __init__(self):
+        self.transport = mock.Mock()
+        self.transport.is_closing.return_value = False
+        self.transport.close.side_effect = lambda: self.transport.is_closing.configure_mock(
+            return_value=True)
+
+        self.messages = {}
+        self.last_activity = time.monotonic()
+
+
+class ConnectionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.dialing = 0
+        self.max_dialing = 0
+        self.unreachable = set()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    async def connect(self, node):
+        """ Connect to a node after a short while, or fail for unreachable nodes. """
+
+        self.dialing += 1
+        self.max_dialing = max(self.max_dialing, self.dialing)
+
+        try:
+            await asyncio.sleep(0.01)
+
+            if node.key in self.unreachable:
+                raise ConnectionRefusedError()
+
+            int(node.port)
+
+            protocol = FakeProtocol()
+            node.protocol = protocol
+            return protocol
+
+        finally:
+            self.dialing -= 1
+
+    def test_dial_concurrently(self):
+        """ Nodes should be dialed in parallel, but no more than max_dials at a time. """
+
+        manager = ConnectionManager(self.connect, max_dials=4)
+        nodes = [Node(str(i), '127.0.0.1', 1000 + i) for i in range(10)]
+
+        manager.dial_nodes(nodes)
+        self.loop.run_until_complete(asyncio.gather(*manager.dials.values()))
+
+        self.assertEqual(self.max_dialing, 4)
+        self.assertEqual(len(manager.get_open_protocols()), 10)
+        self.assertTrue(all(node.protocol is not None for node in nodes))
+
+    def test_backoff(self):
+        """ A node that can't be reached should not be dialed again during its backoff. """
+
+        manager = ConnectionManager(self.connect)
+        node = Node('unreachable', '127.0.0.1', 1000)
+        self.unreachable.add(node.key)
+
+        with self.assertRaises(ConnectionRefusedError):
+            self.loop.run_until_complete(manager.get_protocol(node))
+
+        self.assertEqual(node.failures, 1)
+        self.assertFalse(manager.can_dial(node))
+
+        with self.assertRaises(ConnectionBackoffException):
+            self.loop.run_until_complete(manager.get_protocol(node))
+
+        # Dialing all unconnected nodes should skip it.
+        manager.dial_nodes([node])
+        self.assertEqual(len(manager.dials), 0)
+
+    def test_backoff_without_address(self):
+        """ A node without an address should get a backoff like an unreachable node. """
+
+        manager = ConnectionManager(self.connect)
+        node = Node('no address', None, None)
+
+        with self.assertRaises(TypeError):
+            self.loop.run_until_complete(manager.get_protocol(node))
+
+        self.assertEqual(node.failures, 1)
+        self.assertFalse(manager.can_dial(node))
+
+    def test_connection_limit(self):
+        """ The least recently active idle connection should be closed to make room. """
+
+        manager = ConnectionManager(self.connect, max_connections=2)
+        nodes = [Node(str(i), '127.0.0.1', 1000 + i) for i in range(3)]
+
+        first = self.loop.run_until_complete(manager.get_protocol(nodes[0]))
+        second = self.loop.run_until_complete(manager.get_protocol(nodes[1]))
+
+        # The first connection has a pending message, so the second is closed.
+        first.messages[1] = mock.Mock()
+        first.last_activity -= 10
+
+        self.loop.run_until_complete(manager.get_protocol(nodes[2]))
+
+        self.assertFalse(first.transport.close.called)
+        self.assertTrue(second.transport.close.called)
+        self.assertEqual(len(manager.get_open_protocols()), 2)
+
+    def test_close_idle(self):
+        """ Connections without activity should be closed. """
+
+        manager = ConnectionManager(self.connect, idle_timeout=60)
+        protocol = self.loop.run_until_complete(manager.get_protocol(Node('0', '127.0.0.1', 1000)))
+
+        manager.close_idle()
+        self.assertFalse(protocol.transport.close.called)
+
+        protocol.last_activity -= 120
+        manager.close_idle()
+
+        self.assertTrue(protocol.transport.close.called)
+        self.assertEqual(len(manager.get_open_protocols()), 0)
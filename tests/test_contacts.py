@@ -0,0 +1,92 @@
+import unittest
+
+from dht import settings
+from dht.contacts import ContactTable
+from dht.node import Node
+from dht.utils import hash_string
+
+
+class ContactTableTest(unittest.TestCase):
+
+    def test_add_get_remove(self):
+        """ Contacts should keep their key, address and port, also after removing others. """
+
+        table = ContactTable()
+
+        table.add(hash_string('first'), '127.0.0.1', 1234)
+        table.add(hash_string('second'), '::1', 5678)
+        table.add(hash_string('third'), '10.0.0.3', 9100)
+
+        table.remove(hash_string('first'))
+
+        self.assertEqual(len(table), 2)
+        self.assertFalse(hash_string('first') in table)
+
+        node = table.get(hash_string('third'))
+
+        self.assertEqual(node.get_data(), (hash_string('third'), '10.0.0.3', 9100))
+        self.assertEqual(table.get(hash_string('second')).address, '::1')
+
+        # Adding a contact again should update it.
+        table.add(hash_string('second'), '127.0.0.2', 1000)
+
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get(hash_string('second')).get_data()[1:], ('127.0.0.2', 1000))
+
+        with self.assertRaises(KeyError):
+            table.get(hash_string('first'))
+
+    def test_find_nodes(self):
+        """ The closest contacts by XOR distance should be found, closest first. """
+
+        table = ContactTable()
+        keys = [hash_string(str(i)) for i in range(100)]
+
+        for i, key in enumerate(keys):
+            table.add(key, '127.0.0.1', 1000 + i)
+
+        key = hash_string('test')
+        expected = sorted(keys, key=lambda other: int(other, 16) ^ int(key, 16))
+
+        nodes = table.find_nodes(key)
+
+        self.assertEqual([node.key for node in nodes], expected[:settings.BUCKET_SIZE])
+        self.assertEqual(len(table.find_nodes(key, 200)), 100)
+
+    def test_find_nodes_after_remove(self):
+        """ The index should follow the contacts that move to other slots, a removed
+        contact should never be found. """
+
+        table = ContactTable()
+        keys = [hash_string(str(i)) for i in range(5000)]
+
+        for key in keys:
+            table.add(key, '127.0.0.1', 1000)
+
+        for key in keys[:4000:2]:
+            table.remove(key)
+
+        keys = keys[1:4000:2] + keys[4000:]
+
+        for i in range(10):
+            key = hash_string('test {:d}'.format(i))
+            expected = sorted(keys, key=lambda other: int(other, 16) ^ int(key, 16))
+
+            nodes = table.find_nodes(key, 50)
+
+            self.assertEqual([node.key for node in nodes], expected[:50])
+
+
+class NodeTest(unittest.TestCase):
+
+    def test_int_key(self):
+        """ The integer key should match the hexadecimal key. """
+
+        node = Node(hash_string('test'))
+        self.assertEqual(node.int_key, int(hash_string('test'), 16))
+
+    def test_slots(self):
+        """ Nodes should not have a __dict__. """
+
+        with self.assertRaises(AttributeError):
+            Node('0').unknown = True
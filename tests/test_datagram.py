@@ -0,0 +1,160 @@
+import asyncio
+import unittest
+
+from unittest import mock
+
+from dht import settings
+from dht.datagram import DHTDatagramProtocol
+from dht.node import Node
+from dht.protocol import RequestTimeoutException
+
+
+class DHTDatagramProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    @staticmethod
+    def create_endpoint(self_key, address):
+        """ Create a datagram endpoint for testing. """
+
+        bucket_tree = mock.Mock(key_size=512)
+        bucket_tree.get_known_node.return_value = None
+        value_store = mock.Mock()
+
+        endpoint = DHTDatagramProtocol(self_key, bucket_tree, value_store, address[1])
+        endpoint.connection_made(mock.Mock())
+
+        return endpoint, bucket_tree, value_store
+
+    def test_find_value(self):
+        """ Identify with a peer and get a value from it over datagrams. """
+
+        endpoint_a, tree_a, _ = self.create_endpoint('endpoint_a', ('127.0.0.1', 1000))
+        endpoint_b, tree_b, store_b = self.create_endpoint('endpoint_b', ('127.0.0.2', 1000))
+
+        # Deliver the datagrams of one endpoint to the other.
+        endpoint_a.transport.sendto.side_effect = \
+            lambda data, address: endpoint_b.datagram_received(data, ('127.0.0.1', 1000))
+        endpoint_b.transport.sendto.side_effect = \
+            lambda data, address: endpoint_a.datagram_received(data, ('127.0.0.2', 1000))
+
+        store_b.retrieve.return_value = 'value'
+
+        peer = endpoint_a.get_peer(('127.0.0.2', 1000))
+        peer.identify()
+
+        # Both ends should know each other now.
+        self.assertEqual(tree_a.add_node.call_args[0][0].key, 'endpoint_b')
+        self.assertEqual(tree_b.add_node.call_args[0][0].key, 'endpoint_a')
+        self.assertEqual(len(endpoint_b.peers), 1)
+
+        future = peer.find_value('testkey')
+
+        self.assertEqual(future.result(), 'value')
+        self.assertEqual(len(peer.messages), 0)
+
+    def test_retransmit(self):
+        """ A command without a response should be sent again until the last attempt and
+        fail at its deadline. """
+
+        endpoint, _, _ = self.create_endpoint('endpoint', ('127.0.0.1', 1000))
+        peer = endpoint.get_peer(('127.0.0.2', 1000))
+
+        with mock.patch.object(settings, 'RETRANSMIT_INTERVAL', 0.01), \
+                mock.patch.object(settings, 'RETRANSMIT_ATTEMPTS', 3), \
+                mock.patch.object(settings, 'REQUEST_TIMEOUT', 0.1):
+
+            future = peer.find_node('testkey')
+
+            with self.assertRaises(RequestTimeoutException):
+                self.loop.run_until_complete(future)
+
+        self.assertEqual(endpoint.transport.sendto.call_count, 3)
+        self.assertEqual(len(peer.messages), 0)
+
+    def test_find_values_fits_datagram(self):
+        """ The values in a find_values response should fit in a single datagram. """
+
+        endpoint, _, store = self.create_endpoint('endpoint', ('127.0.0.1', 1000))
+        store.retrieve.side_effect = lambda key: 'x' * 1024
+
+        peer = endpoint.get_peer(('127.0.0.2', 1000))
+        values = peer.handle_find_values(['key {:d}'.format(i) for i in range(100)])
+
+        self.assertTrue(0 < len(values) < 100)
+        self.assertLess(len(peer.codec.encode(1, None, values)), settings.MAX_DATAGRAM_SIZE)
+
+    def test_peer_limit(self):
+        """ Only the most recently active peers should be kept, and idle peers should be
+        forgotten. Peers with pending commands are kept. """
+
+        endpoint, _, _ = self.create_endpoint('endpoint', ('127.0.0.1', 1000))
+
+        with mock.patch.object(settings, 'MAX_DATAGRAM_PEERS', 3):
+            busy = endpoint.get_peer(('127.0.0.2', 1000))
+            busy.ping()
+
+            for index in range(3, 7):
+                endpoint.get_peer(('127.0.0.{:d}'.format(index), 1000))
+
+        self.assertEqual(
+            list(endpoint.peers), [('127.0.0.2', 1000), ('127.0.0.5', 1000), ('127.0.0.6', 1000)])
+
+        with mock.patch.object(settings, 'CONNECTION_IDLE_TIMEOUT', -1):
+            endpoint.close_idle()
+
+        self.assertEqual(list(endpoint.peers), [('127.0.0.2', 1000)])
+
+    def test_invalid_datagram(self):
+        """ A datagram that can't be decoded should be dropped without an error. """
+
+        endpoint, _, _ = self.create_endpoint('endpoint', ('127.0.0.1', 1000))
+
+        endpoint.datagram_received(b'\x00\x00\x00\x07garbage', ('127.0.0.2', 1000))
+        endpoint.datagram_received(b'\xff\xff\xff\xff', ('127.0.0.3', 1000))
+
+        self.assertFalse(endpoint.transport.sendto.called)
+
+    def test_remove_peer(self):
+        """ A removed peer should be closing and no longer be the protocol of its Node,
+        the next command gets a new peer. """
+
+        endpoint, _, _ = self.create_endpoint('endpoint', ('127.0.0.1', 1000))
+        peer = endpoint.get_peer(('127.0.0.2', 1000))
+
+        node = Node('peer', '127.0.0.2', 1000, peer)
+        peer.node = node
+
+        endpoint.remove_peer(('127.0.0.2', 1000))
+
+        self.assertTrue(peer.transport.is_closing())
+        self.assertIsNone(node.protocol)
+        self.assertFalse(node.is_connected())
+        self.assertIsNot(endpoint.get_peer(('127.0.0.2', 1000)), peer)
+
+    def test_failing_timer(self):
+        """ A timer callback that raises shouldn't stop the other timers of the
+        endpoint. """
+
+        endpoint, _, _ = self.create_endpoint('endpoint', ('127.0.0.1', 1000))
+        called = []
+
+        def fail():
+            raise ValueError('test')
+
+        with mock.patch.object(self.loop, 'call_exception_handler') as exception_handler:
+            endpoint.timers.call_later(0.01, fail)
+            endpoint.timers.call_later(0.01, called.append, 1)
+            endpoint.timers.call_later(0.02, called.append, 2)
+
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.assertEqual(called, [1, 2])
+        self.assertEqual(exception_handler.call_count, 1)
@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+
+from dht import settings
+from dht.lookup import NodeLookup, ValueLookup
+from dht.node import Node, SelfNode
+from dht.routing import BucketTree
+from dht.utils import hash_string
+
+
+class FakeProtocol:
+    """ Answers find_node and find_value from the BucketTree of a node. """
+
+    def __init__(self, tree, values=None, online=True):
+        self.tree = tree
+        self.values = values or {}
+        self.online = online
+        self.requests = 0
+
+    def find_node(self, key):
+        self.requests += 1
+        future = asyncio.Future()
+
+        if self.online:
+            future.set_result([node.get_data() for node in self.tree.find_nodes(key)])
+
+        return future
+
+    def find_value(self, key):
+        if key in self.values:
+            future = asyncio.Future()
+            future.set_result(self.values[key])
+            return future
+
+        return self.find_node(key)
+
+
+class LookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        # A network of nodes that all tried to add every other node, so every node
+        # only knows the nodes that fit in its Buckets.
+        self.keys = [hash_string(str(i)) for i in range(300)]
+        self.protocols = {}
+
+        for key in self.keys:
+            tree = BucketTree(SelfNode(key, '127.0.0.1', 1000))
+
+            for other in self.keys:
+                tree.add_node(Node(other, '127.0.0.1', 1000))
+
+            self.protocols[key] = FakeProtocol(tree)
+
+        self.tree = BucketTree(SelfNode(hash_string('self'), '127.0.0.1', 1000))
+
+        for key in self.keys[:10]:
+            self.tree.add_node(Node(key, '127.0.0.1', 1000))
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    async def get_protocol(self, node):
+        return self.protocols[node.key]
+
+    def get_closest_keys(self, key):
+        return sorted(self.keys, key=lambda other: int(other, 16) ^ int(key, 16))[:settings.BUCKET_SIZE]
+
+    def test_node_lookup(self):
+        """ The lookup should find the closest nodes of the whole network. """
+
+        key = hash_string('test')
+        lookup = NodeLookup(key, self.tree, self.get_protocol)
+
+        nodes = self.loop.run_until_complete(lookup.run())
+
+        self.assertEqual([node.key for node in nodes], self.get_closest_keys(key))
+        self.assertTrue(lookup.get_hops() > 1)
+
+    def test_node_lookup_with_failures(self):
+        """ Nodes that don't respond should be left out of the result. """
+
+        key = hash_string('test')
+        closest = self.get_closest_keys(key)
+
+        for offline in closest[:5]:
+            self.protocols[offline].online = False
+
+        lookup = NodeLookup(key, self.tree, self.get_protocol, timeout=0.01)
+        nodes = self.loop.run_until_complete(lookup.run())
+
+        self.assertEqual([node.key for node in nodes][:15], closest[5:])
+
+    def test_value_lookup(self):
+        """ The lookup should stop when a node returns the value. """
+
+        key = hash_string('value')
+        self.protocols[self.get_closest_keys(key)[0]].values[key] = 'value'
+
+        lookup = ValueLookup(key, self.tree, self.get_protocol)
+        self.loop.run_until_complete(lookup.run())
+
+        self.assertTrue(lookup.found)
+        self.assertEqual(lookup.value, 'value')
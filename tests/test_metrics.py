@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+
+from unittest import mock
+
+from dht import metrics
+from dht.metrics import Registry, serve_metrics
+from dht.protocol import DHTProtocol
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'A test.', ['command'])
+
+        counter.inc(labels=('ping',))
+        counter.inc(2, labels=('ping',))
+        counter.inc(labels=('store',))
+
+        self.assertEqual(registry.get_text(), '\n'.join([
+            '# HELP test_total A test.',
+            '# TYPE test_total counter',
+            'test_total{command="ping"} 3',
+            'test_total{command="store"} 1',
+        ]) + '\n')
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('test_seconds', 'A test.', [0.1, 1])
+
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(registry.get_text().splitlines()[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 5.65',
+            'test_seconds_count 4',
+        ])
+
+    def test_gauge_collect(self):
+        """ A gauge with a collect function should read its values when the metrics are
+        read. """
+
+        registry = Registry()
+        gauge = registry.gauge('test_nodes', 'A test.', ['bucket'])
+        sizes = [3, 1]
+
+        gauge.collect = lambda: {(str(index),): size for index, size in enumerate(sizes)}
+        sizes.append(2)
+
+        self.assertEqual(registry.get_text().splitlines()[2:], [
+            'test_nodes{bucket="0"} 3',
+            'test_nodes{bucket="1"} 1',
+            'test_nodes{bucket="2"} 2',
+        ])
+
+    def test_protocol_metrics(self):
+        """ Sending a command should count the command and its bytes. """
+
+        sent = metrics.RPCS_SENT.values.get(('ping',), 0)
+        sent_bytes = metrics.BYTES_SENT.values.get((), 0)
+
+        protocol = DHTProtocol('selfkey', mock.Mock(), mock.Mock(), 1234)
+        protocol.transport = mock.Mock()
+        protocol.ping()
+
+        written = protocol.transport.write.call_args[0][0]
+
+        self.assertEqual(metrics.RPCS_SENT.values[('ping',)], sent + 1)
+        self.assertEqual(metrics.BYTES_SENT.values[()], sent_bytes + len(written))
+
+    def test_serve_metrics(self):
+        """ The metrics should be served over HTTP at /metrics. """
+
+        registry = Registry()
+        registry.counter('test_total', 'A test.').inc()
+
+        server = self.loop.run_until_complete(serve_metrics('127.0.0.1', 0, registry))
+        port = server.sockets[0].getsockname()[1]
+
+        async def get(path):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('GET {} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(path).encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        response = self.loop.run_until_complete(get('/metrics'))
+
+        self.assertTrue(response.startswith(b'HTTP/1.0 200 OK'))
+        self.assertTrue(response.endswith(b'\ntest_total 1\n'))
+
+        response = self.loop.run_until_complete(get('/other'))
+        self.assertTrue(response.startswith(b'HTTP/1.0 404'))
+
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
@@ -1,9 +1,15 @@
+import asyncio
+import json
 import unittest
 
 from unittest import mock
 
+from dht import metrics, settings
 from dht.node import Node
-from dht.protocol import DHTProtocol
+from dht.protocol import (
+    BusyException, CommandFailedException, DHTProtocol, FrameReader, FrameTooLargeException,
+    KeySizeMismatchException, Message, RequestTimeoutException, split_batches)
+from dht.ratelimit import create_peer_rate_limiter
 
 
 class DHTProtocolTest(unittest.TestCase):
@@ -15,11 +21,12 @@ class DHTProtocolTest(unittest.TestCase):
         if self_key is None:
             self_key = 'selfkey'
 
-        bucket_tree = mock.Mock()
+        bucket_tree = mock.Mock(key_size=512)
         value_store = mock.Mock()
 
         protocol = DHTProtocol(self_key, bucket_tree, value_store, 1234)
         transport = mock.Mock()
+        transport.get_extra_info.return_value = ('127.0.0.1', 1000)
         protocol.transport = transport
 
         return protocol, transport, bucket_tree, value_store
@@ -44,7 +51,7 @@ class DHTProtocolTest(unittest.TestCase):
 
         # Get the message and check for the key.
         output = transport_a.write.call_args[0][0]
-        self.assertTrue(protocol_a.self_key in output.decode())
+        self.assertTrue(protocol_a.self_key.encode() in output)
 
         # Feed the message to the other protocol.
         protocol_b.data_received(output)
@@ -58,7 +65,7 @@ class DHTProtocolTest(unittest.TestCase):
 
         # Get the response, check the key.
         output = transport_b.write.call_args[0][0]
-        self.assertTrue(protocol_b.self_key in output.decode())
+        self.assertTrue(protocol_b.self_key.encode() in output)
 
         # Feed the response to the original protocol.
         protocol_a.data_received(output)
@@ -70,6 +77,50 @@ class DHTProtocolTest(unittest.TestCase):
         # The messages dict should now be empty again.
         self.assertTrue(len(protocol_a.messages) == 0)
 
+    def test_identify_other_key_size(self):
+        """ Nodes with keys of different sizes shouldn't add each other, and the
+        identify should fail. """
+
+        protocol_a, transport_a, tree_a, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, tree_b, _ = self.create_protocol('protocol_b')
+        tree_b.key_size = 160
+
+        transport_a.get_extra_info.return_value = ('127.0.0.1', 1000)
+        transport_b.get_extra_info.return_value = ('127.0.0.2', 1000)
+
+        future = protocol_a.identify()
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertFalse(tree_b.add_node.called)
+        self.assertFalse(tree_a.add_node.called)
+        self.assertRaises(KeySizeMismatchException, future.result)
+
+    def test_identify_negotiates_codec(self):
+        """ After identify both protocols should send with the binary codec, when both
+        prefer it, and still understand each other. """
+
+        protocol_a, transport_a, tree_a, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, tree_b, store_b = self.create_protocol('protocol_b')
+
+        transport_a.get_extra_info.return_value = ('127.0.0.1', 1000)
+        transport_b.get_extra_info.return_value = ('127.0.0.2', 1000)
+        store_b.retrieve.return_value = 'value'
+
+        with mock.patch.object(settings, 'CODECS', ['binary', 'json']):
+            protocol_a.identify()
+            protocol_b.data_received(transport_a.write.call_args[0][0])
+            protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertEqual(protocol_a.codec.name, 'binary')
+        self.assertEqual(protocol_b.codec.name, 'binary')
+
+        future = protocol_a.find_value('testkey')
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertEqual(future.result(), 'value')
+
     def test_find_node(self):
         """ Test the find_node flow between two protocols. """
 
@@ -113,6 +164,220 @@ class DHTProtocolTest(unittest.TestCase):
         self.assertTrue(tree_a.add_node.called)
         self.assertTrue(len(tree_a.add_node.call_args_list) == 3)
 
+    def test_find_response_without_address(self):
+        """ Contacts without an address should not be added to the routing tree. """
+
+        protocol, _, tree, _ = self.create_protocol()
+        protocol.handle_find_response([['first', None, None], ['second', '127.0.0.1', 1000]])
+
+        self.assertEqual([call[0][0].key for call in tree.add_node.call_args_list], ['second'])
+
+    def test_busy(self):
+        """ Commands above the inbound rate should be answered busy, and fail with a
+        BusyException. """
+
+        with mock.patch.object(settings, 'INBOUND_RATE', 0), mock.patch.object(settings, 'INBOUND_BURST', 2):
+            protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+            protocol_b, transport_b, _, _ = self.create_protocol('protocol_b')
+
+        futures = []
+
+        for _ in range(3):
+            futures.append(protocol_a.ping())
+            protocol_b.data_received(transport_a.write.call_args[0][0])
+            protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertTrue(futures[0].result())
+        self.assertTrue(futures[1].result())
+        self.assertRaises(BusyException, futures[2].result)
+
+    def test_busy_over_connections(self):
+        """ Connections with the same address should share its inbound rate. """
+
+        with mock.patch.object(settings, 'INBOUND_RATE', 0), mock.patch.object(settings, 'INBOUND_BURST', 2):
+            limits = create_peer_rate_limiter()
+
+        receivers = []
+
+        for _ in range(3):
+            protocol, transport, _, _ = self.create_protocol()
+            protocol.inbound_limits = limits
+            receivers.append((protocol, transport))
+
+        sender, sender_transport, _, _ = self.create_protocol()
+        futures = []
+
+        for receiver, transport in receivers:
+            futures.append(sender.ping())
+            receiver.data_received(sender_transport.write.call_args[0][0])
+            sender.data_received(transport.write.call_args[0][0])
+
+        self.assertTrue(futures[1].result())
+        self.assertRaises(BusyException, futures[2].result)
+
+    def test_pause_writing(self):
+        """ Messages should be queued while writing is paused and written when it
+        resumes. Commands that don't fit in the queue should fail at once. """
+
+        protocol, transport, _, _ = self.create_protocol()
+        protocol.pause_writing()
+
+        with mock.patch.object(settings, 'OUTBOUND_QUEUE_SIZE', 100):
+            queued = protocol.ping()
+            dropped = protocol.find_value('x' * 100)
+
+        self.assertFalse(transport.write.called)
+        self.assertRaises(BusyException, dropped.result)
+        self.assertEqual(len(protocol.messages), 1)
+
+        # A command received while paused is shed, its busy response is queued.
+        protocol.data_received(FrameReader.frame(json.dumps(
+            {'id': 'other', 'command': 'ping', 'data': None}).encode()))
+
+        self.assertEqual(len(protocol.outbound), 2)
+
+        protocol.resume_writing()
+
+        self.assertEqual(transport.write.call_count, 2)
+        self.assertTrue(b'busy' in transport.write.call_args[0][0])
+        self.assertEqual(protocol.outbound_size, 0)
+        self.assertFalse(queued.done())
+
+    def test_ping(self):
+        """ A ping should be answered, and every message received from a known Node
+        should mark it as seen in the routing tree. """
+
+        protocol_a, transport_a, tree_a, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, tree_b, _ = self.create_protocol('protocol_b')
+
+        protocol_a.node = Node('protocol_b', '127.0.0.2', 1000)
+
+        future = protocol_a.ping()
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+
+        self.assertFalse(tree_b.touch_node.called)
+
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertTrue(future.result())
+        self.assertEqual(tree_a.touch_node.call_args[0][0], protocol_a.node)
+
+    def test_unknown_command(self):
+        """ An unknown command should be answered with an error, which fails the command
+        at the other end. """
+
+        protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, _, _ = self.create_protocol('protocol_b')
+
+        message = Message.create('unknown', None)
+        protocol_a.send_message(message)
+
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertRaises(CommandFailedException, message.future.result)
+
+    def test_invalid_frames(self):
+        """ A frame that can't be decoded or handled should not stop the frames after
+        it, also not in later reads. """
+
+        protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, _, _ = self.create_protocol('protocol_b')
+
+        identify = Message.create('identify', {"key_size": 512})
+        protocol_a.send_message(identify)
+        invalid = transport_a.write.call_args[0][0]
+
+        future = protocol_a.ping()
+        ping = transport_a.write.call_args[0][0]
+
+        # An undecodable frame, a command that fails and half a ping.
+        protocol_b.data_received(FrameReader.frame(b'garbage') + invalid + ping[:6])
+        protocol_b.data_received(ping[6:])
+
+        self.assertEqual(transport_b.write.call_count, 2)
+
+        for call in transport_b.write.call_args_list:
+            protocol_a.data_received(call[0][0])
+
+        self.assertRaises(CommandFailedException, identify.future.result)
+        self.assertTrue(future.result())
+
+    def test_trace(self):
+        """ With a sample rate of 1 every step of a request should be traced. """
+
+        protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, _, _ = self.create_protocol('protocol_b')
+
+        transport_a.get_extra_info.return_value = ('127.0.0.2', 1000)
+        transport_b.get_extra_info.return_value = ('127.0.0.1', 1000)
+
+        with mock.patch.object(settings, 'TRACE_SAMPLE_RATE', 1.0), \
+                self.assertLogs('dht.trace', level='INFO') as logs:
+            protocol_a.ping()
+            protocol_b.data_received(transport_a.write.call_args[0][0])
+            protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        events = [json.loads(record.getMessage()) for record in logs.records]
+
+        self.assertEqual([event['event'] for event in events], ['send', 'command', 'response'])
+        self.assertEqual({event['command'] for event in events}, {'ping'})
+        self.assertEqual(len({event['id'] for event in events}), 1)
+
+    def test_find_values(self):
+        """ find_values should give back the values that are stored, and leave out the
+        others. """
+
+        protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, _, store_b = self.create_protocol('protocol_b')
+
+        values = {'first': 'value 1', 'second': 'value 2'}
+        store_b.retrieve.side_effect = lambda key: values[key]
+
+        future = protocol_a.find_values(['first', 'missing', 'second'])
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertEqual(future.result(), values)
+
+    def test_store_many(self):
+        """ store_many should store every value and give back their keys. """
+
+        protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, _, store_b = self.create_protocol('protocol_b')
+
+        store_b.store.side_effect = lambda value: 'key of ' + value
+
+        future = protocol_a.store_many(['first', 'second'])
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertEqual(future.result(), ['key of first', 'key of second'])
+        self.assertEqual(store_b.store.call_count, 2)
+
+    def test_message_too_large(self):
+        """ A command larger than the maximum message size should fail without being
+        sent, so the other end doesn't close the connection. """
+
+        protocol, transport, _, _ = self.create_protocol()
+
+        with mock.patch.object(settings, 'MAX_FRAME_SIZE', 1024):
+            future = protocol.store_many(['x' * 1024])
+
+        self.assertRaises(FrameTooLargeException, future.result)
+        self.assertFalse(transport.write.called)
+        self.assertEqual(len(protocol.messages), 0)
+
+    def test_split_batches(self):
+        """ Batches should stay below the count and the size, a large item should get a
+        batch of its own. """
+
+        items = ['x' * 100] * 5 + ['x' * 1000] + ['x'] * 3
+
+        self.assertEqual(
+            [len(batch) for batch in split_batches(items, 4, 300)], [2, 2, 1, 1, 3])
+        self.assertEqual(sum(split_batches(items, 4, 300), []), items)
+
     def test_find_value_without_result(self):
         """ Test the find_value flow between two protocols when the value isn't at the protocol
         receiving the request. """
@@ -253,3 +518,151 @@ class DHTProtocolTest(unittest.TestCase):
         # There shouldn't be any messages left.
         self.assertTrue(len(protocol_a.messages) == 0)
         self.assertTrue(future.done())
+
+    def test_coalesced_and_split_messages(self):
+        """ Messages written in one read, or split over several reads, should all be
+        received exactly once. """
+
+        protocol_a, transport_a, _, _ = self.create_protocol('protocol_a')
+        protocol_b, transport_b, _, store_b = self.create_protocol('protocol_b')
+
+        for i in range(3):
+            protocol_a.store('value{:d}'.format(i))
+
+        output = b''.join(call[0][0] for call in transport_a.write.call_args_list)
+
+        # All messages in a single read.
+        protocol_b.data_received(output)
+        self.assertEqual(store_b.store.call_count, 3)
+
+        # Every byte in its own read.
+        for i in range(len(output)):
+            protocol_b.data_received(output[i:i + 1])
+
+        self.assertEqual(store_b.store.call_count, 6)
+        self.assertEqual(
+            [call[0][0] for call in store_b.store.call_args_list[3:]], ['value0', 'value1', 'value2'])
+        self.assertEqual(len(protocol_b.frame_reader.buffer), 0)
+
+
+class RequestTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    def test_request_timeout(self):
+        """ A command without a response should fail at its deadline, be removed from the
+        pending messages and count as a failure of the Node. """
+
+        protocol, transport, _, _ = DHTProtocolTest.create_protocol()
+        protocol.node = Node('other', '127.0.0.1', 1234, protocol)
+
+        with mock.patch.object(settings, 'REQUEST_TIMEOUT', 0.01):
+            future = protocol.find_node('testkey')
+            self.assertEqual(len(protocol.messages), 1)
+
+            with self.assertRaises(RequestTimeoutException):
+                self.loop.run_until_complete(future)
+
+        self.assertEqual(len(protocol.messages), 0)
+        self.assertEqual(len(protocol.timers), 0)
+        self.assertEqual(protocol.node.failures, 1)
+
+    def test_response_cancels_timeout(self):
+        """ A response should cancel the deadline and register the response time. """
+
+        protocol_a, transport_a, _, _ = DHTProtocolTest.create_protocol('protocol_a')
+        protocol_b, transport_b, tree_b, _ = DHTProtocolTest.create_protocol('protocol_b')
+        protocol_a.node = Node('protocol_b', '127.0.0.1', 1234, protocol_a)
+        tree_b.find_nodes.return_value = []
+
+        future = protocol_a.find_node('testkey')
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertEqual(future.result(), [])
+        self.assertEqual(len(protocol_a.timers), 0)
+        self.assertTrue(protocol_a.node.response_time is not None)
+
+    def test_late_response(self):
+        """ A response after the deadline should count as a slow response of the Node,
+        which is no failure anymore. """
+
+        protocol_a, transport_a, _, _ = DHTProtocolTest.create_protocol('protocol_a')
+        protocol_b, transport_b, tree_b, _ = DHTProtocolTest.create_protocol('protocol_b')
+        protocol_a.node = Node('protocol_b', '127.0.0.1', 1234, protocol_a)
+        tree_b.find_nodes.return_value = []
+
+        with mock.patch.object(settings, 'REQUEST_TIMEOUT', 0.01):
+            future = protocol_a.find_node('testkey')
+
+            with self.assertRaises(RequestTimeoutException):
+                self.loop.run_until_complete(future)
+
+        self.assertEqual(protocol_a.node.failures, 1)
+
+        late = metrics.LATE_RESPONSES.values.get((), 0)
+
+        protocol_b.data_received(transport_a.write.call_args[0][0])
+        protocol_a.data_received(transport_b.write.call_args[0][0])
+
+        self.assertEqual(protocol_a.node.failures, 0)
+        self.assertTrue(protocol_a.node.response_time >= 0.01)
+        self.assertEqual(metrics.LATE_RESPONSES.values[()], late + 1)
+        self.assertEqual(protocol_a.timed_out, {})
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def test_partial_frame(self):
+        """ A partial frame should be kept until the rest of it is received. """
+
+        reader = FrameReader()
+        frames = []
+
+        data = FrameReader.frame(b'first') + FrameReader.frame(b'second')
+
+        reader.feed(data[:12], lambda frame: frames.append(bytes(frame)))
+        self.assertEqual(frames, [b'first'])
+
+        reader.feed(data[12:], lambda frame: frames.append(bytes(frame)))
+        self.assertEqual(frames, [b'first', b'second'])
+        self.assertEqual(len(reader.buffer), 0)
+
+    def test_callback_error(self):
+        """ An error in the callback should be raised, and the frames after it should
+        still be read. """
+
+        reader = FrameReader()
+        frames = []
+
+        def callback(frame):
+            # Keep a view of the frame, like the traceback of an error would.
+            frames.append(memoryview(frame))
+
+            if bytes(frame) == b'error':
+                raise ValueError('error')
+
+        reader.feed(FrameReader.frame(b'first')[:3], callback)
+
+        with self.assertRaises(ValueError):
+            reader.feed(FrameReader.frame(b'first')[3:] + FrameReader.frame(b'error'), callback)
+
+        reader.feed(FrameReader.frame(b'second'), callback)
+
+        self.assertEqual([bytes(frame) for frame in frames], [b'first', b'error', b'second'])
+        self.assertEqual(len(reader.buffer), 0)
+
+    def test_frame_too_large(self):
+        """ A frame larger than the maximum should raise a FrameTooLargeException. """
+
+        reader = FrameReader(max_frame_size=4)
+
+        with self.assertRaises(FrameTooLargeException):
+            reader.feed(FrameReader.frame(b'too large'), lambda frame: None)
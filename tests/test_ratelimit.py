@@ -0,0 +1,54 @@
+import unittest
+
+from dht.ratelimit import PeerRateLimiter, TokenBucket
+
+
+class ClockTokenBucket(TokenBucket):
+    """ A TokenBucket with a clock that is set by the test. """
+
+    now = 0.0
+
+    def clock(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_consume(self):
+        """ A burst should be allowed at once, after that the tokens should come back
+        at the rate. """
+
+        bucket = ClockTokenBucket(10, 5)
+
+        for _ in range(5):
+            self.assertTrue(bucket.consume())
+
+        self.assertFalse(bucket.consume())
+
+        bucket.now = 0.1
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        # The tokens never add up to more than the burst.
+        bucket.now = 100
+        self.assertTrue(bucket.consume(5))
+        self.assertFalse(bucket.consume())
+
+
+class PeerRateLimiterTest(unittest.TestCase):
+
+    def test_consume(self):
+        """ Every peer should have its own tokens, and only the peers seen last should
+        be kept. """
+
+        limiter = PeerRateLimiter(0, 2)
+        limiter.MAX_PEERS = 2
+
+        self.assertTrue(limiter.consume('10.0.0.1'))
+        self.assertTrue(limiter.consume('10.0.0.1'))
+        self.assertFalse(limiter.consume('10.0.0.1'))
+        self.assertTrue(limiter.consume('10.0.0.2'))
+
+        limiter.consume('10.0.0.3')
+
+        self.assertEqual(list(limiter.buckets), ['10.0.0.2', '10.0.0.3'])
@@ -0,0 +1,120 @@
+import asyncio
+import unittest
+
+from dht.node import Node, SelfNode
+from dht.refresh import RefreshScheduler
+from dht.routing import BucketTree
+from dht.simulator import VirtualTimeLoop
+from dht.utils import hash_string
+
+
+class RefreshSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.tree = BucketTree(SelfNode(hash_string('self'), '127.0.0.1', 9999))
+
+        for i in range(100):
+            self.tree.add_node(Node(hash_string(str(i)), '127.0.0.1', 9999))
+
+        self.keys = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    async def lookup(self, key):
+        self.keys.append(key)
+        self.tree.mark_lookup(int(key, 16))
+
+    def test_refresh_stale_buckets(self):
+        """ Every Bucket without a lookup should be refreshed once per interval, with a
+        key in its range. """
+
+        scheduler = RefreshScheduler(self.tree, self.lookup, interval=0.05, jitter=0.1)
+        scheduler.start()
+
+        bucket_nodes = self.tree.get_leaf_bucket_nodes(include_self=True)
+
+        self.loop.run_until_complete(asyncio.sleep(0.08))
+        scheduler.stop()
+
+        self.assertEqual(len(self.keys), len(bucket_nodes))
+
+        for key in self.keys:
+            bucket_nodes.remove(self.tree._find_bucket_node(int(key, 16)))
+
+        self.assertEqual(bucket_nodes, [])
+
+    def test_recent_lookup(self):
+        """ A Bucket with a recent lookup shouldn't be refreshed. """
+
+        scheduler = RefreshScheduler(self.tree, self.lookup, interval=0.05, jitter=0)
+        scheduler.start()
+
+        key = hash_string('1')
+        bucket_node = self.tree._find_bucket_node(int(key, 16))
+
+        async def lookup_key():
+            await asyncio.sleep(0.03)
+            self.tree.mark_lookup(int(key, 16))
+            await asyncio.sleep(0.04)
+
+        self.loop.run_until_complete(lookup_key())
+        scheduler.stop()
+
+        refreshed = [self.tree._find_bucket_node(int(other, 16)) for other in self.keys]
+
+        self.assertFalse(bucket_node in refreshed)
+        self.assertEqual(len(self.keys), len(self.tree.get_leaf_bucket_nodes(include_self=True)) - 1)
+
+    def test_refresh_virtual_time(self):
+        """ On the clock of the event loop, Buckets should become stale in virtual time
+        as well, without waiting for the interval. """
+
+        self.loop.close()
+        self.loop = VirtualTimeLoop()
+        asyncio.set_event_loop(self.loop)
+
+        self.tree = BucketTree(
+            SelfNode(hash_string('self'), '127.0.0.1', 9999), clock=self.loop.time)
+
+        for i in range(100):
+            self.tree.add_node(Node(hash_string(str(i)), '127.0.0.1', 9999))
+
+        scheduler = RefreshScheduler(self.tree, self.lookup, interval=3600, jitter=0.1)
+        scheduler.start()
+
+        self.loop.run_until_complete(asyncio.sleep(3 * 3600))
+        scheduler.stop()
+
+        bucket_nodes = self.tree.get_leaf_bucket_nodes(include_self=True)
+
+        self.assertTrue(len(self.keys) >= 2 * len(bucket_nodes))
+        self.assertTrue(len(self.keys) <= 3 * len(bucket_nodes))
+
+    def test_schedule_split_buckets(self):
+        """ The Buckets created by splits after the start should be scheduled at once,
+        spread over the jitter, and a split Bucket shouldn't be scheduled anymore. """
+
+        scheduler = RefreshScheduler(self.tree, self.lookup, interval=10, jitter=0.5)
+        scheduler.start()
+
+        before = self.tree.get_leaf_bucket_nodes(include_self=True)
+
+        for i in range(100, 2000):
+            self.tree.add_node(Node(hash_string(str(i)), '127.0.0.1', 9999))
+
+        bucket_nodes = self.tree.get_leaf_bucket_nodes(include_self=True)
+        new = [bucket_node for bucket_node in bucket_nodes if bucket_node not in before]
+
+        self.assertTrue(len(new) > 1)
+        self.assertEqual(set(scheduler.scheduled), set(bucket_nodes))
+        self.assertEqual(len(scheduler.timers), len(bucket_nodes))
+        self.assertEqual(len({scheduler.scheduled[bucket_node].when for bucket_node in new}), len(new))
+
+        scheduler.stop()
+        self.assertIsNone(self.tree.on_split)
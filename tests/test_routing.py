@@ -2,10 +2,11 @@ import unittest
 
 from dht import settings
 
-from dht.bucket import NodeAlreadyAddedException, BucketIsFullException
+from dht.bucket import (
+    Bucket, NodeAlreadyAddedException, BucketIsFullException, NodeNotFoundException)
 from dht.node import Node, SelfNode
 from dht.routing import BucketTree, BucketNode
-from dht.utils import hash_string
+from dht.utils import hash_string, hex_to_bin
 
 
 class BucketTreeTest(unittest.TestCase):
@@ -35,6 +36,28 @@ class BucketTreeTest(unittest.TestCase):
         expected_amount = settings.KEY_SIZE * 2 + 1
         assert len(tree.bucket_node_list) == expected_amount
 
+    def test_key_size(self):
+        """ A BucketTree with 160 bit keys should split at most 160 times, and find
+        nodes by their 160 bit keys. """
+
+        self_key = hash_string('self', 160)
+        self.assertEqual(len(self_key), 40)
+
+        tree = BucketTree(SelfNode(self_key, '127.0.0.1', '9999'), key_size=160)
+
+        # The neighbour of the SelfNode splits the tree all the way down.
+        tree.add_node(Node('{:040x}'.format(int(self_key, 16) ^ 1), None, None))
+        self.assertEqual(len(tree.bucket_node_list), 160 * 2 + 1)
+
+        for i in range(100):
+            tree.add_node(Node(hash_string(str(i), 160), None, None))
+
+        key = hash_string('test', 160)
+        expected = sorted(
+            (node.key for node in tree.find_nodes(key, 1000)), key=lambda other: int(other, 16) ^ int(key, 16))
+
+        self.assertEqual([node.key for node in tree.find_nodes(key)], expected[:settings.BUCKET_SIZE])
+
     def test_add_node_twice(self):
         """ Add a Node twice. This should raise a NodeAlreadyAddedException. """
 
@@ -65,8 +88,8 @@ class BucketTreeTest(unittest.TestCase):
         self.assertEqual(node1, node2)
 
     def test_full_bucket(self):
-        """ A Bucket should raise an BucketIsFullException when the Bucket's Node list and
-        replacement cache are full. """
+        """ A node should not be added to the tree when the Bucket's Node list is full,
+        also when the replacement cache is full. """
 
         tree = self.get_new_tree()
 
@@ -87,6 +110,71 @@ class BucketTreeTest(unittest.TestCase):
         # Bucket should be full by now.
         self.assertFalse(tree.add_node(node))
 
+    def test_full_bucket_pings_least_recently_seen(self):
+        """ A node added to a full Bucket should go to the replacement cache, and the
+        least recently seen node should be checked. If it doesn't respond, the latest
+        replacement takes its place. """
+
+        full = []
+        tree = BucketTree(SelfNode('0', '127.0.0.1', '9999'), on_bucket_full=full.append)
+
+        dec_key = int(hash_string('test'), 16)
+        nodes = [Node(hex(dec_key + i)[2:], None, None) for i in range(settings.BUCKET_SIZE + 1)]
+
+        for node in nodes[:settings.BUCKET_SIZE]:
+            self.assertTrue(tree.add_node(node))
+
+        # The first node was seen again, so the second is the least recently seen.
+        tree.touch_node(nodes[0])
+
+        self.assertFalse(tree.add_node(nodes[-1]))
+        self.assertEqual(full, [nodes[1]])
+
+        tree.replace_node(nodes[1])
+
+        self.assertEqual(tree.find_node(nodes[-1].key), nodes[-1])
+        self.assertRaises(NodeNotFoundException, tree.find_node, nodes[1].key)
+
+    def test_node_failed(self):
+        """ A node should only be replaced once it failed too many times in a row. """
+
+        tree = BucketTree(SelfNode('0', '127.0.0.1', '9999'))
+
+        dec_key = int(hash_string('test'), 16)
+        nodes = [Node(hex(dec_key + i)[2:], None, None) for i in range(settings.BUCKET_SIZE + 1)]
+
+        for node in nodes:
+            tree.add_node(node)
+
+        for _ in range(settings.BUCKET_STALE_FAILURES - 1):
+            nodes[0].add_failure()
+            tree.node_failed(nodes[0])
+
+        self.assertEqual(tree.find_node(nodes[0].key), nodes[0])
+
+        nodes[0].add_failure()
+        tree.node_failed(nodes[0])
+
+        self.assertRaises(NodeNotFoundException, tree.find_node, nodes[0].key)
+        self.assertEqual(tree.find_node(nodes[-1].key), nodes[-1])
+
+    def test_find_bucket_node_by_prefix(self):
+        """ The BucketNode found by shared prefix length should be the leaf on the route of
+        the key. """
+
+        tree = BucketTree(SelfNode(hash_string('self'), '127.0.0.1', '9999'))
+
+        for i in range(200):
+            key = hash_string(str(i))
+            tree.add_node(Node(key, None, None))
+
+        for i in range(400):
+            key = hash_string(str(i))
+            bucket_node = tree._find_bucket_node(int(key, 16))
+
+            self.assertTrue(bucket_node.bucket is not None)
+            self.assertTrue(hex_to_bin(key).startswith(bucket_node.route))
+
     def test_find_nodes(self):
 
         tree = self.get_new_tree()
@@ -114,6 +202,125 @@ class BucketTreeTest(unittest.TestCase):
         self.assertEqual(len(nodes), 20)
 
 
+    def test_find_nodes_closest(self):
+        """ find_nodes should return the closest nodes by XOR distance, closest first. """
+
+        tree = BucketTree(SelfNode(hash_string('self'), '127.0.0.1', '9999'))
+
+        for i in range(500):
+            tree.add_node(Node(hash_string(str(i)), None, None))
+
+        all_nodes = [
+            node for bucket_node in tree.get_leaf_bucket_nodes(include_self=True)
+            for node in bucket_node.bucket.nodes.values()
+        ]
+
+        for target in ('test', 'other', '42'):
+            key = int(hash_string(target), 16)
+
+            nodes = tree.find_nodes(hash_string(target))
+            expected = sorted(all_nodes, key=lambda node: int(node.key, 16) ^ key)
+
+            self.assertEqual(len(nodes), settings.BUCKET_SIZE)
+            self.assertEqual(nodes, expected[:settings.BUCKET_SIZE])
+
+
+class BucketTest(unittest.TestCase):
+
+    def test_least_recently_seen(self):
+        """ Nodes should be ordered by when they were seen, touch moves a node to the
+        end. """
+
+        bucket = Bucket(nodes_size=3, replacement_cache_size=1)
+        nodes = [Node(hash_string(str(i)), None, None) for i in range(3)]
+
+        for node in nodes:
+            self.assertTrue(bucket.add_node(node))
+
+        self.assertEqual(bucket.get_least_recently_seen(), nodes[0])
+
+        bucket.touch(nodes[0].key)
+
+        self.assertEqual(bucket.get_least_recently_seen(), nodes[1])
+        self.assertEqual(list(bucket.nodes.values()), [nodes[1], nodes[2], nodes[0]])
+
+    def test_replace_node(self):
+        """ A replaced node should make room for the most recently seen node of the
+        replacement cache. """
+
+        bucket = Bucket(nodes_size=1, replacement_cache_size=2)
+        node, first, second = [Node(hash_string(str(i)), None, None) for i in range(3)]
+
+        bucket.add_node(node)
+        self.assertFalse(bucket.add_node(first))
+        self.assertFalse(bucket.add_node(second))
+
+        # Seeing the first replacement again makes it the most recently seen.
+        bucket.touch(first.key)
+
+        self.assertEqual(bucket.replace_node(node.key), first)
+        self.assertEqual(list(bucket.nodes.values()), [first])
+        self.assertEqual(list(bucket.replacement_cache.values()), [second])
+
+    def test_replacement_seen_again(self):
+        """ A replacement that is added again should keep its address and history, and
+        become the most recently seen replacement. """
+
+        bucket = Bucket(nodes_size=1, replacement_cache_size=2)
+        node, first, second = [Node(hash_string(str(i)), '127.0.0.1', 1000) for i in range(3)]
+        first.add_response_time(0.1)
+
+        bucket.add_node(node)
+        bucket.add_node(first)
+        bucket.add_node(second)
+        bucket.add_node(Node(first.key, None, None))
+
+        self.assertEqual(list(bucket.replacement_cache.values()), [second, first])
+        self.assertEqual(bucket.replace_node(node.key), first)
+        self.assertEqual(bucket.nodes[first.key].address, '127.0.0.1')
+        self.assertEqual(bucket.nodes[first.key].response_time, 0.1)
+
+    def test_replace_node_without_replacement(self):
+        """ A node without a replacement should stay in the Bucket. """
+
+        bucket = Bucket(nodes_size=1, replacement_cache_size=2)
+        node = Node(hash_string('0'), None, None)
+        bucket.add_node(node)
+
+        self.assertEqual(bucket.replace_node(node.key), None)
+        self.assertEqual(list(bucket.nodes.values()), [node])
+
+    def test_full_replacement_cache(self):
+        """ A full replacement cache should drop its least recently seen node for a new
+        one. """
+
+        bucket = Bucket(nodes_size=1, replacement_cache_size=2)
+        nodes = [Node(hash_string(str(i)), None, None) for i in range(4)]
+
+        for node in nodes:
+            bucket.add_node(node)
+
+        self.assertEqual(list(bucket.replacement_cache.values()), [nodes[2], nodes[3]])
+
+    def test_stale_node(self):
+        """ A stale node should be replaced by a new node right away. """
+
+        bucket = Bucket(nodes_size=2, replacement_cache_size=2, stale_failures=2)
+        nodes = [Node(hash_string(str(i)), None, None) for i in range(3)]
+
+        bucket.add_node(nodes[0])
+        bucket.add_node(nodes[1])
+
+        nodes[1].add_failure()
+        self.assertFalse(bucket.add_node(nodes[2]))
+
+        nodes[1].add_failure()
+        bucket.replacement_cache.clear()
+        self.assertTrue(bucket.add_node(nodes[2]))
+
+        self.assertEqual(list(bucket.nodes.values()), [nodes[0], nodes[2]])
+
+
 class BucketNodeTest(unittest.TestCase):
 
     def test_split(self):
@@ -0,0 +1,338 @@
+import asyncio
+import unittest
+
+from unittest import mock
+
+from dht import metrics, settings
+from dht.lookup import NodeLookup, ValueLookup
+from dht.node import Node
+from dht.protocol import DHTProtocol
+from dht.ratelimit import create_peer_rate_limiter
+from dht.simulator import Network, SimulatedDHT, Simulation, VirtualTimeLoop, create_network
+from dht.utils import hash_string
+from dht.value_stores.base import ValueStore
+
+
+class SimulatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_loop = asyncio.get_event_loop_policy().get_event_loop()
+        self.loop = VirtualTimeLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        # Stop the pings the nodes of the test still have running.
+        tasks = asyncio.all_tasks(self.loop)
+
+        for task in tasks:
+            task.cancel()
+
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    def test_join(self):
+        """ Every node should know the node it joined through, and the other way
+        around. """
+
+        dhts = create_network(10, self.loop)
+        addresses = {(dht.address, dht.listen_port): dht for dht in dhts}
+
+        for dht in dhts[1:]:
+            initial = addresses[dht.initial_nodes[0]]
+
+            self.assertEqual(dht.bucket_tree.find_node(initial.self_key).address, initial.address)
+            self.assertEqual(initial.bucket_tree.find_node(dht.self_key).address, dht.address)
+
+    def test_join_with_unreachable_seed(self):
+        """ A node should join through the seeds that answer, also when one of its
+        seeds is down. """
+
+        dhts = create_network(5, self.loop)
+        seeds = [('10.9.9.9', 9999)] + [(dht.address, dht.listen_port) for dht in dhts[:3]]
+
+        dht = SimulatedDHT(dhts[0].network, '10.0.1.0', 9999, seeds)
+        self.loop.run_until_complete(dht.join())
+
+        for other in dhts[:3]:
+            self.assertEqual(dht.bucket_tree.find_node(other.self_key).address, other.address)
+            self.assertEqual(other.bucket_tree.find_node(dht.self_key).address, dht.address)
+
+    def test_lookup(self):
+        """ A lookup in the simulated network should find the closest nodes. """
+
+        dhts = create_network(50, self.loop)
+
+        key = hash_string('test')
+        expected = sorted(
+            (dht.self_key for dht in dhts), key=lambda other: int(other, 16) ^ int(key, 16))
+
+        nodes = self.loop.run_until_complete(dhts[-1].lookup_node(key))
+
+        # The node doing the lookup isn't part of the result.
+        expected.remove(dhts[-1].self_key)
+
+        self.assertEqual([node.key for node in nodes], expected[:settings.BUCKET_SIZE])
+
+    def test_find_node_leaves_out_self(self):
+        """ A find_node response should hold neither the node that responds nor the
+        node that asks. """
+
+        dhts = create_network(30, self.loop)
+        dht, other = dhts[0], dhts[1]
+
+        node = dht.bucket_tree.find_node(other.self_key)
+        protocol = self.loop.run_until_complete(dht.get_protocol(node))
+        contacts = self.loop.run_until_complete(protocol.find_node(other.self_key))
+
+        keys = [contact[0] for contact in contacts]
+
+        self.assertEqual(len(keys), settings.BUCKET_SIZE)
+        self.assertNotIn(other.self_key, keys)
+        self.assertNotIn(dht.self_key, keys)
+        self.assertTrue(all(contact[1] is not None for contact in contacts))
+
+    def test_connection_refused(self):
+        """ Connecting to an address nobody listens on should fail. """
+
+        network = Network(self.loop)
+        dht = SimulatedDHT(network, '10.0.0.1', 9999)
+
+        self.assertRaises(
+            ConnectionRefusedError, self.loop.run_until_complete,
+            dht.connect_to_node(Node(hash_string('other'), '10.0.0.2', 9999)))
+
+    def test_closed_connection_dialed_again(self):
+        """ A node whose connection closed should be unconnected in the BucketTree and
+        be dialed again, also when it was added before it connected. """
+
+        dhts = create_network(10, self.loop)
+        dht, other = dhts[0], dhts[-1]
+
+        # Connect again, so the Node gets its protocol from the identify response.
+        node = dht.bucket_tree.find_node(other.self_key)
+        node.protocol.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        protocol = self.loop.run_until_complete(dht.get_protocol(node))
+        self.loop.run_until_complete(protocol.ping())
+
+        self.assertIs(node.protocol, protocol)
+        self.assertIs(protocol.node, node)
+
+        protocol.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertFalse(node.is_connected())
+        self.assertIn(node, dht.bucket_tree.get_unconnected_nodes())
+
+        dht.connections.dial_nodes(dht.bucket_tree.get_unconnected_nodes())
+        self.loop.run_until_complete(asyncio.sleep(1))
+
+        self.assertTrue(node.is_connected())
+        self.assertIs(node.protocol.node, node)
+
+    def test_incoming_connection_reused(self):
+        """ A node that connected to us should be reached over that connection, not
+        be dialed again. """
+
+        dhts = create_network(5, self.loop)
+        dht, other = dhts[0], dhts[1]
+
+        node = dht.bucket_tree.find_node(other.self_key)
+        incoming = other.network.connect(other, dht.address, dht.listen_port, protocol_class=DHTProtocol)
+        self.loop.run_until_complete(incoming.identify())
+
+        protocol = self.loop.run_until_complete(dht.get_protocol(node))
+
+        self.assertIs(protocol.transport.peer.protocol, incoming)
+
+    def test_simulation(self):
+        """ Lookups should keep finding the closest node with latency, loss and churn.
+        The loop runs on virtual time, so the timeouts don't depend on the load of
+        the machine. """
+
+        simulation = Simulation(latency=0.01, jitter=0.01, loss=0.01, seed=1, loop=self.loop)
+        results = simulation.run(50, 30, churn=0.1)
+
+        self.assertEqual(results['nodes'], 50)
+        self.assertEqual(results['lookups'], 30)
+        self.assertEqual(sum(results['hops'].values()), 30)
+        self.assertTrue(results['success_rate'] > 0.8)
+        self.assertTrue(results['messages_per_node_mean'] > 0)
+
+    def test_latency(self):
+        """ Messages should arrive after the latency, in the order they were sent. """
+
+        network = Network(self.loop, latency=0.01, jitter=0.01)
+        sender = SimulatedDHT(network, '10.0.0.1', 9999)
+        SimulatedDHT(network, '10.0.0.2', 9999)
+
+        protocol = network.connect(sender, '10.0.0.2', 9999, protocol_class=DHTProtocol)
+        futures = [protocol.ping() for _ in range(10)]
+
+        start = self.loop.time()
+        results = self.loop.run_until_complete(asyncio.gather(*futures))
+
+        self.assertEqual(results, [True] * 10)
+        self.assertTrue(self.loop.time() - start >= 0.02)
+        self.assertEqual(network.messages['10.0.0.2'], 10)
+
+    def test_ping_busy_node(self):
+        """ A node that answers a ping with busy should be kept, a node that doesn't
+        answer should be replaced. """
+
+        dhts = create_network(5, self.loop)
+        dht, other = dhts[0], dhts[1]
+        node = dht.bucket_tree.find_node(other.self_key)
+
+        with mock.patch.object(dht.bucket_tree, 'replace_node') as replace_node, \
+                mock.patch.object(settings, 'INBOUND_BURST', 0):
+            other.inbound_limits = create_peer_rate_limiter()
+
+            for protocol in other.connections.get_open_protocols():
+                protocol.inbound_limits = other.inbound_limits
+
+            self.loop.run_until_complete(dht.ping_node(node))
+            self.assertFalse(replace_node.called)
+
+            other.leave()
+            self.loop.run_until_complete(dht.ping_node(node))
+            self.assertTrue(replace_node.called)
+
+    def test_leave_cancels_pings(self):
+        """ A node that leaves should stop pinging the nodes of its full Buckets. """
+
+        dhts = create_network(5, self.loop)
+        dht = dhts[0]
+
+        dht.check_node(dht.bucket_tree.find_node(dhts[1].self_key))
+        task = dht.pinging[dhts[1].self_key]
+
+        dht.leave()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+        self.assertTrue(task.cancelled())
+        self.assertEqual(dht.pinging, {})
+
+    def test_put_many_get_many(self):
+        """ Values stored in batches should be found in batches from another node. """
+
+        dhts = create_network(30, self.loop)
+        values = ['value {:d}'.format(i) for i in range(50)]
+
+        keys = self.loop.run_until_complete(dhts[0].put_many(values))
+        self.assertEqual(keys, [hash_string(value) for value in values])
+
+        sent = metrics.RPCS_SENT.values.get(('find_values',), 0)
+        found = self.loop.run_until_complete(dhts[-1].get_many(keys + [hash_string('missing')]))
+
+        self.assertEqual(found, dict(zip(keys, values)))
+
+        # The keys are asked for in batches, far less than a request for every key.
+        self.assertTrue(metrics.RPCS_SENT.values[('find_values',)] - sent < 20)
+
+    def test_put_with_node_gone(self):
+        """ A put should store the value at the closest nodes that are still there,
+        also when one of them left after it was found. """
+
+        dhts = create_network(40, self.loop)
+        key = hash_string('value')
+
+        self.loop.run_until_complete(dhts[0].lookup_node(key))
+
+        closest = sorted(dhts[1:], key=lambda dht: dht.self_node.int_key ^ int(key, 16))
+        closest[0].leave()
+
+        self.assertEqual(self.loop.run_until_complete(dhts[0].put('value')), key)
+
+        stored = [dht for dht in closest[1:settings.BUCKET_SIZE] if key in dht.value_store]
+        self.assertEqual(len(stored), settings.BUCKET_SIZE - 1)
+
+    def test_put_skips_node_cache(self):
+        """ A put should look up the closest nodes again, the cached nodes may have
+        left. A later lookup should still use the cache. """
+
+        dhts = create_network(20, self.loop)
+        key = hash_string('value')
+
+        self.loop.run_until_complete(dhts[0].lookup_node(key))
+
+        with mock.patch('dht.main.NodeLookup', side_effect=NodeLookup) as node_lookup:
+            self.loop.run_until_complete(dhts[0].put('value'))
+            self.assertEqual(node_lookup.call_count, 1)
+
+            self.loop.run_until_complete(dhts[0].lookup_node(key))
+            self.assertEqual(node_lookup.call_count, 1)
+
+    def test_put_stores_here(self):
+        """ A node that is one of the closest to the key should store the value itself. """
+
+        dhts = create_network(40, self.loop)
+        key = hash_string('value')
+
+        closest = min(dhts, key=lambda dht: dht.self_node.int_key ^ int(key, 16))
+        self.loop.run_until_complete(closest.put('value'))
+
+        self.assertEqual(closest.value_store.retrieve(key), 'value')
+
+    def test_put_many_stores_here(self):
+        """ A node that is one of the closest to a key should store the value itself,
+        also when it stores values in batches. """
+
+        dhts = create_network(10, self.loop)
+        values = ['value {:d}'.format(i) for i in range(5)]
+
+        keys = self.loop.run_until_complete(dhts[0].put_many(values))
+
+        for key, value in zip(keys, values):
+            self.assertEqual(dhts[0].value_store.retrieve(key), value)
+
+    def test_republish_values(self):
+        """ A value should be kept while its publisher republishes it. A value nobody
+        publishes anymore should expire, also while the nodes holding it republish
+        it. """
+
+        with mock.patch.object(ValueStore, 'clock', staticmethod(self.loop.time)), \
+                mock.patch.object(settings, 'VALUE_TTL', 100), \
+                mock.patch.object(settings, 'REPUBLISH_INTERVAL', 10), \
+                mock.patch.object(settings, 'EXPIRE_INTERVAL', 1):
+            dhts = create_network(20, self.loop)
+
+            kept = self.loop.run_until_complete(dhts[0].put('kept'))
+            orphan = self.loop.run_until_complete(dhts[0].put('orphan'))
+
+            # The publisher forgets the orphan, like a publisher that left.
+            del dhts[0].published[orphan]
+
+            for dht in dhts:
+                self.loop.create_task(dht.expire_values())
+                self.loop.create_task(dht.republish_values())
+
+            self.loop.run_until_complete(asyncio.sleep(50))
+            self.assertTrue(any(orphan in dht.value_store for dht in dhts))
+
+            self.loop.run_until_complete(asyncio.sleep(100))
+
+        self.assertEqual([dht for dht in dhts if orphan in dht.value_store], [])
+        self.assertEqual(len([dht for dht in dhts if kept in dht.value_store]), len(dhts))
+
+    def test_shared_lookups(self):
+        """ Concurrent gets of the same key should share a single lookup, and a found
+        value should be cached. """
+
+        dhts = create_network(40, self.loop)
+        key = self.loop.run_until_complete(dhts[0].put('value'))
+
+        dht = next(dht for dht in dhts if key not in dht.value_store)
+
+        with mock.patch('dht.main.ValueLookup', side_effect=ValueLookup) as value_lookup:
+            values = self.loop.run_until_complete(asyncio.gather(*[dht.get(key) for _ in range(10)]))
+
+            self.assertEqual(values, ['value'] * 10)
+            self.assertEqual(value_lookup.call_count, 1)
+
+            self.assertEqual(self.loop.run_until_complete(dht.get(key)), 'value')
+            self.assertEqual(value_lookup.call_count, 1)
+
+        self.assertEqual(dht.lookups, {})
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+from dht.node import Node, SelfNode
+from dht.routing import BucketTree
+from dht.snapshot import SnapshotException, read_snapshot, write_snapshot
+from dht.utils import hash_string
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'snapshot')
+
+        self_key = hash_string('self')
+        self.tree = BucketTree(SelfNode(self_key, '127.0.0.1', 9999))
+
+        for index in range(200):
+            self.tree.add_node(Node(hash_string(str(index)), '10.0.0.{:d}'.format(index % 256), 9000 + index))
+
+        self.tree.add_node(Node(hash_string('ipv6'), '::1', 9999))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_buckets(self, tree) -> list:
+        return [
+            ([(node.key, node.address, int(node.port)) for node in bucket_node.bucket.nodes.values()],
+             [node.key for node in bucket_node.bucket.replacement_cache.values()])
+            for bucket_node in tree.get_leaf_bucket_nodes(include_self=True)
+        ]
+
+    def test_restore(self):
+        """ A BucketTree built from a snapshot should have the same Buckets and
+        replacement caches as the BucketTree it was written from. """
+
+        write_snapshot(self.path, self.tree)
+        self_key, nodes = read_snapshot(self.path)
+
+        self.assertEqual(self_key, self.tree.self_node.key)
+
+        tree = BucketTree(SelfNode(self_key, '127.0.0.1', 9999))
+
+        for node in nodes:
+            tree.add_node(node)
+
+        self.assertTrue(any(replacements for _, replacements in self.get_buckets(self.tree)))
+        self.assertEqual(self.get_buckets(tree), self.get_buckets(self.tree))
+
+    def test_damaged(self):
+        """ A damaged snapshot should raise a SnapshotException. """
+
+        write_snapshot(self.path, self.tree)
+
+        with open(self.path, 'r+b') as snapshot_file:
+            snapshot_file.seek(100)
+            snapshot_file.write(b'\xff\xff')
+
+        self.assertRaises(SnapshotException, read_snapshot, self.path)
+
+    def test_other_key_size(self):
+        """ A snapshot with keys of another size should raise a SnapshotException. """
+
+        write_snapshot(self.path, self.tree)
+        self.assertRaises(SnapshotException, read_snapshot, self.path, 160)
@@ -0,0 +1,329 @@
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from dht import settings
+from dht.utils import hash_string
+from dht.value_stores import create_value_store
+from dht.value_stores.disk import DiskStore
+from dht.value_stores.memory import MemoryStore
+from dht.value_stores.shared import SharedStore, serve_store, stop_store
+
+
+class MemoryStoreTest(unittest.TestCase):
+
+    def test_store_retrieve(self):
+        """ A stored value should be retrievable by its hash and counted in the size. """
+
+        store = create_value_store('memory')
+        self.assertTrue(isinstance(store, MemoryStore))
+
+        key = store.store('value')
+
+        self.assertEqual(key, hash_string('value'))
+        self.assertEqual(store.retrieve(key), 'value')
+        self.assertEqual(store.size, 5)
+
+        # Storing the same value again shouldn't count twice.
+        store.store('value')
+        self.assertEqual(store.size, 5)
+
+        store.remove(key)
+
+        self.assertEqual(store.size, 0)
+        self.assertFalse(key in store)
+
+        with self.assertRaises(KeyError):
+            store.retrieve(key)
+
+
+    def test_expire(self):
+        """ Values should be removed when they expire, storing them again renews them. """
+
+        now = [1000.0]
+
+        store = MemoryStore()
+        store.clock = lambda: now[0]
+
+        first = store.store('first', ttl=10)
+        second = store.store('second', ttl=20)
+
+        now[0] += 15
+        store.store('second', ttl=20)
+
+        # Expired values can't be retrieved, even before expire() is called.
+        with self.assertRaises(KeyError):
+            store.retrieve(first)
+
+        now[0] += 10
+        self.assertEqual(store.expire(), 0)
+        self.assertEqual(store.retrieve(second), 'second')
+
+        now[0] += 20
+        self.assertEqual(store.expire(), 1)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.size, 0)
+
+    def test_store_remaining(self):
+        """ A republished value should be stored for the time it has left, and not
+        shorten the expiry time of a value that is stored already. """
+
+        now = [1000.0]
+
+        store = MemoryStore()
+        store.clock = lambda: now[0]
+
+        key = store.store_remaining('value', 10)
+        self.assertEqual(store.get_expires(key), 1010)
+
+        store.store_remaining('value', 5)
+        self.assertEqual(store.get_expires(key), 1010)
+
+        store.store_remaining('value', 20)
+        self.assertEqual(store.get_expires(key), 1020)
+
+        store.store_remaining('other', 0)
+        self.assertEqual(len(store), 1)
+
+    def test_evict(self):
+        """ The least recently used values should be evicted at the maximum. """
+
+        store = MemoryStore(max_values=2)
+
+        first = store.store('first')
+        second = store.store('second')
+
+        # Use the first value, so the second is the least recently used.
+        store.retrieve(first)
+        third = store.store('third')
+
+        self.assertEqual(sorted(store.keys()), sorted([first, third]))
+        self.assertFalse(second in store)
+
+        store = MemoryStore(max_size=10)
+        store.store('12345')
+        store.store('67890')
+        store.store('abc')
+
+        self.assertEqual(store.size, 8)
+
+
+class DiskStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_restart(self):
+        """ Values should still be there after opening the store again. """
+
+        store = DiskStore(self.path, segment_size=100)
+        keys = [store.store('value {:d}'.format(i)) for i in range(20)]
+        store.remove(keys[0])
+        store.close()
+
+        # The small segment size should've created many segments.
+        self.assertTrue(len(os.listdir(self.path)) > 1)
+
+        store = DiskStore(self.path, segment_size=100)
+
+        self.assertEqual(len(store), 19)
+        self.assertFalse(keys[0] in store)
+        self.assertEqual(store.retrieve(keys[5]), 'value 5')
+        self.assertEqual(store.size, sum(len('value {:d}'.format(i)) for i in range(1, 20)))
+
+        store.close()
+
+    def test_damaged_segment(self):
+        """ A record cut short by a crash should be dropped, the records before it kept. """
+
+        store = DiskStore(self.path)
+        first = store.store('first')
+        second = store.store('second')
+        store.close()
+
+        segment_path = store.get_segment_path(0)
+
+        with open(segment_path, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(segment_path) - 2)
+
+        store = DiskStore(self.path)
+
+        self.assertEqual(store.retrieve(first), 'first')
+        self.assertFalse(second in store)
+
+        # New values should be appended after the last complete record.
+        third = store.store('third')
+        store.close()
+
+        store = DiskStore(self.path)
+        self.assertEqual(store.retrieve(third), 'third')
+        store.close()
+
+    def test_compact(self):
+        """ Removing most values should compact the segments into new ones. """
+
+        store = DiskStore(self.path, segment_size=200)
+        keys = [store.store('value {:d}'.format(i)) for i in range(50)]
+
+        for key in keys[:45]:
+            store.remove(key)
+
+        self.assertTrue(store.garbage < 200)
+        store.close()
+
+        store = DiskStore(self.path, segment_size=200)
+
+        self.assertEqual(sorted(store.keys()), sorted(keys[45:]))
+        self.assertEqual(store.retrieve(keys[49]), 'value 49')
+
+        store.close()
+
+    def test_expire(self):
+        """ Expiry times should be kept across restarts, and renewed by storing again. """
+
+        now = [1000.0]
+
+        class ClockDiskStore(DiskStore):
+            clock = staticmethod(lambda: now[0])
+
+        store = ClockDiskStore(self.path)
+
+        first = store.store('first', ttl=10)
+        second = store.store('second', ttl=10)
+
+        now[0] += 5
+        store.store('second', ttl=10)
+        store.close()
+
+        now[0] += 6
+
+        # Opening the store again should remove the expired value right away.
+        store = ClockDiskStore(self.path)
+
+        self.assertFalse(first in store)
+        self.assertEqual(store.get_expires(second), 1015.0)
+
+        store.close()
+
+    def test_evict(self):
+        """ The least recently used values should be evicted at the maximum size. """
+
+        store = DiskStore(self.path, max_size=10)
+
+        first = store.store('12345')
+        second = store.store('67890')
+        store.retrieve(first)
+        store.store('abc')
+
+        self.assertTrue(first in store)
+        self.assertFalse(second in store)
+        self.assertEqual(store.size, 8)
+
+        store.close()
+
+
+class SharedStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.server = serve_store(self.store)
+
+    def tearDown(self):
+        stop_store(self.server)
+
+    def test_store_retrieve(self):
+        """ Values stored through a SharedStore should end up in the served store, and
+        be retrievable through another SharedStore. """
+
+        first = create_value_store('shared', address=self.server.address)
+        second = SharedStore(self.server.address)
+
+        key = first.store('value')
+        first.close()
+        second.sync()
+
+        self.assertEqual(self.store.retrieve(key), 'value')
+        self.assertEqual(second.retrieve(key), 'value')
+        self.assertTrue(key in second)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(second.size, 5)
+
+        second.remove(key)
+
+        third = SharedStore(self.server.address)
+
+        self.assertFalse(key in self.store)
+        self.assertFalse(key in third)
+
+        with self.assertRaises(KeyError):
+            second.retrieve(key)
+
+        second.close()
+        third.close()
+
+    def test_cached_retrieve(self):
+        """ A value that is stored or retrieved once should be served from the cache,
+        a key that isn't stored shouldn't be asked for. Neither is a round trip to
+        the served store. """
+
+        store = SharedStore(self.server.address)
+        key = store.store('value')
+
+        with mock.patch.object(store, 'proxy') as proxy:
+            self.assertEqual(store.retrieve(key), 'value')
+            self.assertTrue(key in store)
+
+            with self.assertRaises(KeyError):
+                store.retrieve(hash_string('missing'))
+
+            self.assertFalse(hash_string('missing') in store)
+            self.assertFalse(proxy.retrieve.called)
+
+        store.close()
+
+    def test_sync_index(self):
+        """ The index should learn the keys other workers store, and the keys the
+        served store removes itself. """
+
+        first = SharedStore(self.server.address)
+        second = SharedStore(self.server.address)
+
+        key = first.store('value')
+        first.close()
+
+        self.assertFalse(key in second)
+        second.sync()
+        self.assertTrue(key in second)
+
+        self.store.remove(key)
+        second.sync()
+
+        self.assertFalse(key in second)
+        self.assertEqual(second.keys(), [])
+
+        second.close()
+
+    def test_sync_log_overflow(self):
+        """ A worker that missed more changes than the log holds should start over
+        from all the keys. """
+
+        with mock.patch.object(settings, 'SHARED_STORE_LOG_SIZE', 2):
+            server = serve_store(MemoryStore())
+
+        first = SharedStore(server.address)
+        second = SharedStore(server.address)
+
+        keys = [first.store('value {:d}'.format(i)) for i in range(5)]
+        first.close()
+        second.sync()
+
+        self.assertEqual(sorted(second.keys()), sorted(keys))
+
+        second.close()
+        stop_store(server)
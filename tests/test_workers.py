@@ -0,0 +1,38 @@
+import unittest
+
+from unittest import mock
+
+from dht import settings
+from dht.workers import Supervisor
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def test_start_worker(self):
+        """ Every worker should listen on its own port, join through the first worker
+        and use the value store of the supervisor. """
+
+        supervisor = Supervisor(3, 9000, [('10.0.0.1', 9999)])
+        supervisor.server = mock.Mock(address=('127.0.0.1', 5000))
+
+        with mock.patch('multiprocessing.Process') as process_class, \
+                mock.patch.object(settings, 'METRICS_PORT', 9100):
+            supervisor.start_worker(0)
+            supervisor.start_worker(2)
+
+        first, third = [call[1]['args'] for call in process_class.call_args_list]
+
+        self.assertEqual(first[1], 9000)
+        self.assertEqual(first[2], [('10.0.0.1', 9999)])
+
+        self.assertEqual(third[1], 9002)
+        self.assertEqual(third[2], [('10.0.0.1', 9999), ('127.0.0.1', 9000)])
+
+        worker_settings = third[4]
+
+        self.assertEqual(worker_settings['VALUE_STORE'], 'shared')
+        self.assertEqual(worker_settings['VALUE_STORE_ADDRESS'], ('127.0.0.1', 5000))
+        self.assertEqual(worker_settings['METRICS_PORT'], 9102)
+        self.assertEqual(worker_settings['KEY_SIZE'], settings.KEY_SIZE)
+
+        self.assertEqual(len(supervisor.processes), 2)